@@ -239,6 +239,7 @@ def commands():
             # vmgroup {create, update, rm , ls} - manipulates vmgroup
             # vmgroup vm {add, rm, ls}  - manipulates VMs for a vmgroup
             # vmgroup access {add, set, rm, ls} - manipulates datastore access right for a vmgroup
+            # vmgroup ratelimit {set, ls} - manipulates request rate limits for a vmgroup
             #
             # Internally, "vmgroup" is called "tenant".
             # We decided to keep the name of functions as "tenant_*" for now
@@ -454,6 +455,47 @@ def commands():
                             }
                         }
                     }
+                },
+                'ratelimit': {
+                    'help': 'Limit the rate of volume requests from the VMs of a vmgroup',
+                    'cmds': {
+                        'set': {
+                            'func': tenant_rate_limit_set,
+                            'help': 'Set request rate limits for a vmgroup, unset limits are removed',
+                            'args': {
+                                '--name': {
+                                    'help': 'The name of the vmgroup',
+                                    'required': True
+                                },
+                                '--vm-rate': {
+                                    'help': 'Requests per second allowed from each VM of the vmgroup',
+                                    'metavar': 'Num - e.g. 2.5'
+                                },
+                                '--vm-burst': {
+                                    'help': 'Max number of requests each VM of the vmgroup may send at once',
+                                    'metavar': 'Num - e.g. 10'
+                                },
+                                '--vmgroup-rate': {
+                                    'help': 'Requests per second allowed from all VMs of the vmgroup together',
+                                    'metavar': 'Num - e.g. 20'
+                                },
+                                '--vmgroup-burst': {
+                                    'help': 'Max number of requests all VMs of the vmgroup may send at once',
+                                    'metavar': 'Num - e.g. 50'
+                                }
+                            }
+                        },
+                        'ls': {
+                            'func': tenant_rate_limit_ls,
+                            'help': 'List request rate limits of a vmgroup',
+                            'args': {
+                                '--name': {
+                                    'help': 'The name of the vmgroup',
+                                    'required': True
+                                }
+                            }
+                        }
+                    }
                 }
             }
         },
@@ -815,17 +857,10 @@ def policy_rm(args):
 
 
 def policy_ls(args):
-    volumes = vsan_policy.list_volumes_and_policies()
+    used_policies = vsan_policy.get_policy_usage()
     policies = vsan_policy.get_policies()
     header = ['Policy Name', 'Policy Content', 'Active']
     rows = []
-    used_policies = {}
-    for v in volumes:
-        policy_name = v['policy']
-        if policy_name in used_policies:
-            used_policies[policy_name] = used_policies[policy_name] + 1
-        else:
-            used_policies[policy_name] = 1
 
     for name, content in policies.items():
         if name in used_policies:
@@ -838,7 +873,13 @@ def policy_ls(args):
 
 
 def policy_update(args):
-    output = vsan_policy.update(args.name,  args.content)
+    progress = None
+    if args.output_format != "xml":
+        def progress(updated, failed, total):
+            print("Updated {0} of {1} volumes, {2} failed".format(updated, total, failed))
+            sys.stdout.flush()
+
+    output = vsan_policy.update(args.name,  args.content, progress)
     if output:
         return err_out(output)
     else:
@@ -1006,7 +1047,18 @@ def tenant_rm(args):
     if args.remove_volumes:
         remove_volumes = True
 
-    error_info = auth_api._tenant_rm(args.name, remove_volumes, args.force)
+    progress = None
+    if remove_volumes and args.output_format != "xml":
+        error_info, rm_progress = auth_api._tenant_rm_progress(args.name)
+        if not error_info and rm_progress:
+            print("Resuming vmgroup rm: {0} of {1} volumes already removed"
+                  .format(rm_progress["removed"], rm_progress["total"]))
+
+        def progress(removed, total):
+            print("Removed {0} of {1} volumes".format(removed, total))
+            sys.stdout.flush()
+
+    error_info = auth_api._tenant_rm(args.name, remove_volumes, args.force, progress)
 
     if error_info:
         return err_out(error_info.msg)
@@ -1179,6 +1231,37 @@ def tenant_access_ls(args):
     else:
         printList(args.output_format, header, rows)
 
+def tenant_rate_limit_set(args):
+    """ Handle tenant ratelimit set command """
+    error_info = auth_api._tenant_rate_limit_set(name=args.name,
+                                                 vm_rate=args.vm_rate or 0,
+                                                 vm_burst=args.vm_burst or 0,
+                                                 group_rate=args.vmgroup_rate or 0,
+                                                 group_burst=args.vmgroup_burst or 0)
+    if error_info:
+        return err_out(error_info.msg)
+    else:
+        printMessage(args.output_format, "vmgroup ratelimit set succeeded")
+
+def tenant_rate_limit_ls_headers():
+    """ Return column names for tenant ratelimit ls command """
+    headers = ['VM_rate', 'VM_burst', 'Vmgroup_rate', 'Vmgroup_burst']
+    return headers
+
+def tenant_rate_limit_ls(args):
+    """ Handle tenant ratelimit ls command """
+    error_info, rate_limits = auth_api._tenant_rate_limit_ls(args.name)
+    if error_info:
+        return err_out(error_info.msg)
+
+    header = tenant_rate_limit_ls_headers()
+    rows = []
+    if rate_limits:
+        rows.append([UNSET if not rate_limits[col] else str(rate_limits[col])
+                     for col in (auth_data_const.COL_VM_RATE, auth_data_const.COL_VM_BURST,
+                                 auth_data_const.COL_GROUP_RATE, auth_data_const.COL_GROUP_BURST)])
+    printList(args.output_format, header, rows)
+
 # ==== CONFIG DB manipulation functions ====
 
 def create_db_symlink(path, link_path):
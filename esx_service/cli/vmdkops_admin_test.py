@@ -265,6 +265,24 @@ class TestParsing(unittest.TestCase):
     def test_tenant_access_ls_missing_option_fails(self):
         self.assert_parse_error(VMGROUP + ' access ls')
 
+    def test_tenant_rate_limit_set(self):
+        args = self.parser.parse_args((VMGROUP + ' ratelimit set --name=vmgroup1 --vm-rate=2.5 --vm-burst=10').split())
+        self.assertEqual(args.func, vmdkops_admin.tenant_rate_limit_set)
+        self.assertEqual(args.name, 'vmgroup1')
+        self.assertEqual(args.vm_rate, '2.5')
+        self.assertEqual(args.vm_burst, '10')
+        self.assertEqual(args.vmgroup_rate, None)
+        self.assertEqual(args.vmgroup_burst, None)
+
+    def test_tenant_rate_limit_ls(self):
+        args = self.parser.parse_args((VMGROUP + ' ratelimit ls --name=vmgroup1').split())
+        self.assertEqual(args.func, vmdkops_admin.tenant_rate_limit_ls)
+        self.assertEqual(args.name, 'vmgroup1')
+
+    def test_tenant_rate_limit_missing_option_fails(self):
+        self.assert_parse_error(VMGROUP + ' ratelimit set')
+        self.assert_parse_error(VMGROUP + ' ratelimit ls')
+
     def test_status(self):
         args = self.parser.parse_args(['status'])
         self.assertEqual(args.func, vmdkops_admin.status)
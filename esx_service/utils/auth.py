@@ -16,6 +16,13 @@
 
 """
 import logging
+import os
+import shutil
+import stat
+import struct
+import sys
+import threading
+import time
 import auth_data
 import sqlite3
 import convert
@@ -28,6 +35,13 @@ import vmdk_utils
 from error_code import ErrorCode
 from error_code import error_code_to_message
 
+if sys.version_info.major < 3:
+    # python 2.x
+    import Queue as queue
+else:
+    # python 3.x
+    import queue
+
 # All supported vmdk commands that need authorization checking
 CMD_CREATE = 'create'
 CMD_REMOVE = 'remove'
@@ -40,17 +54,391 @@ SIZE = 'size'
 # thread local storage in this module namespace
 thread_local = threadutils.get_local_storage()
 
+# Kinds of entries kept in auth_cache
+CACHE_VM_TENANT = 'vm_tenant'
+CACHE_DEFAULT_DS = 'default_ds'
+CACHE_TENANT_ID = 'tenant_id'
+CACHE_PRIVILEGES = 'privileges'
+CACHE_TABLES_EXIST = 'tables_exist'
+CACHE_RATE_LIMITS = 'rate_limits'
+
+# How often (in seconds) the auth DB file is checked for changes made by
+# other processes or hosts.
+AUTH_CACHE_CHECK_SEC = 1
+
+# Offset of the "file change counter" in the sqlite DB file header. It is
+# incremented by every transaction which modifies the DB.
+SQLITE_CHANGE_COUNTER_OFFSET = 24
+
+
+class AuthCache(object):
+    """
+    In-process cache of authorization data (tenant of a VM, id and default
+    datastore of a tenant, privileges of a tenant on a datastore).
+
+    Every change made through auth_api bumps the cache generation, which
+    drops all entries. Changes made by other processes or ESX hosts sharing
+    the DB are detected by checking the DB file (inode, size, mtime and
+    sqlite change counter) at most every AUTH_CACHE_CHECK_SEC seconds.
+    """
+    def __init__(self, db_path=auth_data.AUTH_DB_PATH):
+        self._db_path = db_path
+        self._lock = threadutils.get_lock()
+        self._entries = {}
+        self._generation = 0
+        self._db_signature = None
+        self._last_check = 0
+
+    def _get_db_signature(self):
+        """ Return a value which changes whenever the DB file is modified. """
+        try:
+            st = os.stat(self._db_path)
+            with open(self._db_path, 'rb') as f:
+                f.seek(SQLITE_CHANGE_COUNTER_OFFSET)
+                header = f.read(4)
+        except (OSError, IOError):
+            return None
+        change_counter = struct.unpack('>I', header)[0] if len(header) == 4 else None
+        return (st.st_ino, st.st_size, st.st_mtime, change_counter)
+
+    def _check_db(self):
+        """ Drop all entries if the DB file was modified since last check. """
+        now = time.time()
+        if now - self._last_check < AUTH_CACHE_CHECK_SEC:
+            return
+        self._last_check = now
+        signature = self._get_db_signature()
+        if signature != self._db_signature:
+            logging.debug("AuthCache: auth DB changed, dropping cached data")
+            self._db_signature = signature
+            self._generation += 1
+            self._entries.clear()
+
+    def generation(self):
+        """
+        Return current generation. Should be taken before querying the DB,
+        and passed to put() when caching the query result.
+        """
+        with self._lock:
+            self._check_db()
+            return self._generation
+
+    def get(self, kind, key):
+        """ Return (found, value) for the given kind and key. """
+        with self._lock:
+            self._check_db()
+            entry_key = (kind, key)
+            if entry_key in self._entries:
+                return True, self._entries[entry_key]
+            return False, None
+
+    def put(self, generation, kind, key, value):
+        """
+        Cache value, unless the cache was invalidated after generation was taken.
+        """
+        with self._lock:
+            if generation == self._generation:
+                self._entries[(kind, key)] = value
+
+    def invalidate(self):
+        """ Drop all cached data, called when the auth DB is modified. """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+auth_cache = AuthCache()
+
+# Max number of idle auth DB connections kept for reuse by request threads
+AUTH_MGR_POOL_SIZE = 8
+
+
+def get_db_location_signature(db_path):
+    """
+    Return a value identifying the DB file the auth DB path (link) points to.
+    It changes when the DB is created or removed, the symlink is moved
+    to another target, or the DB file is replaced.
+    """
+    try:
+        lst = os.lstat(db_path)
+    except OSError:
+        # no DB, NotConfigured mode
+        return None
+
+    link_target = None
+    if stat.S_ISLNK(lst.st_mode):
+        try:
+            link_target = os.readlink(db_path)
+        except OSError:
+            pass
+    try:
+        st = os.stat(db_path)
+        db_file = (st.st_dev, st.st_ino)
+    except OSError:
+        # broken link
+        db_file = None
+    return (link_target, db_file)
+
+
+class AuthMgrPool(object):
+    """
+    Pool of connected AuthorizationDataManager objects shared by request threads.
+    DB mode discovery and upgrade checks are done once per connection, and
+    idle connections are dropped when the DB location changes.
+    """
+    def __init__(self, db_path=auth_data.AUTH_DB_PATH, size=AUTH_MGR_POOL_SIZE):
+        self._db_path = db_path
+        self._size = size
+        self._lock = threadutils.get_lock()
+        self._idle = []
+        self._signature = None
+
+    def checkout(self):
+        """
+        Return (auth_mgr, signature) with a connected auth_mgr.
+        Raises the same exceptions as AuthorizationDataManager.connect()
+        """
+        signature = get_db_location_signature(self._db_path)
+        with self._lock:
+            if signature != self._signature:
+                if self._idle:
+                    logging.info("Auth DB location changed, dropping %d pooled connections",
+                                 len(self._idle))
+                self._idle = []
+                self._signature = signature
+            if self._idle:
+                return self._idle.pop(), signature
+
+        auth_mgr = auth_data.AuthorizationDataManager(self._db_path)
+        auth_mgr.connect()
+        return auth_mgr, signature
+
+    def release(self, auth_mgr, signature):
+        """ Return auth_mgr to the pool, unless the DB location changed. """
+        if auth_mgr.conn:
+            try:
+                # drop anything left uncommitted by the previous user
+                auth_mgr.conn.rollback()
+            except sqlite3.Error as e:
+                logging.warning("Dropping auth DB connection: %s", e)
+                return
+        with self._lock:
+            if signature == self._signature and len(self._idle) < self._size:
+                self._idle.append(auth_mgr)
+
+auth_mgr_pool = AuthMgrPool()
+
+# Local read-only copy of the shared auth DB used in MultiNode mode, see AuthDbReplica
+AUTH_DB_REPLICA_PATH = auth_data.AUTH_DB_PATH + ".replica"
+# How often (in milliseconds) the shared auth DB is checked for changes
+AUTH_DB_REPLICA_CHECK_MS = 500
+# Max number of idle connections to the replica kept for reuse
+AUTH_DB_REPLICA_POOL_SIZE = 8
+
+
+class AuthDbReplica(object):
+    """
+    Local read-only snapshot of the auth DB, used in MultiNode mode where the
+    auth DB is a symlink to a DB file on a shared datastore.
+
+    A background thread checks the shared DB file every AUTH_DB_REPLICA_CHECK_MS
+    and copies it when its inode, size or mtime change. The copy is made while
+    holding a sqlite SHARED lock on the shared DB, so it is consistent, and is
+    renamed into place atomically.
+
+    Request path reads (see get_read_conn) use the snapshot, so they don't take
+    locks on the shared storage. Writes still go to the shared DB and should be
+    followed by mark_stale(), which sends readers to the shared DB until a fresh
+    snapshot is taken. Each new snapshot invalidates auth_cache, so data read
+    from an older snapshot is not served after a refresh.
+    """
+    def __init__(self, db_path=auth_data.AUTH_DB_PATH, replica_path=AUTH_DB_REPLICA_PATH,
+                 check_ms=AUTH_DB_REPLICA_CHECK_MS, pool_size=AUTH_DB_REPLICA_POOL_SIZE):
+        self._db_path = db_path
+        self._replica_path = replica_path
+        self._check_sec = check_ms / 1000.0
+        self._pool_size = pool_size
+        self._lock = threadutils.get_lock()
+        self._wakeup = threading.Event()
+        self._started = False
+        self._ready = False
+        self._stale_count = 0
+        self._signature = None
+        self._generation = 0
+        self._idle = []
+
+    def start(self):
+        """ Start the thread keeping the snapshot up to date. """
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threadutils.start_new_thread(target=self._run, daemon=True)
+
+    def mark_stale(self):
+        """
+        Called after the auth DB is modified. Readers use the shared DB until
+        the snapshot is refreshed.
+        """
+        with self._lock:
+            self._ready = False
+            self._stale_count += 1
+        self._wakeup.set()
+
+    def generation(self):
+        """ Return generation of the current snapshot, or None if it can't be used. """
+        with self._lock:
+            if self._ready:
+                return self._generation
+            return None
+
+    def checkout(self):
+        """
+        Return (conn, generation) for the current snapshot, or (None, None)
+        if there is no up to date snapshot.
+        """
+        with self._lock:
+            if not self._ready:
+                return None, None
+            generation = self._generation
+            if self._idle:
+                return self._idle.pop(), generation
+        try:
+            conn = sqlite3.connect(self._replica_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA query_only = ON")
+        except sqlite3.Error as e:
+            logging.warning("AuthDbReplica: failed to open %s: %s", self._replica_path, e)
+            return None, None
+        return conn, generation
+
+    def release(self, conn, generation):
+        """ Return conn to the pool if it still points to the current snapshot. """
+        with self._lock:
+            if self._ready and generation == self._generation and len(self._idle) < self._pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _run(self):
+        threadutils.set_thread_name("AuthDbReplica")
+        logging.info("AuthDbReplica: keeping %s in sync with %s", self._replica_path, self._db_path)
+        while True:
+            self._check()
+            self._wakeup.wait(self._check_sec)
+            self._wakeup.clear()
+
+    def _check(self):
+        """ Refresh the snapshot. If that fails, readers use the shared DB. """
+        try:
+            self._refresh()
+        except Exception as e:
+            logging.exception("AuthDbReplica: failed to refresh: %s", e)
+            with self._lock:
+                self._ready = False
+
+    def _get_shared_db_signature(self):
+        """ Return signature of the shared DB file, or None if not in MultiNode mode. """
+        if not os.path.islink(self._db_path):
+            return None
+        try:
+            st = os.stat(self._db_path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+    def _refresh(self):
+        """ Take a new snapshot if the shared DB changed. """
+        signature = self._get_shared_db_signature()
+        with self._lock:
+            if not signature:
+                self._ready = False
+                self._signature = None
+                return
+            if self._ready and signature == self._signature:
+                return
+            stale_count = self._stale_count
+
+        tmp_path = self._replica_path + ".tmp"
+        conn = sqlite3.connect(self._db_path)
+        try:
+            # Reading inside a transaction holds a SHARED lock until rollback,
+            # so no other host can commit changes while the file is copied.
+            conn.execute("BEGIN")
+            conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            signature = self._get_shared_db_signature()
+            shutil.copyfile(self._db_path, tmp_path)
+        finally:
+            conn.rollback()
+            conn.close()
+        os.rename(tmp_path, self._replica_path)
+
+        with self._lock:
+            self._signature = signature
+            self._generation += 1
+            self._idle = []
+            # local writes made while copying may not be in the snapshot
+            self._ready = (stale_count == self._stale_count)
+        # entries cached from the previous snapshot may be out of date
+        auth_cache.invalidate()
+        logging.debug("AuthDbReplica: refreshed snapshot, generation %d", self._generation)
+
+auth_db_replica = AuthDbReplica()
+
 def get_auth_mgr():
-    """ Get a connection to auth DB. """
+    """
+    Get a connection to auth DB.
+    The connection is taken from the pool on first use by a thread, and stays
+    with the thread until release_auth_mgr() is called.
+    """
     global thread_local
     if not hasattr(thread_local, '_auth_mgr'):
         try:
-            thread_local._auth_mgr = auth_data.AuthorizationDataManager()
-            thread_local._auth_mgr.connect()
+            thread_local._auth_mgr, thread_local._auth_mgr_signature = auth_mgr_pool.checkout()
         except (auth_data.DbConnectionError, auth_data.DbAccessError, auth_data.DbUpgradeError) as err:
             return str(err), None
     return None, thread_local._auth_mgr
 
+def release_auth_mgr():
+    """ Return connections to auth DB used by the current thread to the pool. """
+    global thread_local
+    if hasattr(thread_local, '_auth_mgr'):
+        auth_mgr_pool.release(thread_local._auth_mgr, thread_local._auth_mgr_signature)
+        del thread_local._auth_mgr
+        del thread_local._auth_mgr_signature
+    release_read_conn()
+
+def get_read_conn():
+    """
+    Get a connection for request path reads.
+    Returns (err_msg, conn), where conn is connected to the local replica of the
+    auth DB if there is an up to date one (MultiNode mode), otherwise to auth DB.
+    """
+    global thread_local
+    err_msg, _auth_mgr = get_auth_mgr()
+    if err_msg:
+        return err_msg, None
+
+    replica_conn = getattr(thread_local, '_replica_conn', None)
+    if replica_conn and thread_local._replica_generation != auth_db_replica.generation():
+        release_read_conn()
+        replica_conn = None
+    if not replica_conn:
+        replica_conn, generation = auth_db_replica.checkout()
+        if replica_conn:
+            thread_local._replica_conn = replica_conn
+            thread_local._replica_generation = generation
+
+    if replica_conn:
+        return None, replica_conn
+    return None, _auth_mgr.conn
+
+def release_read_conn():
+    """ Return replica connection used by the current thread to the pool. """
+    global thread_local
+    if getattr(thread_local, '_replica_conn', None):
+        auth_db_replica.release(thread_local._replica_conn, thread_local._replica_generation)
+    thread_local._replica_conn = thread_local._replica_generation = None
+
 def get_default_tenant():
     """
         Get DEFAULT tenant by querying the auth DB or from hardcoded defaults.
@@ -71,8 +459,12 @@ def get_default_tenant():
     if _auth_mgr.allow_all_access():
         return None, auth_data_const.DEFAULT_TENANT_UUID, auth_data_const.DEFAULT_TENANT
 
+    err_msg, conn = get_read_conn()
+    if err_msg:
+        return err_msg, None, None
+
     try:
-        cur = _auth_mgr.conn.execute(
+        cur = conn.execute(
             "SELECT id FROM tenants WHERE name = ?",
             (auth_data_const.DEFAULT_TENANT, )
             )
@@ -110,8 +502,18 @@ def get_tenant(vm_uuid):
         logging.debug("returning default info")
         return None, auth_data_const.DEFAULT_TENANT_UUID, auth_data_const.DEFAULT_TENANT
 
+    generation = auth_cache.generation()
+    found, tenant = auth_cache.get(CACHE_VM_TENANT, vm_uuid)
+    if found:
+        tenant_uuid, tenant_name = tenant
+        return None, tenant_uuid, tenant_name
+
+    err_msg, conn = get_read_conn()
+    if err_msg:
+        return err_msg, None, None
+
     try:
-        cur = _auth_mgr.conn.execute(
+        cur = conn.execute(
             "SELECT tenant_id FROM vms WHERE vm_id = ?",
             (vm_uuid, )
         )
@@ -128,7 +530,7 @@ def get_tenant(vm_uuid):
     if result:
         tenant_uuid = result[0]
         try:
-            cur = _auth_mgr.conn.execute(
+            cur = conn.execute(
                 "SELECT name FROM tenants WHERE id = ?",
                 (tenant_uuid, )
                 )
@@ -141,6 +543,7 @@ def get_tenant(vm_uuid):
             tenant_name = result[0]
             logging.debug("Found tenant_uuid %s, tenant_name %s", tenant_uuid, tenant_name)
 
+        auth_cache.put(generation, CACHE_VM_TENANT, vm_uuid, (tenant_uuid, tenant_name))
         return None, tenant_uuid, tenant_name
     else:
         error_msg, tenant_uuid, tenant_name = get_default_tenant()
@@ -154,6 +557,7 @@ def get_tenant(vm_uuid):
                  err_msg = error_code_to_message[ErrorCode.VM_NOT_BELONG_TO_TENANT].format(vm_uuid)
              logging.debug(err_msg)
              return err_msg, None, None
+        auth_cache.put(generation, CACHE_VM_TENANT, vm_uuid, (tenant_uuid, tenant_name))
         return None, tenant_uuid, tenant_name
 
 
@@ -175,9 +579,18 @@ def get_privileges(tenant_uuid, datastore_url):
         if datastore_url == auth_data_const.VM_DS_URL:
             return None, _auth_mgr.get_vm_ds_privileges_dict()
 
+    generation = auth_cache.generation()
+    found, privileges = auth_cache.get(CACHE_PRIVILEGES, (tenant_uuid, datastore_url))
+    if found:
+        return None, privileges
+
+    err_msg, conn = get_read_conn()
+    if err_msg:
+        return err_msg, None
+
     privileges = []
     try:
-        cur = _auth_mgr.conn.execute(
+        cur = conn.execute(
             "SELECT * FROM privileges WHERE tenant_id = ? and datastore_url = ?",
             (tenant_uuid, datastore_url)
             )
@@ -187,6 +600,7 @@ def get_privileges(tenant_uuid, datastore_url):
                       e, tenant_uuid, datastore_url)
         return str(e), None
 
+    auth_cache.put(generation, CACHE_PRIVILEGES, (tenant_uuid, datastore_url), privileges)
     return None, privileges
 
 def has_privilege(privileges, type=None):
@@ -256,9 +670,10 @@ def get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url):
         # datastore_url need to be set to the url of a real datastore
         datastore_url = vm_datastore_url
 
+    # volume_usage is kept up to date by triggers on volumes table
     try:
         cur = _auth_mgr.conn.execute(
-            "SELECT SUM(volume_size) FROM volumes WHERE tenant_id = ? and datastore_url = ?",
+            "SELECT total_size FROM volume_usage WHERE tenant_id = ? and datastore_url = ?",
             (tenant_uuid, datastore_url)
             )
     except sqlite3.Error as e:
@@ -274,20 +689,124 @@ def get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url):
 
     return None, total_storage_used
 
+# Lock names used by QuotaLedger are prefixed with this
+QUOTA_LOCK_PREFIX = "quota."
+
+
+class QuotaLedger(object):
+    """
+    Storage reserved for volumes being created, per (tenant, datastore).
+
+    A volume is only added to volumes table after it is created, so the
+    quota check for a create has to count volumes being created by other
+    requests too. The check reserves the volume size here, atomically with
+    reading the storage used from auth DB. The reservation is committed
+    (dropped from the ledger) once the volume is in volumes table, or
+    released if the create fails. Only creates for the same
+    (tenant, datastore) are serialized, and only for the quota check itself.
+
+    Each thread (request) holds at most one reservation.
+    """
+    def __init__(self):
+        self._lock = threadutils.get_lock()
+        self._key_locks = threadutils.LockManager()
+        self._reserved = {}
+
+    def _key_lock(self, key):
+        return self._key_locks.get_lock(QUOTA_LOCK_PREFIX + ".".join(key))
+
+    def reserve(self, tenant_uuid, datastore_url, vol_size_in_MB, usage_quota):
+        """
+        Reserve vol_size_in_MB for (tenant_uuid, datastore_url) if it fits in usage_quota.
+        Return True if the reservation is made.
+        """
+        # a new reservation replaces the one this thread holds, if any
+        self.release()
+
+        key = (tenant_uuid, datastore_url)
+        with self._key_lock(key):
+            error_msg, total_storage_used = get_total_storage_used(tenant_uuid, datastore_url, datastore_url)
+            if error_msg:
+                # cannot get the total_storage_used, to be safe, return False
+                return False
+            with self._lock:
+                reserved = self._reserved.get(key, 0)
+                logging.debug("total_storage_used=%d, reserved=%d, usage_quota=%d",
+                              total_storage_used, reserved, usage_quota)
+                if vol_size_in_MB + total_storage_used + reserved > usage_quota:
+                    return False
+                self._reserved[key] = reserved + vol_size_in_MB
+        thread_local._quota_reservation = (key, vol_size_in_MB)
+        return True
+
+    def _drop(self):
+        """ Drop reservation of the current thread from the ledger """
+        reservation = getattr(thread_local, '_quota_reservation', None)
+        if not reservation:
+            return None
+        thread_local._quota_reservation = None
+        key, vol_size_in_MB = reservation
+        # Taking the key lock makes sure a concurrent reserve() does not read the
+        # storage used before the volume was added, and the reservations after
+        # it was dropped.
+        with self._key_lock(key):
+            with self._lock:
+                reserved = self._reserved.get(key, 0) - vol_size_in_MB
+                if reserved > 0:
+                    self._reserved[key] = reserved
+                else:
+                    self._reserved.pop(key, None)
+        return reservation
+
+    def commit(self):
+        """ Called once the volume reserved for is added to volumes table """
+        reservation = self._drop()
+        if reservation:
+            logging.debug("Committed quota reservation %s", reservation)
+
+    def release(self):
+        """ Called when the volume reserved for is not created """
+        reservation = self._drop()
+        if reservation:
+            logging.debug("Released quota reservation %s", reservation)
+
+quota_ledger = QuotaLedger()
+
+def commit_quota_reservation():
+    """ Commit quota reserved by the current request, see QuotaLedger """
+    quota_ledger.commit()
+
+def release_quota_reservation():
+    """ Release quota reserved by the current request, see QuotaLedger """
+    quota_ledger.release()
+
+def releases_quota_reservation(func):
+    """
+    Decorator for request handlers. Releases quota reserved by the request
+    and not committed, whatever way the handler exits.
+    """
+    def release(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            quota_ledger.release()
+    return release
+
 def check_usage_quota(vol_size_in_MB, tenant_uuid, datastore_url, privileges, vm_datastore_url):
-    """ Check if the volume can be created without violating the quota. """
+    """
+        Check if the volume can be created without violating the quota.
+        On success, the volume size is reserved in quota_ledger for the current request.
+    """
     if privileges:
-        error_msg, total_storage_used = get_total_storage_used(tenant_uuid, datastore_url, vm_datastore_url)
-        if error_msg:
-            # cannot get the total_storage_used, to be safe, return False
-            return False
         usage_quota = privileges[auth_data_const.COL_USAGE_QUOTA]
-        logging.debug("total_storage_used=%d, usage_quota=%d", total_storage_used, usage_quota)
         # if usage_quota which read from DB is 0, which means
         # no usage_quota, function should return True
         if usage_quota == 0:
             return True
-        return vol_size_in_MB + total_storage_used <= usage_quota
+        if (datastore_url == auth_data_const.VM_DS_URL):
+            # datastore_url need to be set to the url of a real datastore
+            datastore_url = vm_datastore_url
+        return quota_ledger.reserve(tenant_uuid, datastore_url, vol_size_in_MB, usage_quota)
     else:
         # no privileges
         return True
@@ -340,8 +859,17 @@ def tables_exist():
     if err_msg:
         return err_msg, False
 
+    generation = auth_cache.generation()
+    found, _ = auth_cache.get(CACHE_TABLES_EXIST, _auth_mgr.db_path)
+    if found:
+        return None, True
+
+    err_msg, conn = get_read_conn()
+    if err_msg:
+        return err_msg, False
+
     try:
-        cur = _auth_mgr.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'tenants';")
+        cur = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'tenants';")
         result = cur.fetchall()
     except sqlite3.Error as e:
         logging.error("Error %s when checking whether table tenants exists or not", e)
@@ -352,7 +880,7 @@ def tables_exist():
         return error_msg, False
 
     try:
-        cur = _auth_mgr.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'vms';")
+        cur = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'vms';")
         result = cur.fetchall()
     except sqlite3.Error as e:
         logging.error("Error %s when checking whether table vms exists or not", e)
@@ -363,7 +891,7 @@ def tables_exist():
         return error_msg, False
 
     try:
-        cur = _auth_mgr.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'privileges';")
+        cur = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'privileges';")
         result = cur.fetchall()
     except sqlite3.Error as e:
         logging.error("Error %s when checking whether table privileges exists or not", e)
@@ -374,7 +902,7 @@ def tables_exist():
         return error_msg, False
 
     try:
-        cur = _auth_mgr.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'volumes';")
+        cur = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' and name = 'volumes';")
         result = cur.fetchall()
     except sqlite3.Error as e:
         logging.error("Error %s when checking whether table volumes exists or not", e)
@@ -384,6 +912,7 @@ def tables_exist():
         error_msg = err_msg_no_table('volumes')
         return error_msg, False
 
+    auth_cache.put(generation, CACHE_TABLES_EXIST, _auth_mgr.db_path, True)
     return None, True
 
 def authorize(vm_uuid, datastore_url, cmd, opts, privilege_ds_url, vm_datastore_url=None):
@@ -418,7 +947,8 @@ def authorize(vm_uuid, datastore_url, cmd, opts, privilege_ds_url, vm_datastore_
 
     # If table "tenants", "vms", "privileges" or "volumes" does not exist
     # don't need auth check
-    if not tables_exist():
+    _, exist = tables_exist()
+    if not exist:
         error_msg = "Required tables do not exist in auth db"
         logging.error(error_msg)
         return error_msg, None, None
@@ -449,6 +979,266 @@ def authorize(vm_uuid, datastore_url, cmd, opts, privilege_ds_url, vm_datastore_
 
         return result, tenant_uuid, tenant_name
 
+def get_rate_limits(tenant_uuid):
+    """ Return request rate limits for given tenant by querying the auth DB.
+        Return value:
+        -- error_msg: return None on success or error info on failure
+        -- rate_limits: return a row of rate_limits table, or None if the tenant has no limits
+    """
+    err_msg, _auth_mgr = get_auth_mgr()
+    if err_msg:
+        return err_msg, None
+
+    if _auth_mgr.allow_all_access():
+        return None, None
+
+    generation = auth_cache.generation()
+    found, rate_limits = auth_cache.get(CACHE_RATE_LIMITS, tenant_uuid)
+    if found:
+        return None, rate_limits
+
+    err_msg, conn = get_read_conn()
+    if err_msg:
+        return err_msg, None
+
+    try:
+        cur = conn.execute("SELECT * FROM rate_limits WHERE tenant_id = ?", (tenant_uuid,))
+        rate_limits = cur.fetchone()
+    except sqlite3.Error as e:
+        logging.error("Error %s when querying rate_limits table for tenant_id %s", e, tenant_uuid)
+        return str(e), None
+
+    auth_cache.put(generation, CACHE_RATE_LIMITS, tenant_uuid, rate_limits)
+    return None, rate_limits
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, and up to burst requests at once.
+    """
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time() if now is None else now
+
+    def refill(self, now):
+        """ Add the tokens earned since the last refill. """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_full(self):
+        return self.tokens >= self.burst
+
+    def can_take(self, cost):
+        """
+        Return True if a request costing cost tokens may go ahead. A request
+        costing more than burst goes ahead once the bucket is full.
+        """
+        return self.tokens >= min(cost, self.burst)
+
+    def take(self, cost):
+        """
+        Take cost tokens. The balance may go negative, the tokens over burst
+        are paid back by refills before the next request goes ahead.
+        """
+        self.tokens -= cost
+
+
+# Max number of token buckets kept by RequestRateLimiter before full
+# (i.e. idle) ones are dropped
+MAX_RATE_LIMIT_BUCKETS = 4096
+
+
+class RequestRateLimiter(object):
+    """
+    Token buckets per VM and per vmgroup, configured in rate_limits table.
+    A request is let through only if both buckets of the VM have a token.
+    A batch is charged a token per operation, see TokenBucket.take().
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _get_bucket(self, key, rate, burst, now):
+        """ Return bucket for key, None if rate is 0 (no limit). """
+        if not rate:
+            self._buckets.pop(key, None)
+            return None
+        # at least one request must always fit
+        burst = max(burst, 1)
+        bucket = self._buckets.get(key)
+        if not bucket or bucket.rate != rate or bucket.burst != burst:
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def _prune(self, now):
+        for key in list(self._buckets):
+            bucket = self._buckets[key]
+            bucket.refill(now)
+            if bucket.is_full():
+                del self._buckets[key]
+
+    def check(self, vm_uuid, cost=1):
+        """
+        Take cost tokens for a request from VM vm_uuid.
+        Returns None if the request can go ahead, or error message if it is throttled.
+        """
+        err_msg, tenant_uuid, tenant_name = get_tenant(vm_uuid)
+        if err_msg or not tenant_uuid:
+            return None
+        err_msg, rate_limits = get_rate_limits(tenant_uuid)
+        if err_msg or not rate_limits:
+            return None
+        return self.take(vm_uuid, tenant_uuid, tenant_name, rate_limits, cost)
+
+    def take(self, vm_uuid, tenant_uuid, tenant_name, rate_limits, cost=1, now=None):
+        """
+        Take cost tokens from the buckets of VM vm_uuid and its vmgroup, with
+        limits given by rate_limits (a rate_limits table row).
+        Returns None if the request can go ahead, or error message if it is throttled.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if len(self._buckets) > MAX_RATE_LIMIT_BUCKETS:
+                self._prune(now)
+            buckets = [b for b in (self._get_bucket(("vm", vm_uuid),
+                                                    rate_limits[auth_data_const.COL_VM_RATE],
+                                                    rate_limits[auth_data_const.COL_VM_BURST],
+                                                    now),
+                                   self._get_bucket(("group", tenant_uuid),
+                                                    rate_limits[auth_data_const.COL_GROUP_RATE],
+                                                    rate_limits[auth_data_const.COL_GROUP_BURST],
+                                                    now))
+                       if b]
+            for bucket in buckets:
+                bucket.refill(now)
+            if not all(bucket.can_take(cost) for bucket in buckets):
+                logging.warning("Request from VM %s (vmgroup %s) throttled", vm_uuid, tenant_name)
+                return error_code_to_message[ErrorCode.REQUEST_THROTTLED].format(vm_uuid, tenant_name)
+            for bucket in buckets:
+                bucket.take(cost)
+        return None
+
+request_rate_limiter = RequestRateLimiter()
+
+# Max time (in milliseconds) the volumes table writer waits to collect more changes
+# into one transaction
+VOLUMES_WRITER_BATCH_MS = 5
+# Max number of volumes table changes committed in one transaction
+VOLUMES_WRITER_BATCH_SIZE = 64
+
+
+class PendingWrite(object):
+    """ A volumes table change waiting to be committed by VolumesTableWriter """
+    __slots__ = ('sql', 'params', 'error', 'done')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.error = None
+        self.done = threading.Event()
+
+
+class VolumesTableWriter(object):
+    """
+    Single writer thread for volumes table changes done on volume create/remove.
+
+    Each commit is a journal sync, which is expensive when the auth DB is on
+    a shared datastore. The writer collects changes arriving within
+    VOLUMES_WRITER_BATCH_MS and commits them in one transaction. Callers are
+    blocked until their change is committed, so a change is visible to
+    quota checks as soon as the call returns, same as with direct commits.
+    If the batch fails, its changes are retried one per transaction so one
+    bad change (e.g. a duplicate volume) does not fail the others.
+    """
+    def __init__(self, batch_ms=VOLUMES_WRITER_BATCH_MS, batch_size=VOLUMES_WRITER_BATCH_SIZE):
+        self._batch_sec = batch_ms / 1000.0
+        self._batch_size = batch_size
+        self._queue = queue.Queue()
+        self._lock = threadutils.get_lock()
+        self._started = False
+
+    def execute(self, sql, params):
+        """
+        Run sql statement with params in the next batch and wait until committed.
+        Return None on success or error string.
+        """
+        with self._lock:
+            if not self._started:
+                threadutils.start_new_thread(target=self._run, daemon=True)
+                self._started = True
+        write = PendingWrite(sql, params)
+        self._queue.put(write)
+        write.done.wait()
+        return write.error
+
+    def _run(self):
+        threadutils.set_thread_name("VolumesTableWriter")
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self._batch_sec
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logging.exception("VolumesTableWriter: unexpected error: %s", e)
+                for write in batch:
+                    write.error = write.error or str(e)
+            finally:
+                for write in batch:
+                    write.done.set()
+
+    def _commit(self, batch):
+        """ Commit changes in batch, setting error for the ones which failed """
+        try:
+            auth_mgr, signature = auth_mgr_pool.checkout()
+        except (auth_data.DbConnectionError, auth_data.DbAccessError, auth_data.DbUpgradeError) as e:
+            for write in batch:
+                write.error = str(e)
+            return
+
+        try:
+            if not auth_mgr.conn:
+                for write in batch:
+                    write.error = auth_mgr.err_config_init_needed()
+                return
+            try:
+                for write in batch:
+                    auth_mgr.conn.execute(write.sql, write.params)
+                auth_mgr.conn.commit()
+                logging.debug("VolumesTableWriter: committed %d changes", len(batch))
+                return
+            except sqlite3.Error as e:
+                auth_mgr.conn.rollback()
+                if len(batch) == 1:
+                    batch[0].error = str(e)
+                    return
+                logging.warning("VolumesTableWriter: batch of %d changes failed (%s), "
+                                "retrying one by one", len(batch), e)
+
+            for write in batch:
+                try:
+                    auth_mgr.conn.execute(write.sql, write.params)
+                    auth_mgr.conn.commit()
+                except sqlite3.Error as e:
+                    auth_mgr.conn.rollback()
+                    write.error = str(e)
+        finally:
+            auth_mgr_pool.release(auth_mgr, signature)
+
+volumes_table_writer = VolumesTableWriter()
+
 def add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_in_MB):
     """
         Insert volume to volumes table.
@@ -469,16 +1259,14 @@ def add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_i
             logging.info("No access control, skipping volumes tracing in auth DB")
             return None
 
-    try:
-        _auth_mgr.conn.execute(
-            "INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
-            (tenant_uuid, datastore_url, vol_name, vol_size_in_MB)
-            )
-        _auth_mgr.conn.commit()
-    except sqlite3.Error as e:
+    err_msg = volumes_table_writer.execute(
+        "INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+        (tenant_uuid, datastore_url, vol_name, vol_size_in_MB)
+        )
+    if err_msg:
         logging.error("Error %s when insert into volumes table for tenant_id %s and datastore_url %s",
-                      e, tenant_uuid, datastore_url)
-        return str(e)
+                      err_msg, tenant_uuid, datastore_url)
+        return err_msg
 
     return None
 
@@ -498,16 +1286,14 @@ def remove_volume_from_volumes_table(tenant_uuid, datastore_url, vol_name):
         logging.debug("Skipping Rm volume from DB %s (allow_all_access)", tenant_uuid)
         return None
 
-    try:
-        _auth_mgr.conn.execute(
-                    "DELETE FROM volumes WHERE tenant_id = ? AND datastore_url = ? AND volume_name = ?",
-                    [tenant_uuid, datastore_url, vol_name]
-            )
-        _auth_mgr.conn.commit()
-    except sqlite3.Error as e:
+    err_msg = volumes_table_writer.execute(
+        "DELETE FROM volumes WHERE tenant_id = ? AND datastore_url = ? AND volume_name = ?",
+        (tenant_uuid, datastore_url, vol_name)
+        )
+    if err_msg:
         logging.error("Error %s when remove from volumes table for tenant_id %s and datastore_url %s",
-                      e, tenant_uuid, datastore_url)
-        return str(e)
+                      err_msg, tenant_uuid, datastore_url)
+        return err_msg
 
     return None
 
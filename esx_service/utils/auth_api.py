@@ -94,6 +94,20 @@ def only_when_configured(ret_obj=False):
     return real_decorator
 
 
+def invalidates_auth_cache(func):
+    """
+    Decorator for functions which modify the auth DB.
+    Drops the cached authorization data, the auth DB replica
+    and the resolved tenant folders once the function is done.
+    """
+    def invalidate(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            auth_data.invalidate_cached_auth_data()
+    return invalidate
+
+
 def get_tenant_from_db(name):
     """
         Get a tenant object with given name
@@ -113,6 +127,38 @@ def get_tenant_from_db(name):
 
     return None, tenant
 
+def get_tenant_id_from_db(name):
+    """
+        Get id of the tenant with given name, without loading the whole tenant
+        Return value:
+        -- error_info: return None on success or error info on failure
+        -- tenant_id: return tenant id on success, None on failure or if tenant does not exist
+    """
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    if auth_mgr.allow_all_access():
+        # no cache in NotConfigured mode, auth_mgr returns the hardcoded _DEFAULT uuid
+        error_msg, tenant_id = auth_mgr.get_tenant_id(name)
+    else:
+        generation = auth.auth_cache.generation()
+        found, tenant_id = auth.auth_cache.get(auth.CACHE_TENANT_ID, name)
+        if found:
+            return None, tenant_id
+        err_msg, conn = auth.get_read_conn()
+        if err_msg:
+            return generate_error_info(ErrorCode.INTERNAL_ERROR, err_msg), None
+        error_msg, tenant_id = auth_mgr.get_tenant_id(name, conn)
+        if not error_msg and tenant_id:
+            auth.auth_cache.put(generation, auth.CACHE_TENANT_ID, name, tenant_id)
+
+    if error_msg:
+        error_info = generate_error_info(error_msg)
+        return error_info, None
+
+    return None, tenant_id
+
 def get_tenant_name(tenant_uuid):
     """
         Get tenant name with given tenant_uuid
@@ -335,18 +381,31 @@ def get_default_datastore_url(name):
         else:
             return generate_error_info(ErrorCode.INIT_NEEDED), None
 
-    error_info, tenant = get_tenant_from_db(name)
+    generation = auth.auth_cache.generation()
+    found, default_datastore_url = auth.auth_cache.get(auth.CACHE_DEFAULT_DS, name)
+    if found:
+        return None, default_datastore_url
+
+    error_info, tenant_id = get_tenant_id_from_db(name)
     if error_info:
         return error_info, None
 
-    if not tenant:
+    if not tenant_id:
         error_info = generate_error_info(ErrorCode.TENANT_NOT_EXIST, name)
         return error_info, None
 
+    err_msg, conn = auth.get_read_conn()
+    if err_msg:
+        return generate_error_info(ErrorCode.INTERNAL_ERROR, err_msg), None
+
     # if default_datastore is not set for this tenant, default_datastore will be None
-    error_msg, default_datastore_url = tenant.get_default_datastore(auth_mgr.conn)
+    tenant = auth_data.DockerVolumeTenant(name=name, description=None, vms=None,
+                                          privileges=None, id=tenant_id)
+    error_msg, default_datastore_url = tenant.get_default_datastore(conn)
     if error_msg:
         error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+    else:
+        auth.auth_cache.put(generation, auth.CACHE_DEFAULT_DS, name, default_datastore_url)
     logging.debug("returning url %s", default_datastore_url)
     return error_info, default_datastore_url
 
@@ -442,6 +501,7 @@ def set_default_ds(tenant, default_datastore, check_existing):
     return error_info
 
 @only_when_configured(ret_obj=True)
+@invalidates_auth_cache
 def _tenant_create(name, default_datastore, description="", vm_list=None, privileges=None):
     """ API to create a tenant . Returns (ErrInfo, Tenant) """
     logging.debug("_tenant_create: name=%s description=%s vm_list=%s privileges=%s default_ds=%s",
@@ -505,6 +565,7 @@ def _tenant_create(name, default_datastore, description="", vm_list=None, privil
 
 
 @only_when_configured()
+@invalidates_auth_cache
 def _tenant_update(name, new_name=None, description=None, default_datastore=None):
     """ API to update a tenant """
     logging.debug("_tenant_update: name=%s, new_name=%s, descrption=%s, default_datastore=%s",
@@ -558,8 +619,12 @@ def _tenant_update(name, new_name=None, description=None, default_datastore=None
     return None
 
 @only_when_configured()
-def _tenant_rm(name, remove_volumes=False, force=False):
-    """ API to remove a tenant """
+@invalidates_auth_cache
+def _tenant_rm(name, remove_volumes=False, force=False, progress=None):
+    """
+    API to remove a tenant. progress(removed, total) is called from time to
+    time while volumes are removed.
+    """
     logging.debug("_tenant_rm: name=%s remove_volumes=%s", name, remove_volumes)
     error_info, tenant = get_tenant_from_db(name)
     if error_info:
@@ -584,11 +649,33 @@ def _tenant_rm(name, remove_volumes=False, force=False):
                 error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
                 return error_info
 
-    error_msg = auth_mgr.remove_tenant(tenant.id, remove_volumes)
+    error_msg = auth_mgr.remove_tenant(tenant.id, remove_volumes, progress)
     if error_msg:
         error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
     return error_info
 
+@only_when_configured(ret_obj=True)
+def _tenant_rm_progress(name):
+    """
+    API to get the progress of an unfinished "tenant rm" with volume removal.
+    Returns (error_info, progress) where progress is a dict with "total" and
+    "removed" volume counts, or None if there is no such removal.
+    """
+    logging.debug("_tenant_rm_progress: name=%s", name)
+    error_info, tenant = get_tenant_from_db(name)
+    if error_info:
+        return error_info, None
+
+    if not tenant:
+        error_info = generate_error_info(ErrorCode.TENANT_NOT_EXIST, name)
+        return error_info, None
+
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    return None, auth_mgr.get_remove_progress(tenant.id)
+
 def _tenant_ls(name=None):
     """ API to list all tenants """
     logging.debug("_tenant_ls: name=%s", name)
@@ -635,17 +722,21 @@ def vm_in_any_tenant(vms):
     """
         Check if any vm in @param "vms" is a part of another tenant
     """
-    error_info, tenant_list = get_tenant_list_from_db()
+    error_info, auth_mgr = get_auth_mgr_object()
     if error_info:
         return error_info
 
-    for tenant in tenant_list:
-        for vm_id, vm_name in vms:
-            if vm_id in dict(tenant.vms):
-                error_info = error_code.generate_error_info(ErrorCode.VM_IN_ANOTHER_TENANT,
-                                                            vm_name, tenant.name)
-                logging.error(error_info.msg)
-                return error_info
+    error_msg, vm_tenants = auth_mgr.get_tenants_for_vms([vm_id for vm_id, _ in vms])
+    if error_msg:
+        return generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+
+    vm_tenants = dict(vm_tenants)
+    for vm_id, vm_name in vms:
+        if vm_id in vm_tenants:
+            error_info = error_code.generate_error_info(ErrorCode.VM_IN_ANOTHER_TENANT,
+                                                        vm_name, vm_tenants[vm_id])
+            logging.error(error_info.msg)
+            return error_info
 
     return None
 
@@ -667,6 +758,7 @@ def named_tenant(func):
 
 @only_when_configured()
 @named_tenant
+@invalidates_auth_cache
 def _tenant_vm_add(name, vm_list):
     """ API to add vms for a tenant """
     logging.debug("_tenant_vm_add: name=%s vm_list=%s", name, vm_list)
@@ -721,6 +813,7 @@ def _tenant_vm_add(name, vm_list):
 
 @only_when_configured()
 @named_tenant
+@invalidates_auth_cache
 def _tenant_vm_rm(name, vm_list):
     """ API to remove vms for a tenant """
     logging.debug("_tenant_vm_rm: name=%s vm_list=%s", name, vm_list)
@@ -787,6 +880,7 @@ def _tenant_vm_ls(name):
 
 @only_when_configured()
 @named_tenant
+@invalidates_auth_cache
 def _tenant_vm_replace(name, vm_list):
     """ API to replace vms for a tenant """
     logging.debug("_tenant_vm_replace: name=%s vm_list=%s", name, vm_list)
@@ -886,6 +980,7 @@ def check_privilege_parameters(privilege):
     return None
 
 @only_when_configured()
+@invalidates_auth_cache
 def _tenant_access_add(name, datastore, allow_create=None,
                        volume_maxsize_in_MB=None, volume_totalsize_in_MB=None):
     """ API to add datastore access for a tenant """
@@ -954,6 +1049,7 @@ def _tenant_access_add(name, datastore, allow_create=None,
 
 
 @only_when_configured()
+@invalidates_auth_cache
 def _tenant_access_set(name, datastore, allow_create=None, volume_maxsize_in_MB=None, volume_totalsize_in_MB=None):
     """ API to modify datastore access for a tenant """
     logging.debug("_tenant_access_set: name=%s datastore=%s, allow_create=%s "
@@ -1025,6 +1121,7 @@ def _tenant_access_set(name, datastore, allow_create=None, volume_maxsize_in_MB=
     return error_info
 
 @only_when_configured()
+@invalidates_auth_cache
 def _tenant_access_rm(name, datastore):
     """ API to remove datastore access for a tenant """
     logging.debug("_tenant_access_rm: name=%s datastore=%s", name, datastore)
@@ -1089,3 +1186,72 @@ def _tenant_access_ls(name):
         return error_info, None
 
     return None, tenant.privileges
+
+@only_when_configured()
+@invalidates_auth_cache
+def _tenant_rate_limit_set(name, vm_rate=0, vm_burst=0, group_rate=0, group_burst=0):
+    """
+    API to set request rate limits for a tenant. Rates are in requests per second,
+    bursts in requests; 0 means no limit. Returns ErrInfo or None.
+    """
+    logging.debug("_tenant_rate_limit_set: name=%s vm_rate=%s vm_burst=%s group_rate=%s group_burst=%s",
+                  name, vm_rate, vm_burst, group_rate, group_burst)
+    limits = [(auth_data_const.COL_VM_RATE, vm_rate, float),
+              (auth_data_const.COL_VM_BURST, vm_burst, int),
+              (auth_data_const.COL_GROUP_RATE, group_rate, float),
+              (auth_data_const.COL_GROUP_BURST, group_burst, int)]
+    values = []
+    for limit_name, value, convert_func in limits:
+        try:
+            values.append(convert_func(value))
+        except (TypeError, ValueError):
+            values.append(-1)
+        if values[-1] < 0:
+            error_info = generate_error_info(ErrorCode.RATE_LIMIT_INVALID, limit_name, value)
+            return error_info
+
+    error_info, tenant = get_tenant_from_db(name)
+    if error_info:
+        return error_info
+
+    if not tenant:
+        error_info = generate_error_info(ErrorCode.TENANT_NOT_EXIST, name)
+        return error_info
+
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info
+
+    error_msg = tenant.set_rate_limits(auth_mgr.conn, *values)
+    if error_msg:
+        error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+        return error_info
+
+    return None
+
+@only_when_configured(ret_obj=True)
+def _tenant_rate_limit_ls(name):
+    """
+    API to get request rate limits of a tenant.
+    Returns (ErrInfo, rate_limits), rate_limits is a row of rate_limits table,
+    or None if no limits were set.
+    """
+    logging.debug("_tenant_rate_limit_ls: name=%s", name)
+    error_info, tenant = get_tenant_from_db(name)
+    if error_info:
+        return error_info, None
+
+    if not tenant:
+        error_info = generate_error_info(ErrorCode.TENANT_NOT_EXIST, name)
+        return error_info, None
+
+    error_info, auth_mgr = get_auth_mgr_object()
+    if error_info:
+        return error_info, None
+
+    error_msg, rate_limits = tenant.get_rate_limits(auth_mgr.conn)
+    if error_msg:
+        error_info = generate_error_info(ErrorCode.INTERNAL_ERROR, error_msg)
+        return error_info, None
+
+    return None, rate_limits
@@ -22,6 +22,9 @@ This way the code operates 'tenants' but user/admin operates 'vmgroups'
 import sqlite3
 import uuid
 import os
+import json
+import threading
+import collections
 import vmdk_utils
 import vmdk_ops
 import logging
@@ -37,12 +40,92 @@ CONFIG_DB_NAME = "vmdkops_config.db"         # name of the configuration DB file
 DB_STATE_CHECK_SEC = 300 # interval to check for DB state, in seconds
 DB_REF = "Config DB "  # we will use it in logging
 
+# Volumes of a removed vmgroup are removed VMGROUP_RM_PARALLELISM at a time,
+# interleaving datastores. Progress is saved every VMGROUP_RM_CHECKPOINT_EVERY
+# volumes in a checkpoint file next to the config DB, so that an interrupted
+# removal resumes with the volumes which are left.
+VMGROUP_RM_PARALLELISM = 8
+VMGROUP_RM_CHECKPOINT_EVERY = 20
+VMGROUP_RM_CHECKPOINT = "vmgroup_rm_{0}.json"
+
 # DB schema and VMODL version
-# Bump the DB_MINOR_VER to 1.2
+# Bump the DB_MINOR_VER to 1.4
 # in DB version 1.1, _DEFAULT_TENANT will be created using a constant UUID
 # in DB version 1.2, VM name is persisted along with VM uuid in the vms table
+# in DB version 1.3, vms table is indexed by tenant_id, and storage used per
+# (tenant, datastore) is kept in volume_usage table
+# in DB version 1.4, request rate limits per vmgroup are kept in rate_limits table
 DB_MAJOR_VER = 1
-DB_MINOR_VER = 2
+DB_MINOR_VER = 4
+
+# Schema objects added in DB version 1.3.
+# volume_usage is maintained by triggers on the volumes table, so quota checks
+# read a single row instead of summing all volumes of a tenant.
+SCHEMA_1_3_STATEMENTS = [
+    """
+    CREATE INDEX IF NOT EXISTS vms_tenant_id ON vms(tenant_id);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS volume_usage(
+        -- id in tenants table
+        tenant_id TEXT NOT NULL,
+        -- datastore url
+        datastore_url TEXT NOT NULL,
+        -- sum of volume_size for the (tenant_id, datastore_url) in volumes table, in MB
+        total_size INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, datastore_url)
+        );
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS volume_usage_insert AFTER INSERT ON volumes
+    BEGIN
+        INSERT OR IGNORE INTO volume_usage(tenant_id, datastore_url, total_size)
+            VALUES (NEW.tenant_id, NEW.datastore_url, 0);
+        UPDATE volume_usage SET total_size = total_size + IFNULL(NEW.volume_size, 0)
+            WHERE tenant_id = NEW.tenant_id AND datastore_url = NEW.datastore_url;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS volume_usage_delete AFTER DELETE ON volumes
+    BEGIN
+        UPDATE volume_usage SET total_size = total_size - IFNULL(OLD.volume_size, 0)
+            WHERE tenant_id = OLD.tenant_id AND datastore_url = OLD.datastore_url;
+        DELETE FROM volume_usage
+            WHERE tenant_id = OLD.tenant_id AND datastore_url = OLD.datastore_url AND total_size <= 0;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS volume_usage_update AFTER UPDATE ON volumes
+    BEGIN
+        UPDATE volume_usage SET total_size = total_size - IFNULL(OLD.volume_size, 0)
+            WHERE tenant_id = OLD.tenant_id AND datastore_url = OLD.datastore_url;
+        INSERT OR IGNORE INTO volume_usage(tenant_id, datastore_url, total_size)
+            VALUES (NEW.tenant_id, NEW.datastore_url, 0);
+        UPDATE volume_usage SET total_size = total_size + IFNULL(NEW.volume_size, 0)
+            WHERE tenant_id = NEW.tenant_id AND datastore_url = NEW.datastore_url;
+    END;
+    """,
+]
+
+# Schema objects added in DB version 1.4.
+# A missing row, or a rate of 0, means no limit.
+SCHEMA_1_4_STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS rate_limits(
+        -- id in tenants table
+        tenant_id TEXT PRIMARY KEY NOT NULL,
+        -- requests per second allowed from each VM of the vmgroup
+        vm_rate REAL NOT NULL DEFAULT 0,
+        -- max number of requests a VM of the vmgroup may send in a burst
+        vm_burst INTEGER NOT NULL DEFAULT 0,
+        -- requests per second allowed from all VMs of the vmgroup together
+        group_rate REAL NOT NULL DEFAULT 0,
+        -- max number of requests all VMs of the vmgroup may send in a burst
+        group_burst INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(tenant_id) REFERENCES tenants(id)
+        );
+    """,
+]
 VMODL_MAJOR_VER = 1
 VMODL_MINOR_VER = 0
 
@@ -121,10 +204,12 @@ class DbUpgradeError(Exception):
     def __init__(self, db_path, msg):
         super(DbUpgradeError, self).__init__("DB upgrade error at {}: {}".format(db_path, msg))
 
-class DatastoreAccessPrivilege:
+class DatastoreAccessPrivilege(object):
     """
     This class abstracts the access privilege to a datastore.
     """
+    __slots__ = ('tenant_id', 'datastore_url', 'allow_create', 'max_volume_size', 'usage_quota')
+
     def __init__(self, tenant_id, datastore_url, allow_create, max_volume_size, usage_quota):
         """ Construct a DatastoreAccessPrivilege object. """
         self.tenant_id = tenant_id
@@ -161,7 +246,57 @@ def create_vm_list(vms):
     """
     return [(v[0], v[2]) for v in vms]
 
-class DockerVolumeTenant:
+def create_tenant_list(tenants, vms, privileges):
+    """
+        Return a list of DockerVolumeTenant objects with given input
+        @Param tenants: rows from tenants table
+        @Param vms: rows from vms table for these tenants (can include other tenants)
+        @Param privileges: rows from privileges table for these tenants (can include other tenants)
+    """
+    vms_by_tenant = {}
+    for v in vms:
+        vms_by_tenant.setdefault(v[auth_data_const.COL_TENANT_ID], []).append(v)
+
+    privileges_by_tenant = {}
+    for p in privileges:
+        privileges_by_tenant.setdefault(p[auth_data_const.COL_TENANT_ID], []).append(p)
+
+    tenant_list = []
+    for r in tenants:
+        id = r[auth_data_const.COL_ID]
+        tenant = DockerVolumeTenant(name=r[auth_data_const.COL_NAME],
+                                    description=r[auth_data_const.COL_DESCRIPTION],
+                                    vms=create_vm_list(vms_by_tenant.get(id, [])),
+                                    privileges=create_datastore_access_privileges(privileges_by_tenant.get(id, [])),
+                                    id=id,
+                                    default_datastore_url=r[auth_data_const.COL_DEFAULT_DATASTORE_URL])
+        tenant_list.append(tenant)
+    return tenant_list
+
+def invalidate_cached_auth_data():
+    """
+    Drops the cached authorization data, the auth DB replica
+    and the resolved tenant folders held by this process.
+    """
+    auth.auth_cache.invalidate()
+    auth.auth_db_replica.mark_stale()
+    vmdk_utils.invalidate_vol_path_cache()
+
+
+def invalidates_auth_cache(func):
+    """
+    Decorator for methods which modify tenants, VMs, privileges
+    or rate limits. Invalidates the cached data once the method is done.
+    """
+    def invalidate(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_cached_auth_data()
+    return invalidate
+
+
+class DockerVolumeTenant(object):
     """ This class abstracts the operations to manage a DockerVolumeTenant.
 
     The interfaces it provides includes:
@@ -171,6 +306,7 @@ class DockerVolumeTenant:
     - set datastore and privileges for a tenant
 
     """
+    __slots__ = ('name', 'description', 'vms', 'privileges', 'default_datastore_url', 'id')
 
     def __init__(self, name, description, vms, privileges, id=None, default_datastore_url=None):
         """ Construct a DockerVolumeTenant object. """
@@ -184,6 +320,7 @@ class DockerVolumeTenant:
         else:
             self.id = id
 
+    @invalidates_auth_cache
     def add_vms(self, conn, vms):
         """ Add vms in the vms table for this tenant. """
         tenant_id = self.id
@@ -204,6 +341,7 @@ class DockerVolumeTenant:
         return None
 
 
+    @invalidates_auth_cache
     def remove_vms(self, conn, vms):
         """ Remove vms from the vms table for this tenant. """
         tenant_id = self.id
@@ -221,6 +359,7 @@ class DockerVolumeTenant:
 
         return None
 
+    @invalidates_auth_cache
     def replace_vms(self, conn, vms):
         """ Update vms from the vms table which belong to this tenant. """
         tenant_id = self.id
@@ -244,6 +383,7 @@ class DockerVolumeTenant:
 
         return None
 
+    @invalidates_auth_cache
     def set_name(self, conn, name, new_name):
         """ Set name column in tenant table for this tenant. """
         logging.debug("set_name: name=%s, new_name=%s", name, new_name)
@@ -284,6 +424,7 @@ class DockerVolumeTenant:
 
 
 
+    @invalidates_auth_cache
     def set_description(self, conn, description):
         """ Set description column in tenant table for this tenant. """
         tenant_id = self.id
@@ -300,6 +441,38 @@ class DockerVolumeTenant:
         return None
 
 
+    @invalidates_auth_cache
+    def set_rate_limits(self, conn, vm_rate, vm_burst, group_rate, group_burst):
+        """ Set request rate limits for this tenant, 0 means no limit. """
+        logging.debug("set_rate_limits: tenant=%s vm_rate=%s vm_burst=%s group_rate=%s group_burst=%s",
+                      self.id, vm_rate, vm_burst, group_rate, group_burst)
+        tenant_id = self.id
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits(tenant_id, vm_rate, vm_burst, group_rate, group_burst) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (tenant_id, vm_rate, vm_burst, group_rate, group_burst)
+                )
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error("Error %s when updating rate_limits table with tenant_id %s", e, tenant_id)
+            return str(e)
+        return None
+
+    def get_rate_limits(self, conn):
+        """
+        Return (error_msg, rate_limits) for this tenant, where rate_limits is
+        a row of rate_limits table, or None if no limits were set.
+        """
+        tenant_id = self.id
+        try:
+            cur = conn.execute("SELECT * FROM rate_limits WHERE tenant_id = ?", (tenant_id,))
+            return None, cur.fetchone()
+        except sqlite3.Error as e:
+            logging.error("Error %s when querying rate_limits table with tenant_id %s", e, tenant_id)
+            return str(e), None
+
+    @invalidates_auth_cache
     def set_default_datastore(self, conn, datastore_url):
         """ Set default_datastore for this tenant."""
         logging.debug("set_default_datastore: for tenant=%s to datastore=%s", self.id, datastore_url)
@@ -338,6 +511,7 @@ class DockerVolumeTenant:
             else:
                 return None, datastore_url
 
+    @invalidates_auth_cache
     def set_datastore_access_privileges(self, conn, privileges):
         """ Set datastore and privileges for this tenant.
 
@@ -405,6 +579,7 @@ class DockerVolumeTenant:
 
         return None
 
+    @invalidates_auth_cache
     def remove_datastore_access_privileges(self, conn, datastore_url):
         """ Remove privileges from privileges table for this tenant. """
         tenant_id = self.id
@@ -566,7 +741,7 @@ class AuthorizationDataManager:
                         UPDATE vms SET vm_name=name_from_uuid(vm_id);
                         UPDATE versions SET major_ver = {}, minor_ver = {};
                      """
-            sql_script = script.format(DB_MAJOR_VER, DB_MINOR_VER)
+            sql_script = script.format(1, 2)
             self.conn.executescript(sql_script)
 
             logging.info("handle_upgrade_1_1_to_1_2: update vms table Done")
@@ -608,6 +783,52 @@ class AuthorizationDataManager:
             logging.error("handle_upgrade_1_1_to_1_2. %s", error_msg)
             raise DbUpgradeError(self.db_path, error_msg)
 
+    def handle_upgrade_1_2_to_1_3(self):
+        """
+        Upgrade the db from version 1.2 to 1.3
+        In 1.3 the vms table has an index on tenant_id, and table volume_usage keeps
+        the storage used by each (tenant, datastore), maintained by triggers on the
+        volumes table. The upgrade creates them and fills volume_usage from the
+        existing volumes.
+        """
+        try:
+            logging.info("handle_upgrade_1_2_to_1_3: Start")
+            for statement in SCHEMA_1_3_STATEMENTS:
+                self.conn.execute(statement)
+            self.conn.execute("""INSERT OR REPLACE INTO volume_usage(tenant_id, datastore_url, total_size)
+                                     SELECT tenant_id, datastore_url, SUM(IFNULL(volume_size, 0)) FROM volumes
+                                     GROUP BY tenant_id, datastore_url
+                              """)
+            self.conn.execute("UPDATE versions SET major_ver = ?, minor_ver = ?", (1, 3))
+            self.conn.commit()
+            logging.info("handle_upgrade_1_2_to_1_3: Done")
+            return None
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            error_msg = "Error when upgrading auth DB table({})".format(str(e))
+            logging.error("handle_upgrade_1_2_to_1_3. %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
+
+    def handle_upgrade_1_3_to_1_4(self):
+        """
+        Upgrade the db from version 1.3 to 1.4
+        In 1.4 table rate_limits keeps request rate limits per vmgroup.
+        Existing vmgroups have no limits.
+        """
+        try:
+            logging.info("handle_upgrade_1_3_to_1_4: Start")
+            for statement in SCHEMA_1_4_STATEMENTS:
+                self.conn.execute(statement)
+            self.conn.execute("UPDATE versions SET major_ver = ?, minor_ver = ?", (1, 4))
+            self.conn.commit()
+            logging.info("handle_upgrade_1_3_to_1_4: Done")
+            return None
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            error_msg = "Error when upgrading auth DB table({})".format(str(e))
+            logging.error("handle_upgrade_1_3_to_1_4. %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
+
     def __handle_upgrade(self):
         error_msg, major_ver, minor_ver = self.__get_db_version()
         if error_msg:
@@ -619,13 +840,21 @@ class AuthorizationDataManager:
         if major_ver == DB_MAJOR_VER and minor_ver == DB_MINOR_VER:
             return
 
-        if DB_MAJOR_VER == 1 and DB_MINOR_VER == 2:
-            if major_ver == 1 and minor_ver == 1:
-                self.handle_upgrade_1_1_to_1_2()
-            else:
-                error_msg = "Upgrade is not supported for auth-db schema version {}.{} to {}.{}. Refer to VDVS release versions".format(major_ver, minor_ver, DB_MAJOR_VER, DB_MINOR_VER)
-                logging.error("__handle_upgrade: %s", error_msg)
-                raise DbUpgradeError(self.db_path, error_msg)
+        # upgrade steps are applied one after another, 1.1 -> 1.2 -> 1.3 -> 1.4
+        if major_ver == 1 and minor_ver == 1:
+            self.handle_upgrade_1_1_to_1_2()
+            minor_ver = 2
+        if major_ver == 1 and minor_ver == 2:
+            self.handle_upgrade_1_2_to_1_3()
+            minor_ver = 3
+        if major_ver == 1 and minor_ver == 3:
+            self.handle_upgrade_1_3_to_1_4()
+            minor_ver = 4
+
+        if major_ver != DB_MAJOR_VER or minor_ver != DB_MINOR_VER:
+            error_msg = "Upgrade is not supported for auth-db schema version {}.{} to {}.{}. Refer to VDVS release versions".format(major_ver, minor_ver, DB_MAJOR_VER, DB_MINOR_VER)
+            logging.error("__handle_upgrade: %s", error_msg)
+            raise DbUpgradeError(self.db_path, error_msg)
 
     def __connect(self):
         """
@@ -637,7 +866,9 @@ class AuthorizationDataManager:
             self.__close()
 
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # Connections are reused by different request threads (see auth.AuthMgrPool),
+            # one thread at a time, so sqlite same thread check is not needed.
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         except sqlite3.Error as e:
             logging.error("Failed to connect to DB (%s): %s", self.db_path, e)
             raise DbConnectionError(self.db_path)
@@ -845,6 +1076,9 @@ class AuthorizationDataManager:
                 vmodl_minor_ver INTEGER NOT NULL
                 );''')
 
+            for statement in SCHEMA_1_3_STATEMENTS + SCHEMA_1_4_STATEMENTS:
+                self.conn.execute(statement)
+
             # insert latest DB version and VMODL version to table "versions"
             self.conn.execute("INSERT INTO versions(id, major_ver, minor_ver, vmodl_major_ver, vmodl_minor_ver) " +
                               "VALUES (?, ?, ?, ?, ?)",
@@ -855,6 +1089,7 @@ class AuthorizationDataManager:
 
         return None
 
+    @invalidates_auth_cache
     def create_tenant(self, name, description, vms, privileges):
         """ Create a tenant in the database.
         If tenant_uuid is None, tenant id will be auto-generated and returned,
@@ -1042,49 +1277,54 @@ class AuthorizationDataManager:
                 (tenant_name,)
             )
             result = cur.fetchall()
-
-            for r in result:
-                # loop through each tenant
-                id = r[auth_data_const.COL_ID]
-                name = r[auth_data_const.COL_NAME]
-                description = r[auth_data_const.COL_DESCRIPTION]
-                default_datastore_url = r[auth_data_const.COL_DEFAULT_DATASTORE_URL]
-
-                # search vms for this tenant
-                vms = []
+            if result:
+                id = result[0][auth_data_const.COL_ID]
                 cur = self.conn.execute(
                     "SELECT * FROM vms WHERE tenant_id = ?",
                     (id,)
                 )
                 vms = cur.fetchall()
-
-                logging.debug("vms=%s", vms)
-                vm_list = create_vm_list(vms)
-
-                # search privileges and default_privileges for this tenant
-                privileges = []
                 cur = self.conn.execute(
                     "SELECT * FROM privileges WHERE tenant_id = ?",
                     (id,)
                 )
                 privileges = cur.fetchall()
-                ds_access_privileges = create_datastore_access_privileges(privileges)
-
-                logging.debug("privileges=%s", privileges)
-                logging.debug("ds_access_privileges=%s", ds_access_privileges)
-
-                tenant = DockerVolumeTenant(name=name,
-                                            description=description,
-                                            vms=vm_list,
-                                            privileges=ds_access_privileges,
-                                            id=id,
-                                            default_datastore_url=default_datastore_url)
+                tenant = create_tenant_list(result, vms, privileges)[0]
         except sqlite3.Error as e:
             logging.error("Error %s in get_tenant(%s)", e, tenant_name)
             return ErrorCode.SQLITE3_ERROR, tenant
 
         return None, tenant
 
+    def get_tenant_id(self, tenant_name, conn=None):
+        """
+        Return an (err, id) where err is None or error code,
+        and id is the id of the tenant with given tenant_name or None.
+        Unlike get_tenant(), does not load VMs and privileges of the tenant.
+        Reads using conn if given (e.g. auth DB replica), otherwise self.conn.
+        """
+        if self.allow_all_access():
+            if tenant_name == auth_data_const.DEFAULT_TENANT:
+                return None, auth_data_const.DEFAULT_TENANT_UUID
+            else:
+                return ErrorCode.INIT_NEEDED, None
+
+        if not conn:
+            conn = self.conn
+        try:
+            cur = conn.execute(
+                "SELECT id FROM tenants WHERE name = ?",
+                (tenant_name,)
+            )
+            result = cur.fetchone()
+        except sqlite3.Error as e:
+            logging.error("Error %s in get_tenant_id(%s)", e, tenant_name)
+            return ErrorCode.SQLITE3_ERROR, None
+
+        if result:
+            return None, result[0]
+        return None, None
+
     def list_tenants(self):
         """ Return a list of DockerVolumeTenants objects. """
         if self.allow_all_access():
@@ -1093,50 +1333,44 @@ class AuthorizationDataManager:
 
         tenant_list = []
         try:
-            cur = self.conn.execute(
-                "SELECT * FROM tenants"
-            )
-            result = cur.fetchall()
+            # Load all tables at once and group rows by tenant, instead of
+            # querying vms and privileges for each tenant.
+            tenants = self.conn.execute("SELECT * FROM tenants").fetchall()
+            vms = self.conn.execute("SELECT * FROM vms").fetchall()
+            privileges = self.conn.execute("SELECT * FROM privileges").fetchall()
+            tenant_list = create_tenant_list(tenants, vms, privileges)
+        except sqlite3.Error as e:
+            logging.error("Error %s when listing all tenants", e)
+            return str(e), tenant_list
 
-            for r in result:
-                # loop through each tenant
-                id = r[auth_data_const.COL_ID]
-                name = r[auth_data_const.COL_NAME]
-                description = r[auth_data_const.COL_DESCRIPTION]
-                default_datastore_url = r[auth_data_const.COL_DEFAULT_DATASTORE_URL]
+        return None, tenant_list
 
-                # search vms for this tenant
-                vms = []
-                cur = self.conn.execute(
-                    "SELECT * FROM vms WHERE tenant_id = ?",
-                    (id,)
-                )
-                vms = cur.fetchall()
-                vm_list = create_vm_list(vms)
-                # search privileges and default_privileges for this tenant
-                privileges = []
+    def get_tenants_for_vms(self, vm_ids):
+        """
+        Return (err, tenants) where tenants is a list of (vm_id, tenant_name)
+        for VMs from vm_ids which belong to a tenant.
+        """
+        if self.allow_all_access():
+            return None, []
+
+        tenants = []
+        vm_ids = list(vm_ids)
+        try:
+            # keep well below sqlite limit on number of host parameters (999)
+            batch_size = 500
+            for i in range(0, len(vm_ids), batch_size):
+                batch = vm_ids[i:i + batch_size]
                 cur = self.conn.execute(
-                    "SELECT * FROM privileges WHERE tenant_id = ?",
-                    (id,)
+                    "SELECT vms.vm_id, tenants.name FROM vms JOIN tenants ON vms.tenant_id = tenants.id "
+                    "WHERE vms.vm_id IN ({0})".format(", ".join("?" * len(batch))),
+                    batch
                 )
-                privileges = cur.fetchall()
-                ds_access_privileges = create_datastore_access_privileges(privileges)
-
-                logging.debug("privileges=%s", privileges)
-                logging.debug("ds_access_privileges=%s", ds_access_privileges)
-
-                tenant = DockerVolumeTenant(name=name,
-                                            description=description,
-                                            vms=vm_list,
-                                            privileges=ds_access_privileges,
-                                            id=id,
-                                            default_datastore_url=default_datastore_url)
-                tenant_list.append(tenant)
+                tenants.extend((r[0], r[1]) for r in cur.fetchall())
         except sqlite3.Error as e:
-            logging.error("Error %s when listing all tenants", e)
-            return str(e), tenant_list
+            logging.error("Error %s when looking up tenants for vms %s", e, vm_ids)
+            return str(e), []
 
-        return None, tenant_list
+        return None, tenants
 
     def remove_volumes_from_volumes_table(self, tenant_id):
         """ Remove all volumes from volumes table. """
@@ -1179,7 +1413,128 @@ class AuthorizationDataManager:
 
         return None
 
-    def __remove_volumes_for_tenant(self, tenant_id, remove_volumes):
+    def get_remove_checkpoint_path(self, tenant_id):
+        """ Return the path of the volume removal checkpoint for the tenant """
+        db_dir = os.path.dirname(os.path.realpath(self.db_path))
+        return os.path.join(db_dir, VMGROUP_RM_CHECKPOINT.format(tenant_id))
+
+    def get_remove_progress(self, tenant_id):
+        """
+        Return the checkpoint of an unfinished volume removal for the tenant,
+        a dict with "total" and "removed" volume counts and the "volumes" left,
+        or None if there is none.
+        """
+        try:
+            with open(self.get_remove_checkpoint_path(tenant_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def __save_remove_checkpoint(self, tenant_id, checkpoint):
+        """ Save the volume removal checkpoint (atomically), or delete it if checkpoint is None """
+        path = self.get_remove_checkpoint_path(tenant_id)
+        try:
+            if checkpoint is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                return
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(checkpoint, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to save volume removal checkpoint %s: %s", path, e)
+
+    def __resume_remove_checkpoint(self, checkpoint, vmdks):
+        """
+        Update a saved volume removal checkpoint with vmdks, the volumes the
+        tenant has now. Volumes left in the checkpoint which are gone were
+        removed after the last save (or by hand) and are counted as removed,
+        volumes created since are added.
+        Returns the volumes to remove.
+        """
+        key = lambda vmdk: (vmdk['path'], vmdk['filename'])
+        current = dict((key(vmdk), vmdk) for vmdk in vmdks)
+        saved = set(key(vmdk) for vmdk in checkpoint["volumes"])
+        left = [vmdk for vmdk in checkpoint["volumes"] if key(vmdk) in current]
+        added = [vmdk for vmdk in vmdks if key(vmdk) not in saved]
+        checkpoint["removed"] += len(checkpoint["volumes"]) - len(left)
+        checkpoint["total"] += len(added)
+        checkpoint["volumes"] = left + added
+        checkpoint["dirs"] = sorted(set(checkpoint["dirs"]) | set(vmdk['path'] for vmdk in added))
+        return checkpoint["volumes"]
+
+    def __remove_volumes(self, tenant_id, checkpoint, progress=None):
+        """
+        Remove the volumes left in the checkpoint, VMGROUP_RM_PARALLELISM at a
+        time, saving the checkpoint as they are removed. progress(removed, total),
+        if set, is called at each save.
+        Returns error string, empty if all volumes were removed.
+        """
+        # Interleave datastores so that all of them are worked on at the same time
+        by_datastore = collections.OrderedDict()
+        for vmdk in checkpoint["volumes"]:
+            by_datastore.setdefault(vmdk['datastore'], collections.deque()).append(vmdk)
+        pending = collections.deque()
+        while by_datastore:
+            for datastore in list(by_datastore):
+                pending.append(by_datastore[datastore].popleft())
+                if not by_datastore[datastore]:
+                    del by_datastore[datastore]
+
+        lock = threading.Lock()
+        done = set()
+        errors = []
+
+        def save():
+            """ Save the checkpoint, called with lock held """
+            checkpoint["volumes"] = [vmdk for vmdk in checkpoint["volumes"]
+                                     if (vmdk['path'], vmdk['filename']) not in done]
+            done.clear()
+            self.__save_remove_checkpoint(tenant_id, checkpoint)
+            if progress:
+                progress(checkpoint["removed"], checkpoint["total"])
+
+        def remove_volumes():
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    vmdk = pending.popleft()
+                vmdk_path = os.path.join(vmdk['path'], "{0}".format(vmdk['filename']))
+                logging.debug("Deleting volume path%s", vmdk_path)
+                err = vmdk_ops.removeVMDK(vmdk_path=vmdk_path,
+                                          vol_name=vmdk_utils.strip_vmdk_extension(vmdk['filename']),
+                                          vm_name=None)
+                with lock:
+                    if err:
+                        logging.error("remove vmdk %s failed with error %s", vmdk_path, err)
+                        errors.append(str(err))
+                        continue
+                    done.add((vmdk['path'], vmdk['filename']))
+                    checkpoint["removed"] += 1
+                    if checkpoint["removed"] % VMGROUP_RM_CHECKPOINT_EVERY == 0:
+                        save()
+
+        workers = [threading.Thread(target=remove_volumes)
+                   for _ in range(min(VMGROUP_RM_PARALLELISM, len(pending)) - 1)]
+        for worker in workers:
+            worker.start()
+        remove_volumes()
+        for worker in workers:
+            worker.join()
+
+        with lock:
+            if errors:
+                # keep the volumes left for the next attempt
+                save()
+            else:
+                self.__save_remove_checkpoint(tenant_id, None)
+                if progress:
+                    progress(checkpoint["removed"], checkpoint["total"])
+        return "".join(errors)
+
+    def __remove_volumes_for_tenant(self, tenant_id, remove_volumes, progress=None):
         """ Delete all volumes belongs to this tenant.
 
             Do not use it outside of removing a tenant.
@@ -1199,6 +1554,16 @@ class AuthorizationDataManager:
             logging.debug("remove_volumes_for_tenant: %s %s", tenant_id, result)
             tenant_name = result[0]
             vmdks = vmdk_utils.get_volumes(tenant_name)
+            checkpoint = self.get_remove_progress(tenant_id) if remove_volumes else None
+            if checkpoint:
+                vmdks = self.__resume_remove_checkpoint(checkpoint, vmdks)
+                logging.info("Resuming removal of vmgroup %s volumes: %d of %d removed",
+                             tenant_name, checkpoint["removed"], checkpoint["total"])
+            else:
+                checkpoint = {"total": len(vmdks),
+                              "removed": 0,
+                              "volumes": vmdks,
+                              "dirs": sorted(set(vmdk['path'] for vmdk in vmdks))}
 
             # If volums exist for the tenant but user doesn't want to delete
             # them then fail the tenant removal.
@@ -1206,21 +1571,16 @@ class AuthorizationDataManager:
                 error_msg = "The vmgroup has volumes in it, these must be removed/migrated before deleting the vmgroup."
                 return error_msg
 
-            # Delete all volumes for this tenant.
-            dir_paths = set()
-            for vmdk in vmdks:
-                vmdk_path = os.path.join(vmdk['path'], "{0}".format(vmdk['filename']))
-                dir_paths.add(vmdk['path'])
-                logging.debug("path=%s filename=%s", vmdk['path'], vmdk['filename'])
-                logging.debug("Deleting volume path%s", vmdk_path)
-                datastore_url = vmdk_utils.get_datastore_url(vmdk['datastore'])
-                err = vmdk_ops.removeVMDK(vmdk_path=vmdk_path,
-                                          vol_name=vmdk_utils.strip_vmdk_extension(vmdk['filename']),
-                                          vm_name=None,
-                                          tenant_uuid=tenant_id,
-                                          datastore_url=datastore_url)
+            # Delete all volumes for this tenant. Their rows in the volumes
+            # table are removed all at once below.
+            dir_paths = set(checkpoint["dirs"])
+            error_msg += self.__remove_volumes(tenant_id, checkpoint, progress)
+
+            # Delete warm pool disks, they are not volumes of the vmgroup yet
+            for (datastore, url, path) in vmdk_utils.get_datastores():
+                err = vmdk_ops.remove_warm_pools(os.path.join(path, tenant_id))
                 if err:
-                    logging.error("remove vmdk %s failed with error %s", vmdk_path, err)
+                    logging.error("remove warm pools on %s failed with error %s", datastore, err)
                     error_msg += str(err)
 
             # remove symlink
@@ -1249,12 +1609,15 @@ class AuthorizationDataManager:
 
         return None
 
-    def remove_tenant(self, tenant_id, remove_volumes):
+    @invalidates_auth_cache
+    def remove_tenant(self, tenant_id, remove_volumes, progress=None):
         """
         Remove a tenant with given id.
         A row with given tenant_id will be removed from table tenants, vms,
         and privileges.
-        If remove_volumes is True -  all volumes for this tenant will be removed as well.
+        If remove_volumes is True -  all volumes for this tenant will be removed as well,
+        calling progress(removed, total) from time to time if it is set. An
+        interrupted or failed removal is resumed by the next call.
         Returns None for success, error string for errors.
         """
         logging.debug("remove_tenant: tenant_id%s, remove_volumes=%d", tenant_id, remove_volumes)
@@ -1262,7 +1625,7 @@ class AuthorizationDataManager:
         if self.allow_all_access():
             return self.err_config_init_needed()
 
-        error_msg = self.__remove_volumes_for_tenant(tenant_id, remove_volumes)
+        error_msg = self.__remove_volumes_for_tenant(tenant_id, remove_volumes, progress)
         if error_msg:
             return error_msg
 
@@ -1276,6 +1639,10 @@ class AuthorizationDataManager:
                 "DELETE FROM privileges WHERE tenant_id = ?",
                 [tenant_id]
             )
+            self.conn.execute(
+                "DELETE FROM rate_limits WHERE tenant_id = ?",
+                [tenant_id]
+            )
             self.conn.execute(
                 "DELETE FROM tenants WHERE id = ?",
                 [tenant_id]
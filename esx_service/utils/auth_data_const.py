@@ -35,6 +35,12 @@ COL_USAGE_QUOTA = 'usage_quota'
 COL_VOLUME_NAME = 'volume_name'
 COL_VOLUME_SIZE = 'volume_size'
 
+# column name in rate_limits table
+COL_VM_RATE = 'vm_rate'
+COL_VM_BURST = 'vm_burst'
+COL_GROUP_RATE = 'group_rate'
+COL_GROUP_BURST = 'group_burst'
+
 # default tenant constants
 DEFAULT_TENANT = '_DEFAULT'
 DEFAULT_TENANT_UUID = '11111111-1111-1111-1111-111111111111'
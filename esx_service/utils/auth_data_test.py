@@ -24,6 +24,14 @@ import auth
 import log_config
 import glob
 import random
+import time
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import vmdk_ops
+import vmdk_utils
 
 ADMIN_CLI = '/usr/lib/vmware/vmdkops/bin/vmdkops_admin.py'
 # Admin CLI to control config DB init
@@ -233,6 +241,34 @@ class TestAuthDataModel(unittest.TestCase):
         actual_output = tenants_row[auth_data_const.COL_DESCRIPTION]
         self.assertEqual(actual_output, expected_output)
 
+    def test_set_rate_limits(self):
+        vms = [(self.vm1_uuid, self.vm1_name)]
+        privileges = self.get_privileges()
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Some tenant',
+                                                          vms=vms,
+                                                          privileges=privileges)
+        self.assertEqual(error_info, None)
+
+        # no limits by default
+        error_info, rate_limits = tenant1.get_rate_limits(self.auth_mgr.conn)
+        self.assertEqual(error_info, None)
+        self.assertEqual(rate_limits, None)
+
+        error_info = tenant1.set_rate_limits(self.auth_mgr.conn, 2.5, 10, 0, 0)
+        self.assertEqual(error_info, None)
+        error_info, rate_limits = tenant1.get_rate_limits(self.auth_mgr.conn)
+        self.assertEqual(error_info, None)
+        self.assertEqual(rate_limits[auth_data_const.COL_VM_RATE], 2.5)
+        self.assertEqual(rate_limits[auth_data_const.COL_VM_BURST], 10)
+        self.assertEqual(rate_limits[auth_data_const.COL_GROUP_RATE], 0)
+
+        # limits are removed with the tenant
+        error_info = self.auth_mgr.remove_tenant(tenant1.id, False)
+        self.assertEqual(error_info, None)
+        error_info, rate_limits = tenant1.get_rate_limits(self.auth_mgr.conn)
+        self.assertEqual(rate_limits, None)
+
     def test_set_default_datastore(self):
         vms = [(self.vm1_uuid, self.vm1_name)]
         privileges = self.get_privileges()
@@ -461,6 +497,443 @@ class TestAuthDataModel(unittest.TestCase):
         self.assertEqual(error_info, None)
         self.assertEqual(privileges_row, [])
 
+    def create_tenant_volumes(self, count):
+        """ Create a tenant with count volumes on the first datastore, return (tenant, vmdk paths) """
+        error_info, tenant = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                         description='Tenant with volumes',
+                                                         vms=[],
+                                                         privileges=[])
+        self.assertEqual(error_info, None)
+        datastores = vmdk_utils.get_datastores()
+        self.assertTrue(datastores, "No datastore found")
+        tenant_path = os.path.join(datastores[0][2], tenant.id)
+        os.makedirs(tenant_path)
+        vmdk_paths = []
+        for i in range(count):
+            vol_name = "vmgroup_rm_vol{0}".format(i)
+            vmdk_path = vmdk_utils.get_vmdk_path(tenant_path, vol_name)
+            err = vmdk_ops.createVMDK(vmdk_path=vmdk_path,
+                                      vm_name=self.vm1_name,
+                                      vol_name=vol_name,
+                                      opts={"size": "10mb"})
+            self.assertEqual(err, None, err)
+            vmdk_paths.append(vmdk_path)
+        return tenant, vmdk_paths
+
+    def test_remove_tenant_volumes(self):
+        """ Test parallel removal of vmgroup volumes with progress reports """
+        count = auth_data.VMGROUP_RM_CHECKPOINT_EVERY + auth_data.VMGROUP_RM_PARALLELISM
+        tenant, vmdk_paths = self.create_tenant_volumes(count)
+        reports = []
+
+        error_info = self.auth_mgr.remove_tenant(tenant.id, True,
+                                                 progress=lambda removed, total: reports.append((removed, total)))
+        self.assertEqual(error_info, None)
+        for vmdk_path in vmdk_paths:
+            self.assertFalse(os.path.exists(vmdk_path), vmdk_path)
+        self.assertEqual(reports[0], (auth_data.VMGROUP_RM_CHECKPOINT_EVERY, count))
+        self.assertEqual(reports[-1], (count, count))
+        self.assertEqual(self.auth_mgr.get_remove_progress(tenant.id), None)
+
+    def test_remove_tenant_volumes_resume(self):
+        """ Test resuming an interrupted removal of vmgroup volumes """
+        tenant, vmdk_paths = self.create_tenant_volumes(4)
+        tenant_path = os.path.dirname(vmdk_paths[0])
+        datastore = vmdk_utils.get_datastores()[0][0]
+
+        def vmdk_entry(vmdk_path):
+            return {'path': tenant_path,
+                    'filename': os.path.basename(vmdk_path),
+                    'datastore': datastore}
+
+        # Checkpoint saved before vmdk_paths[2:] were created. vmdk_paths[1]
+        # and another volume were removed after it was saved.
+        gone_vmdk_path = os.path.join(tenant_path, "vmgroup_rm_gone.vmdk")
+        checkpoint = {"total": 3,
+                      "removed": 0,
+                      "volumes": [vmdk_entry(p) for p in vmdk_paths[:2] + [gone_vmdk_path]],
+                      "dirs": [tenant_path]}
+        with open(self.auth_mgr.get_remove_checkpoint_path(tenant.id), "w") as f:
+            json.dump(checkpoint, f)
+        self.assertEqual(vmdk_ops.removeVMDK(vmdk_paths[1]), None)
+
+        reports = []
+        error_info = self.auth_mgr.remove_tenant(tenant.id, True,
+                                                 progress=lambda removed, total: reports.append((removed, total)))
+        self.assertEqual(error_info, None)
+        for vmdk_path in vmdk_paths:
+            self.assertFalse(os.path.exists(vmdk_path), vmdk_path)
+        self.assertEqual(reports[-1], (6, 6))
+        self.assertEqual(self.auth_mgr.get_remove_progress(tenant.id), None)
+
+    def get_volume_names(self, tenant_id):
+        cur = self.auth_mgr.conn.execute("SELECT volume_name FROM volumes WHERE tenant_id = ?", (tenant_id,))
+        return sorted(row[0] for row in cur.fetchall())
+
+    def test_volumes_table_writer(self):
+        """ Test that concurrent volumes table changes are all committed """
+        count = 32
+        datastore_url = self.get_datastore_url(self.get_default_datastore())
+        error_info, tenant = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                         description='Volumes table writer tenant',
+                                                         vms=[(self.vm1_uuid, self.vm1_name)],
+                                                         privileges=[])
+        self.assertEqual(error_info, None)
+        writer = auth.VolumesTableWriter(batch_ms=50)
+        names = ["vol{0}".format(i) for i in range(count)]
+        errors = []
+
+        def execute(sql, params):
+            errors.append(writer.execute(sql, params))
+
+        def run_all(sql, params_list):
+            del errors[:]
+            threads = [threading.Thread(target=execute, args=(sql, params)) for params in params_list]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [None] * len(params_list))
+
+        run_all("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                [(tenant.id, datastore_url, name, 10) for name in names])
+        self.assertEqual(self.get_volume_names(tenant.id), sorted(names))
+
+        run_all("DELETE FROM volumes WHERE tenant_id = ? AND datastore_url = ? AND volume_name = ?",
+                [(tenant.id, datastore_url, name) for name in names[1:]])
+        self.assertEqual(self.get_volume_names(tenant.id), names[:1])
+
+        error_info = self.auth_mgr.remove_tenant(tenant.id, False)
+        self.assertEqual(error_info, None)
+
+    def test_volumes_table_writer_errors(self):
+        """ Test that a failed change in a batch fails only its own caller """
+        datastore_url = self.get_datastore_url(self.get_default_datastore())
+        error_info, tenant = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                         description='Volumes table writer tenant',
+                                                         vms=[(self.vm1_uuid, self.vm1_name)],
+                                                         privileges=[])
+        self.assertEqual(error_info, None)
+        insert = "INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)"
+        writer = auth.VolumesTableWriter()
+        # queued before the writer thread starts, so they are committed in one batch
+        writes = [auth.PendingWrite(insert, (tenant.id, datastore_url, "vol1", 10)),
+                  auth.PendingWrite(insert, (tenant.id, datastore_url, "vol1", 20)),
+                  auth.PendingWrite(insert, (tenant.id, datastore_url, "vol2", 10)),
+                  auth.PendingWrite("INSERT INTO no_such_table VALUES (?)", (1,))]
+        for write in writes:
+            writer._queue.put(write)
+        err = writer.execute(insert, (tenant.id, datastore_url, "vol3", 10))
+        self.assertEqual(err, None)
+        for write in writes:
+            self.assertTrue(write.done.is_set())
+
+        self.assertEqual(writes[0].error, None)
+        self.assertEqual(writes[2].error, None)
+        # duplicate volume
+        self.assertNotEqual(writes[1].error, None)
+        self.assertIn("no_such_table", writes[3].error)
+        self.assertNotEqual(writes[1].error, writes[3].error)
+        self.assertEqual(self.get_volume_names(tenant.id), ["vol1", "vol2", "vol3"])
+        error_info, total_storage_used = auth.get_total_storage_used(tenant.id, datastore_url, None)
+        self.assertEqual(error_info, None)
+        self.assertEqual(total_storage_used, 30)
+
+        error_info = self.auth_mgr.remove_tenant(tenant.id, False)
+        self.assertEqual(error_info, None)
+
+    def assert_volume_usage(self, conn):
+        """ Check that volume_usage has SUM(volume_size) of volumes for each (tenant, datastore) """
+        usage = {}
+        for row in conn.execute("SELECT tenant_id, datastore_url, total_size FROM volume_usage"):
+            if row[2]:
+                usage[(row[0], row[1])] = row[2]
+        expected = {}
+        for row in conn.execute("""SELECT tenant_id, datastore_url, SUM(IFNULL(volume_size, 0)) FROM volumes
+                                   GROUP BY tenant_id, datastore_url"""):
+            if row[2]:
+                expected[(row[0], row[1])] = row[2]
+        self.assertEqual(usage, expected)
+        return usage
+
+    def test_volume_usage(self):
+        """ Test that volume_usage follows inserts, updates and deletes in volumes table """
+        datastore1_url = self.get_datastore_url('datastore1')
+        datastore2_url = self.get_datastore_url('datastore2')
+        error_info, tenant1 = self.auth_mgr.create_tenant(name=self.tenant_name,
+                                                          description='Volume usage tenant',
+                                                          vms=[(self.vm1_uuid, self.vm1_name)],
+                                                          privileges=[])
+        self.assertEqual(error_info, None)
+        error_info, tenant2 = self.auth_mgr.create_tenant(name=self.tenant_2_name,
+                                                          description='Volume usage tenant',
+                                                          vms=[(self.vm2_uuid, self.vm2_name)],
+                                                          privileges=[])
+        self.assertEqual(error_info, None)
+        conn = self.auth_mgr.conn
+
+        volumes = [(tenant1.id, datastore1_url, "vol1", 10),
+                   (tenant1.id, datastore1_url, "vol2", 20),
+                   (tenant1.id, datastore2_url, "vol3", 30),
+                   (tenant2.id, datastore1_url, "vol1", 40),
+                   (tenant2.id, datastore1_url, "vol2", None)]
+        conn.executemany("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                         volumes)
+        conn.commit()
+        usage = self.assert_volume_usage(conn)
+        self.assertEqual(usage[(tenant1.id, datastore1_url)], 30)
+        error_info, total_storage_used = auth.get_total_storage_used(tenant1.id, datastore1_url, None)
+        self.assertEqual(error_info, None)
+        self.assertEqual(total_storage_used, 30)
+
+        # resize, then move a volume to another datastore and tenant
+        conn.execute("UPDATE volumes SET volume_size = ? WHERE tenant_id = ? AND volume_name = ?",
+                     (25, tenant1.id, "vol2"))
+        conn.execute("UPDATE volumes SET volume_size = ? WHERE tenant_id = ? AND volume_name = ?",
+                     (5, tenant2.id, "vol2"))
+        conn.commit()
+        usage = self.assert_volume_usage(conn)
+        self.assertEqual(usage[(tenant1.id, datastore1_url)], 35)
+        self.assertEqual(usage[(tenant2.id, datastore1_url)], 45)
+
+        conn.execute("UPDATE volumes SET tenant_id = ?, datastore_url = ? WHERE tenant_id = ? AND volume_name = ?",
+                     (tenant2.id, datastore2_url, tenant1.id, "vol3"))
+        conn.commit()
+        usage = self.assert_volume_usage(conn)
+        self.assertNotIn((tenant1.id, datastore2_url), usage)
+        self.assertEqual(usage[(tenant2.id, datastore2_url)], 30)
+
+        conn.execute("DELETE FROM volumes WHERE tenant_id = ? AND volume_name = ?", (tenant1.id, "vol1"))
+        conn.commit()
+        usage = self.assert_volume_usage(conn)
+        self.assertEqual(usage[(tenant1.id, datastore1_url)], 25)
+
+        for tenant in (tenant1, tenant2):
+            error_info = self.auth_mgr.remove_tenant(tenant.id, False)
+            self.assertEqual(error_info, None)
+        usage = self.assert_volume_usage(conn)
+        for tenant in (tenant1, tenant2):
+            for datastore_url in (datastore1_url, datastore2_url):
+                self.assertNotIn((tenant.id, datastore_url), usage)
+                error_info, total_storage_used = auth.get_total_storage_used(tenant.id, datastore_url, None)
+                self.assertEqual(error_info, None)
+                self.assertEqual(total_storage_used, 0)
+
+    def test_volume_usage_upgrade(self):
+        """ Test that upgrade from DB version 1.2 to 1.3 fills volume_usage from volumes table """
+        db_path = "/tmp/auth-db-upgrade-test-" + str(uuid.uuid4())
+        auth_mgr = auth_data.AuthorizationDataManager(db_path)
+        try:
+            self.assertEqual(auth_mgr.new_db(), None)
+            conn = auth_mgr.conn
+            # bring the DB back to version 1.2
+            conn.execute("DROP TRIGGER volume_usage_insert")
+            conn.execute("DROP TRIGGER volume_usage_delete")
+            conn.execute("DROP TRIGGER volume_usage_update")
+            conn.execute("DROP TABLE volume_usage")
+            conn.execute("DROP INDEX vms_tenant_id")
+            conn.execute("UPDATE versions SET major_ver = ?, minor_ver = ?", (1, 2))
+            tenant_id = auth_data_const.DEFAULT_TENANT_UUID
+            datastore1_url = self.get_datastore_url('datastore1')
+            datastore2_url = self.get_datastore_url('datastore2')
+            conn.executemany("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                             [(tenant_id, datastore1_url, "vol1", 10),
+                              (tenant_id, datastore1_url, "vol2", 20),
+                              (tenant_id, datastore1_url, "vol3", None),
+                              (tenant_id, datastore2_url, "vol1", 30)])
+            conn.commit()
+
+            self.assertEqual(auth_mgr.handle_upgrade_1_2_to_1_3(), None)
+            usage = self.assert_volume_usage(conn)
+            self.assertEqual(usage, {(tenant_id, datastore1_url): 30,
+                                     (tenant_id, datastore2_url): 30})
+
+            # triggers keep volume_usage up to date after the upgrade
+            conn.execute("INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+                         (tenant_id, datastore2_url, "vol2", 5))
+            conn.execute("DELETE FROM volumes WHERE datastore_url = ? AND volume_name = ?",
+                         (datastore1_url, "vol1"))
+            conn.commit()
+            usage = self.assert_volume_usage(conn)
+            self.assertEqual(usage, {(tenant_id, datastore1_url): 20,
+                                     (tenant_id, datastore2_url): 35})
+        finally:
+            if auth_mgr.conn:
+                auth_mgr.conn.close()
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+class TestAuthDbReplica(unittest.TestCase):
+    """ Test local snapshot of a shared auth DB """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shared_path = os.path.join(self.tmp_dir, "shared-auth-db")
+        self.db_path = os.path.join(self.tmp_dir, "auth-db")
+        conn = sqlite3.connect(self.shared_path)
+        conn.execute("CREATE TABLE tenants(name TEXT)")
+        conn.commit()
+        conn.close()
+        self.write_shared_db("tenant1")
+        # MultiNode mode, the auth DB is a symlink to the shared DB
+        os.symlink(self.shared_path, self.db_path)
+        self.replica = auth.AuthDbReplica(db_path=self.db_path,
+                                          replica_path=os.path.join(self.tmp_dir, "auth-db.replica"))
+        self.copyfile = shutil.copyfile
+
+    def tearDown(self):
+        auth.shutil.copyfile = self.copyfile
+        shutil.rmtree(self.tmp_dir)
+
+    def write_shared_db(self, name):
+        """ Write to the shared DB the way another host would """
+        conn = sqlite3.connect(self.shared_path)
+        conn.execute("INSERT INTO tenants(name) VALUES (?)", (name,))
+        conn.commit()
+        conn.close()
+        # make sure the signature changes even with coarse mtime
+        st = os.stat(self.shared_path)
+        os.utime(self.shared_path, (st.st_atime, st.st_mtime + 10))
+
+    def read_replica(self):
+        """ Return tenant names in the snapshot, or None if readers should use the shared DB """
+        conn, generation = self.replica.checkout()
+        if not conn:
+            return None
+        names = [row[0] for row in conn.execute("SELECT name FROM tenants ORDER BY name")]
+        self.replica.release(conn, generation)
+        return names
+
+    def test_refresh(self):
+        """ Test that a write by another host is picked up """
+        self.assertEqual(self.read_replica(), None)
+        self.replica._check()
+        generation = self.replica.generation()
+        self.assertEqual(self.read_replica(), ["tenant1"])
+
+        # no change, no new snapshot
+        self.replica._check()
+        self.assertEqual(self.replica.generation(), generation)
+
+        self.write_shared_db("tenant2")
+        cache_generation = auth.auth_cache.generation()
+        self.replica._check()
+        self.assertEqual(self.replica.generation(), generation + 1)
+        self.assertNotEqual(auth.auth_cache.generation(), cache_generation)
+        self.assertEqual(self.read_replica(), ["tenant1", "tenant2"])
+
+    def test_mark_stale(self):
+        """ Test that mark_stale sends readers to the shared DB until the next refresh """
+        self.replica._check()
+        generation = self.replica.generation()
+        self.replica.mark_stale()
+        self.assertEqual(self.replica.generation(), None)
+        self.assertEqual(self.read_replica(), None)
+
+        # the shared DB signature is the same, but a new snapshot is taken
+        self.replica._check()
+        self.assertEqual(self.replica.generation(), generation + 1)
+        self.assertEqual(self.read_replica(), ["tenant1"])
+
+    def test_no_partial_snapshot(self):
+        """ Test that readers see the previous snapshot while a new one is copied """
+        self.replica._check()
+        self.write_shared_db("tenant2")
+        seen = []
+
+        def copyfile(src, dst):
+            with open(dst, "wb") as f:
+                with open(src, "rb") as s:
+                    f.write(s.read(100))
+            seen.append(self.read_replica())
+            self.copyfile(src, dst)
+
+        auth.shutil.copyfile = copyfile
+        self.replica._check()
+        self.assertEqual(seen, [["tenant1"]])
+        self.assertEqual(self.read_replica(), ["tenant1", "tenant2"])
+
+    def test_copy_failure(self):
+        """ Test that readers use the shared DB when the snapshot can't be refreshed """
+        self.replica._check()
+        self.write_shared_db("tenant2")
+
+        def copyfile(src, dst):
+            raise IOError("No space left on device")
+
+        auth.shutil.copyfile = copyfile
+        self.replica._check()
+        self.assertEqual(self.replica.generation(), None)
+        self.assertEqual(self.read_replica(), None)
+
+        auth.shutil.copyfile = self.copyfile
+        self.replica._check()
+        self.assertEqual(self.read_replica(), ["tenant1", "tenant2"])
+
+class TestRequestRateLimiter(unittest.TestCase):
+    """ Test per VM and per vmgroup request rate limits """
+
+    def rate_limits(self, vm_rate=0, vm_burst=0, group_rate=0, group_burst=0):
+        return {auth_data_const.COL_VM_RATE: vm_rate,
+                auth_data_const.COL_VM_BURST: vm_burst,
+                auth_data_const.COL_GROUP_RATE: group_rate,
+                auth_data_const.COL_GROUP_BURST: group_burst}
+
+    def test_token_bucket(self):
+        now = time.time()
+        bucket = auth.TokenBucket(rate=2, burst=4, now=now)
+        self.assertTrue(bucket.is_full())
+        self.assertTrue(bucket.can_take(4))
+        # more than burst is let through on a full bucket only
+        self.assertTrue(bucket.can_take(10))
+        bucket.take(10)
+        self.assertEqual(bucket.tokens, -6)
+        self.assertFalse(bucket.can_take(1))
+        # the 6 tokens over burst are paid back before the next request
+        bucket.refill(now + 3)
+        self.assertFalse(bucket.can_take(1))
+        bucket.refill(now + 3.5)
+        self.assertTrue(bucket.can_take(1))
+        bucket.refill(now + 100)
+        self.assertTrue(bucket.is_full())
+        self.assertEqual(bucket.tokens, 4)
+
+    def test_vm_limit(self):
+        limiter = auth.RequestRateLimiter()
+        rate_limits = self.rate_limits(vm_rate=1, vm_burst=2)
+        now = time.time()
+        for _ in range(2):
+            self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now), None)
+        self.assertNotEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now), None)
+        # other VMs in the group have their own bucket
+        self.assertEqual(limiter.take("vm2", "group1", "group1", rate_limits, now=now), None)
+        self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now + 1), None)
+
+    def test_group_limit(self):
+        limiter = auth.RequestRateLimiter()
+        rate_limits = self.rate_limits(group_rate=1, group_burst=2)
+        now = time.time()
+        self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now), None)
+        self.assertEqual(limiter.take("vm2", "group1", "group1", rate_limits, now=now), None)
+        self.assertNotEqual(limiter.take("vm3", "group1", "group1", rate_limits, now=now), None)
+        self.assertEqual(limiter.take("vm3", "group2", "group2", rate_limits, now=now), None)
+
+    def test_batch_cost(self):
+        limiter = auth.RequestRateLimiter()
+        rate_limits = self.rate_limits(vm_rate=1, vm_burst=5)
+        now = time.time()
+        # a batch of 20 operations is charged in full
+        self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, cost=20, now=now), None)
+        self.assertNotEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now + 10), None)
+        self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, now=now + 16), None)
+
+    def test_no_limits(self):
+        limiter = auth.RequestRateLimiter()
+        rate_limits = self.rate_limits()
+        now = time.time()
+        for _ in range(100):
+            self.assertEqual(limiter.take("vm1", "group1", "group1", rate_limits, cost=10, now=now), None)
+
 def setUpModule():
     # Let's make sure we are testing a local DB
     os.system(ADMIN_RM_LOCAL_AUTH_DB)
@@ -66,3 +66,39 @@ class OpsCounter:
         Block until the counter value decreased to 0
         '''
         return self._event.wait(timeout)
+
+
+class LatencyCounter:
+    '''
+    A thread safe accumulator of durations (in seconds), used to report
+    count, average and maximum for a stream of operations.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self._count = 0
+        self._total = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        '''
+        Add one sample
+        '''
+        with self._lock:
+            self._count += 1
+            self._total += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def snapshot(self):
+        '''
+        Return (count, average, max) of the samples recorded so far
+        '''
+        with self._lock:
+            avg = self._total / self._count if self._count else 0.0
+            return self._count, avg, self._max
+
+    def __str__(self):
+        count, avg, max_val = self.snapshot()
+        return "{0}: count={1} avg={2:.3f}s max={3:.3f}s".format(self.name, count, avg, max_val)
@@ -0,0 +1,55 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for counter.py
+
+import unittest
+import threading
+import counter
+
+
+class TestLatencyCounter(unittest.TestCase):
+    """ Test LatencyCounter accumulation """
+
+    def test_empty(self):
+        c = counter.LatencyCounter("empty")
+        self.assertEqual((0, 0.0, 0.0), c.snapshot())
+
+    def test_record(self):
+        c = counter.LatencyCounter("test")
+        for seconds in (1.0, 3.0, 2.0):
+            c.record(seconds)
+        self.assertEqual((3, 2.0, 3.0), c.snapshot())
+        self.assertEqual("test: count=3 avg=2.000s max=3.000s", str(c))
+
+    def test_concurrent_record(self):
+        c = counter.LatencyCounter("concurrent")
+
+        def record():
+            for _ in range(1000):
+                c.record(0.5)
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        count, avg, max_val = c.snapshot()
+        self.assertEqual(4000, count)
+        self.assertAlmostEqual(0.5, avg)
+        self.assertEqual(0.5, max_val)
+
+
+if __name__ == '__main__':
+    unittest.main()
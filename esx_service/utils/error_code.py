@@ -82,6 +82,11 @@ class ErrorCode:
     OPT_VOLUME_SIZE_INVALID  = 507
     # Volume option related error code end
 
+    # Request rate limit related error code start
+    REQUEST_THROTTLED = 601
+    RATE_LIMIT_INVALID = 602
+    # Request rate limit related error code end
+
 
 
 error_code_to_message = {
@@ -135,6 +140,9 @@ error_code_to_message = {
     ErrorCode.SQLITE3_ERROR: "Sqlite3 error - see log for more info",
 
     ErrorCode.OPT_VOLUME_SIZE_INVALID : "Invalid volume size specified.",
+
+    ErrorCode.REQUEST_THROTTLED : "Too many requests from VM {0} (vmgroup {1}), request throttled. Please retry later.",
+    ErrorCode.RATE_LIMIT_INVALID : "Invalid rate limit {0}={1}, a non-negative number is required",
 }
 
 class ErrorInfo:
@@ -17,10 +17,23 @@ Implements threading utilities
 Written by Bruno Moura <brunotm@gmail.com>
 """
 
+import sys
 import threading
 import logging
+import time
+import collections
+import contextlib
 from weakref import WeakValueDictionary
 
+import counter
+
+if sys.version_info.major < 3:
+    # python 2.x
+    import Queue as queue
+else:
+    # python 3.x
+    import queue
+
 class LockManager(object):
     """
     Thread safe lock manager class
@@ -58,6 +71,275 @@ class LockManager(object):
             return self._list_locks()
 
 
+class KeyedWorkerPool(object):
+    """
+    Fixed size pool of worker threads. Work items submitted with the same
+    key are always run by the same worker, so they run in submission order,
+    while items with different keys can run in parallel.
+    """
+    def __init__(self, num_workers, name="Worker"):
+        self._queues = [queue.Queue() for _ in range(num_workers)]
+        for i, work_queue in enumerate(self._queues):
+            start_new_thread(target=self._worker,
+                             args=("{0}-{1}".format(name, i), work_queue),
+                             daemon=True)
+
+    def submit(self, key, func, *args):
+        """
+        Queue func(*args) on the worker which owns key.
+        """
+        work_queue = self._queues[hash(key) % len(self._queues)]
+        work_queue.put((func, args))
+
+    def pending(self):
+        """
+        Return the (approximate) number of queued work items.
+        """
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    @staticmethod
+    def _worker(name, work_queue):
+        set_thread_name(name)
+        while True:
+            func, args = work_queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception("%s: unexpected error in work item %s: %s",
+                                  name, func.__name__, e)
+
+
+class PriorityDispatcher(object):
+    """
+    Runs submitted work items on a fixed number of worker threads. Items are
+    queued by priority class, and the next item is picked by deficit round
+    robin: in each round a class may run as many items as its share, higher
+    priority classes first. An item which has been queued for longer than
+    max_wait seconds is run before anything else, so low priority classes
+    are never starved.
+
+    Some workers may be reserved for a class: they only run items of that
+    class or of higher priority classes, so those still run when all other
+    workers are blocked by long running low priority items.
+    """
+    def __init__(self, shares, num_workers, max_wait, name="Dispatcher", reserved=None):
+        """
+        shares is a list of (class_name, share), from the highest priority
+        class to the lowest. Shares must be positive.
+        reserved is a list of (class_name, num_workers) taken out of num_workers.
+        """
+        self._classes = [class_name for class_name, _ in shares]
+        self._shares = dict(shares)
+        self._queues = dict((c, collections.deque()) for c in self._classes)
+        self._deficit = dict((c, 0) for c in self._classes)
+        self._max_wait = max_wait
+        self._cond = threading.Condition(get_lock())
+        self.wait_time = dict((c, counter.LatencyCounter("{0} queue wait".format(c)))
+                              for c in self._classes)
+        # classes each worker may run
+        worker_classes = []
+        for class_name, count in reserved or []:
+            allowed = self._classes[:self._classes.index(class_name) + 1]
+            worker_classes += [allowed] * count
+        if len(worker_classes) >= num_workers:
+            raise ValueError("{0}: {1} workers reserved out of {2}"
+                             .format(name, len(worker_classes), num_workers))
+        worker_classes += [self._classes] * (num_workers - len(worker_classes))
+        for i, classes in enumerate(worker_classes):
+            start_new_thread(target=self._worker,
+                             args=("{0}-{1}".format(name, i), classes),
+                             daemon=True)
+
+    def submit(self, class_name, func, *args):
+        """
+        Queue func(*args) in the given priority class.
+        """
+        with self._cond:
+            self._queues[class_name].append((time.time(), func, args))
+            # wake up all, workers reserved for other classes can't take it
+            self._cond.notify_all()
+
+    def pending(self, classes=None):
+        """
+        Return the number of queued work items, in the given classes if set.
+        """
+        return sum(len(self._queues[c]) for c in classes or self._classes)
+
+    def _next(self, classes):
+        """
+        Pick the next item from the given classes, called with self._cond
+        held and at least one item queued in these classes.
+        Returns (class_name, (queued, func, args)).
+        """
+        now = time.time()
+        starved = None
+        for c in classes:
+            q = self._queues[c]
+            if q and now - q[0][0] > self._max_wait:
+                if starved is None or q[0][0] < self._queues[starved][0][0]:
+                    starved = c
+        if starved:
+            return starved, self._queues[starved].popleft()
+
+        while True:
+            for c in classes:
+                if self._queues[c] and self._deficit[c] >= 1:
+                    self._deficit[c] -= 1
+                    return c, self._queues[c].popleft()
+            # New round. Idle classes don't accumulate credit.
+            for c in classes:
+                self._deficit[c] = self._deficit[c] + self._shares[c] if self._queues[c] else 0
+
+    def _worker(self, name, classes):
+        set_thread_name(name)
+        while True:
+            with self._cond:
+                while not self.pending(classes):
+                    self._cond.wait()
+                class_name, (queued, func, args) = self._next(classes)
+            self.wait_time[class_name].record(time.time() - queued)
+            try:
+                func(*args)
+            except Exception as e:
+                logging.exception("%s: unexpected error in work item %s: %s",
+                                  name, func.__name__, e)
+            set_thread_name(name)
+
+
+class KeyedSemaphore(object):
+    """
+    Limits the number of threads running concurrently per key, e.g. heavy
+    disk operations per datastore. Keeps per key running/waiting counts (see
+    stats()), total ones in the running and waiting OpsCounters, and the
+    time spent waiting.
+    """
+    def __init__(self, limit, name="KeyedSemaphore", limits=None):
+        """
+        limit is the default max number of holders per key, limits
+        an optional dict of per key overrides.
+        """
+        self._limit = limit
+        self._limits = limits or {}
+        self._name = name
+        self._lock = get_lock()
+        self._semaphores = {}
+        self._running = collections.defaultdict(int)
+        self._waiting = collections.defaultdict(int)
+        self.running = counter.OpsCounter()
+        self.waiting = counter.OpsCounter()
+        self.wait_time = counter.LatencyCounter("{0} wait".format(name))
+
+    def _get_semaphore(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.Semaphore(self._limits.get(key, self._limit))
+            return self._semaphores[key]
+
+    def stats(self):
+        """
+        Return {key: (running, waiting)}.
+        """
+        with self._lock:
+            return dict((key, (self._running[key], self._waiting[key]))
+                        for key in self._semaphores)
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        """
+        Context manager holding a slot for each of the keys. Slots are taken
+        in sorted key order, so holders of several keys can't deadlock.
+        """
+        if not keys:
+            yield
+            return
+        keys = sorted(set(keys))
+        started = time.time()
+        held = []
+        self.waiting.incr()
+        try:
+            for key in keys:
+                semaphore = self._get_semaphore(key)
+                with self._lock:
+                    self._waiting[key] += 1
+                semaphore.acquire()
+                with self._lock:
+                    self._waiting[key] -= 1
+                    self._running[key] += 1
+                held.append((key, semaphore))
+            self.waiting.decr()
+            self.running.incr()
+            waited = time.time() - started
+            self.wait_time.record(waited)
+            logging.debug("%s: waited %.3fs for %s, %s", self._name, waited, keys, self.stats())
+            yield
+        finally:
+            if len(held) == len(keys):
+                self.running.decr()
+            else:
+                self.waiting.decr()
+            for key, semaphore in reversed(held):
+                with self._lock:
+                    self._running[key] -= 1
+                semaphore.release()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls with the same key: the first caller runs the
+    function, callers arriving while it runs wait for it and get the same
+    result (or exception).
+    """
+    class _Call(object):
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = get_lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs), or share the result of the identical
+        call already in flight for key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def forget(self, match):
+        """
+        Stop handing out in-flight results for keys for which match(key)
+        is True. Callers arriving later start a new call.
+        """
+        with self._lock:
+            for key in [k for k in self._calls if match(k)]:
+                del self._calls[key]
+
+
 def get_lock_decorator(reentrant=False):
     """
     Create a locking decorator to be used in modules
@@ -0,0 +1,277 @@
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License
+
+# Tests for threadutils.py
+
+import unittest
+import threading
+import time
+import threadutils
+
+# Max time to wait for background work items in tests
+WAIT_TIMEOUT = 5
+
+
+class TestKeyedWorkerPool(unittest.TestCase):
+    """ Test KeyedWorkerPool ordering and parallelism """
+
+    def test_same_key_in_order(self):
+        pool = threadutils.KeyedWorkerPool(4, name="TestPool")
+        results = []
+        done = threading.Event()
+
+        def work(i):
+            results.append(i)
+            if i == 99:
+                done.set()
+
+        for i in range(100):
+            pool.submit("key", work, i)
+        self.assertTrue(done.wait(WAIT_TIMEOUT))
+        self.assertEqual(list(range(100)), results)
+
+    def test_keys_in_parallel(self):
+        # Integer keys hash to themselves, so 0 and 1 land on different workers
+        pool = threadutils.KeyedWorkerPool(2, name="TestPool")
+        keys = [0, 1]
+        barrier_count = []
+        both_running = threading.Event()
+        lock = threading.Lock()
+
+        def work():
+            with lock:
+                barrier_count.append(1)
+                if len(barrier_count) == 2:
+                    both_running.set()
+            both_running.wait(WAIT_TIMEOUT)
+
+        for key in keys:
+            pool.submit(key, work)
+        self.assertTrue(both_running.wait(WAIT_TIMEOUT))
+
+    def test_failing_item_does_not_stop_worker(self):
+        pool = threadutils.KeyedWorkerPool(1, name="TestPool")
+        done = threading.Event()
+
+        def fail():
+            raise ValueError("expected failure")
+
+        pool.submit("key", fail)
+        pool.submit("key", done.set)
+        self.assertTrue(done.wait(WAIT_TIMEOUT))
+
+
+class TestSingleFlight(unittest.TestCase):
+    """ Test SingleFlight call coalescing """
+
+    def start_callers(self, flight, key, func, count):
+        """ Start count threads calling flight.do(key, func), return (threads, results) """
+        results = []
+
+        def caller():
+            try:
+                results.append(flight.do(key, func))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=caller) for _ in range(count)]
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def test_concurrent_calls_share_result(self):
+        flight = threadutils.SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func():
+            calls.append(1)
+            release.wait(WAIT_TIMEOUT)
+            return "result"
+
+        threads, results = self.start_callers(flight, "key", func, 5)
+        # let all callers reach do() before the leader finishes
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join(WAIT_TIMEOUT)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["result"] * 5, results)
+
+    def test_exception_is_shared(self):
+        flight = threadutils.SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait(WAIT_TIMEOUT)
+            raise ValueError("expected failure")
+
+        threads, results = self.start_callers(flight, "key", func, 3)
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join(WAIT_TIMEOUT)
+        self.assertEqual(3, len(results))
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+    def test_sequential_calls_not_coalesced(self):
+        flight = threadutils.SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(1, flight.do("key", func))
+        self.assertEqual(2, flight.do("key", func))
+
+    def test_forget(self):
+        flight = threadutils.SingleFlight()
+        release = threading.Event()
+        started = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(WAIT_TIMEOUT)
+            return "old"
+
+        threads, results = self.start_callers(flight, "key", slow, 1)
+        self.assertTrue(started.wait(WAIT_TIMEOUT))
+        flight.forget(lambda key: key == "key")
+        # a caller arriving after forget() runs its own call
+        self.assertEqual("new", flight.do("key", lambda: "new"))
+        release.set()
+        for t in threads:
+            t.join(WAIT_TIMEOUT)
+        self.assertEqual(["old"], results)
+
+
+class TestPriorityDispatcher(unittest.TestCase):
+    """ Test PriorityDispatcher class ordering and reserved workers """
+
+    shares = [("detach", 8), ("attach", 6), ("create", 3), ("list", 1)]
+
+    def test_priority_order(self):
+        dispatcher = threadutils.PriorityDispatcher(self.shares, 1, WAIT_TIMEOUT, name="TestDispatcher")
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+        done = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(WAIT_TIMEOUT)
+
+        def record(class_name):
+            order.append(class_name)
+            if len(order) == 3:
+                done.set()
+
+        # keep the only worker busy while items of all classes are queued
+        dispatcher.submit("list", block)
+        self.assertTrue(started.wait(WAIT_TIMEOUT))
+        for class_name in ("list", "create", "detach"):
+            dispatcher.submit(class_name, record, class_name)
+        release.set()
+        self.assertTrue(done.wait(WAIT_TIMEOUT))
+        self.assertEqual(["detach", "create", "list"], order)
+
+    def test_reserved_workers(self):
+        dispatcher = threadutils.PriorityDispatcher(self.shares, 4, WAIT_TIMEOUT, name="TestDispatcher",
+                                                    reserved=[("detach", 1)])
+        release = threading.Event()
+        detached = threading.Event()
+        attached = threading.Event()
+
+        # saturate all workers which may run creates
+        for _ in range(10):
+            dispatcher.submit("create", release.wait, WAIT_TIMEOUT)
+        try:
+            time.sleep(0.2)
+            dispatcher.submit("detach", detached.set)
+            self.assertTrue(detached.wait(WAIT_TIMEOUT))
+            # attach has no reserved worker, it waits for the creates
+            dispatcher.submit("attach", attached.set)
+            self.assertFalse(attached.wait(0.2))
+        finally:
+            release.set()
+        self.assertTrue(attached.wait(WAIT_TIMEOUT))
+
+    def test_too_many_reserved(self):
+        self.assertRaises(ValueError, threadutils.PriorityDispatcher,
+                          self.shares, 2, WAIT_TIMEOUT, "TestDispatcher", [("detach", 2)])
+
+
+class TestKeyedSemaphore(unittest.TestCase):
+    """ Test KeyedSemaphore limits and counts """
+
+    def test_limit_per_key(self):
+        semaphore = threadutils.KeyedSemaphore(2, name="TestSemaphore", limits={"ds2": 1})
+        release = threading.Event()
+        holding = []
+        lock = threading.Lock()
+
+        def hold(key):
+            with semaphore.hold(key):
+                with lock:
+                    holding.append(key)
+                release.wait(WAIT_TIMEOUT)
+
+        threads = [threading.Thread(target=hold, args=(key,))
+                   for key in ("ds1", "ds1", "ds1", "ds2", "ds2")]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        try:
+            self.assertEqual({"ds1": (2, 1), "ds2": (1, 1)}, semaphore.stats())
+            self.assertEqual(3, semaphore.running.value)
+            self.assertEqual(2, semaphore.waiting.value)
+            self.assertEqual(3, len(holding))
+        finally:
+            release.set()
+        for t in threads:
+            t.join(WAIT_TIMEOUT)
+        self.assertEqual({"ds1": (0, 0), "ds2": (0, 0)}, semaphore.stats())
+        self.assertEqual(0, semaphore.running.value)
+        self.assertEqual(0, semaphore.waiting.value)
+        self.assertEqual(5, semaphore.wait_time.snapshot()[0])
+
+    def test_hold_several_keys(self):
+        semaphore = threadutils.KeyedSemaphore(1, name="TestSemaphore")
+        with semaphore.hold("ds2", "ds1", "ds1"):
+            self.assertEqual({"ds1": (1, 0), "ds2": (1, 0)}, semaphore.stats())
+            self.assertEqual(1, semaphore.running.value)
+        self.assertEqual({"ds1": (0, 0), "ds2": (0, 0)}, semaphore.stats())
+        self.assertEqual(0, semaphore.running.value)
+
+    def test_hold_no_keys(self):
+        semaphore = threadutils.KeyedSemaphore(1, name="TestSemaphore")
+        with semaphore.hold():
+            self.assertEqual({}, semaphore.stats())
+            self.assertEqual(0, semaphore.running.value)
+
+    def test_exception_releases(self):
+        semaphore = threadutils.KeyedSemaphore(1, name="TestSemaphore")
+        try:
+            with semaphore.hold("ds1"):
+                raise ValueError("expected failure")
+        except ValueError:
+            pass
+        self.assertEqual({"ds1": (0, 0)}, semaphore.stats())
+        self.assertEqual(0, semaphore.running.value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,10 +27,12 @@ import time
 import sys
 
 import threadutils
+import counter
 import log_config
 import vmdk_utils
 import vmdk_ops
 import volume_kv
+import vsan_info
 
 from pyVmomi import VmomiSupport, vim, vmodl
 # vim api version used - version11
@@ -48,8 +50,27 @@ else:
 
 VM_POWERSTATE = 'runtime.powerState'
 POWERSTATE_POWEROFF = 'poweredOff'
+DATACENTER_DATASTORES = 'datastore'
 HOSTD_RECONNECT_INTERVAL = 2 #approx time for hostd to comeup is 10-15 seconds
 HOSTD_RECONNECT_ATTEMPT = 5
+# Backoff between listener restarts after losing the hostd connection
+LISTENER_RESTART_INTERVAL = 2
+LISTENER_RESTART_MAX_INTERVAL = 60
+# A listener session which lasted this long resets the restart backoff
+LISTENER_STABLE_SECONDS = 300
+
+# Number of threads handling power off events. Events for the same VM are
+# always handled by the same thread, in the order they were received.
+LISTENER_WORKERS = 4
+# Max number of object updates returned by a single WaitForUpdatesEx call
+MAX_OBJECT_UPDATES = 100
+
+# Time between receiving an event and starting to handle it
+event_lag = counter.LatencyCounter("VMChangeListener event lag")
+# Time taken to handle an event
+event_processing = counter.LatencyCounter("VMChangeListener event processing")
+
+_worker_pool = None
 
 
 def get_propertycollector():
@@ -87,35 +108,52 @@ def get_propertycollector():
         # Retrying connection to hostd won't make this error go away. Returning.
         return None, err_msg
 
+    #  We are connected to ESX so childEntity[0] is current DC/Host
+    err_msg = create_datastore_filter(pc, si.content.rootFolder.childEntity[0])
+    if err_msg:
+        # Not fatal, cached volume lists just expire on their TTL instead
+        logging.warning("VMChangeListener: not watching datastore changes: %s", err_msg)
+
     return pc, None
 
 
 def start_vm_changelistener():
     """
-    Listen to power state changes of VMs running on current host
+    Listen to power state changes of VMs running on current host.
+    Restarts the listener with exponential backoff if hostd connection is lost.
     """
+    global _worker_pool
     threadutils.set_thread_name("VMChangeListener")
 
-    pc, error_msg = get_propertycollector()
+    if not _worker_pool:
+        _worker_pool = threadutils.KeyedWorkerPool(LISTENER_WORKERS, "VMChangeWorker")
 
-    if error_msg:
-        logging.warn("Could not start VM Listener: %s", error_msg)
-        return
+    restart_interval = LISTENER_RESTART_INTERVAL
+    while True:
+        pc, error_msg = get_propertycollector()
 
-    # listen to changes
-    ex = listen_vm_propertychange(pc)
-    # hostd is down
+        if error_msg:
+            logging.warn("Could not start VM Listener: %s", error_msg)
+            return
 
-    if isinstance(ex, RemoteDisconnected):
-        logging.error("VMChangeListener: Hostd connection error %s", str(ex))
+        # listen to changes
+        started = time.time()
+        ex = listen_vm_propertychange(pc)
+
+        # vmdkops process is exiting. Return.
+        if isinstance(ex, vmodl.fault.RequestCanceled):
+            logging.info("VMChangeListener thread exiting")
+            return
+
+        # hostd is down.
         # Need to get new SI instance, create a new property collector and property filter
         # for it. Can't use the old one due to stale authentication error.
-        start_vm_changelistener()
-
-    # vmdkops process is exiting. Return.
-    elif isinstance(ex, vmodl.fault.RequestCanceled):
-        logging.info("VMChangeListener thread exiting")
-        return
+        logging.error("VMChangeListener: Hostd connection error %s", str(ex))
+        if time.time() - started > LISTENER_STABLE_SECONDS:
+            restart_interval = LISTENER_RESTART_INTERVAL
+        logging.warn("VMChangeListener: restarting after %s seconds", restart_interval)
+        time.sleep(restart_interval)
+        restart_interval = min(restart_interval * 2, LISTENER_RESTART_MAX_INTERVAL)
 
 
 def create_vm_powerstate_filter(pc, from_node):
@@ -141,22 +179,57 @@ def create_vm_powerstate_filter(pc, from_node):
         return err_msg
 
 
+def create_datastore_filter(pc, datacenter):
+    """
+    Create a filter spec to listen to datastores being added or removed
+    """
+    filterSpec = vmodl.query.PropertyCollector.FilterSpec()
+    objSpec = vmodl.query.PropertyCollector.ObjectSpec(obj=datacenter, skip=False)
+    filterSpec.objectSet.append(objSpec)
+    propSpec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Datacenter, all=False)
+    propSpec.pathSet.append(DATACENTER_DATASTORES)
+    filterSpec.propSet.append(propSpec)
+    try:
+        pcFilter = pc.CreateFilter(filterSpec, True)
+        atexit.register(pcFilter.Destroy)
+        return None
+    except Exception as e:
+        err_msg = "Problem creating PropertyCollector filter: {}".format(str(e))
+        logging.error(err_msg)
+        return err_msg
+
+
 def listen_vm_propertychange(pc):
     """
     Waits for updates on powerstate of VMs. If powerstate is poweroff,
-    detach the dvs managed volumes attached to VM.
+    hand the VM to the worker pool to detach the dvs managed volumes attached to it.
+    Datastore changes invalidate the cached volume lists.
+    Returns the exception which stopped the listener.
     """
     logging.info("VMChangeListener thread started")
     version = ''
+    wait_options = vmodl.query.PropertyCollector.WaitOptions(maxObjectUpdates=MAX_OBJECT_UPDATES)
     while True:
         try:
-            result = pc.WaitForUpdates(version)
+            result = pc.WaitForUpdatesEx(version, wait_options)
+            # no result means the wait timed out without any updates
+            if not result:
+                continue
+            received = time.time()
             # process the updates result
             for filterSet in result.filterSet:
                 for objectSet in filterSet.objectSet:
                     if objectSet.kind != 'modify':
                         continue
                     for change in objectSet.changeSet:
+                        # datastore added to or removed from the host
+                        if change.name == DATACENTER_DATASTORES:
+                            logging.info("VMChangeListener: datastores changed")
+                            vmdk_ops.volumes_changed()
+                            vmdk_utils.invalidate_vol_path_cache()
+                            vsan_info.invalidate_vsan_datastore()
+                            continue
+
                         # if the event was powerOff for a VM, set the status of all
                         # docker volumes attached to the VM to be detached
                         if change.name != VM_POWERSTATE or change.val != POWERSTATE_POWEROFF:
@@ -168,9 +241,10 @@ def listen_vm_propertychange(pc):
                             logging.error("Could not retrieve the VM managed object.")
                             continue
 
-                        logging.info("VM poweroff change found for %s", moref.config.name)
-
-                        set_device_detached(moref)
+                        _worker_pool.submit(moref._GetMoId(), handle_vm_poweroff,
+                                            moref, received)
+            # If result is truncated, the next call returns the remaining
+            # updates right away.
             version = result.version
         # Capture hostd down exception
         except RemoteDisconnected as e:
@@ -180,14 +254,29 @@ def listen_vm_propertychange(pc):
         except vmodl.fault.RequestCanceled as e:
             return e
 
-        except vmodl.fault.ManagedObjectNotFound as e:
-            # Log this info if required by admin just in case
-            logging.info("VMChangeListener: VM was powered down and then deleted right away. Fault msg: %s", e.msg)
         except Exception as e:
             # Do we need to alert the admin? how?
             logging.error("VMChangeListener: error %s", str(e))
 
 
+def handle_vm_poweroff(vm_moref, received):
+    """
+    Run by the worker pool: detach the dvs managed volumes of a powered off VM
+    """
+    started = time.time()
+    event_lag.record(started - received)
+    try:
+        logging.info("VM poweroff change found for %s", vm_moref.config.name)
+        set_device_detached(vm_moref)
+    except vmodl.fault.ManagedObjectNotFound as e:
+        # Log this info if required by admin just in case
+        logging.info("VMChangeListener: VM was powered down and then deleted right away. Fault msg: %s", e.msg)
+    finally:
+        event_processing.record(time.time() - started)
+        logging.debug("%s; %s; pending=%d", event_lag, event_processing,
+                      _worker_pool.pending())
+
+
 def vm_folder_traversal():
     """
     Build the traversal spec for the property collector to traverse vmFolder
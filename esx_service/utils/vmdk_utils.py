@@ -74,6 +74,37 @@ lockManager = threadutils.LockManager()
 # vmdkops vib name
 VIB_NAME = "esx-vmdkops-service"
 
+# Resolved volume folders, (datastore, tenant_name) -> (tenant_id, path).
+# Only folders known to exist are kept here, see vmdk_ops.get_vol_path()
+vol_path_cache = {}
+vol_path_cache_lock = threadutils.get_lock()
+
+def get_cached_vol_path(datastore, tenant_name, tenant_id):
+    """
+    Returns the cached volume folder for (datastore, tenant_name), or None.
+    The entry is only used if it was resolved for the same tenant_id, so a
+    tenant which was removed and re-created with the same name never gets
+    the folder of the old one.
+    """
+    with vol_path_cache_lock:
+        entry = vol_path_cache.get((datastore, tenant_name))
+    if entry and entry[0] == tenant_id:
+        return entry[1]
+    return None
+
+
+def cache_vol_path(datastore, tenant_name, tenant_id, path):
+    """ Remembers an existing volume folder for (datastore, tenant_name) """
+    with vol_path_cache_lock:
+        vol_path_cache[(datastore, tenant_name)] = (tenant_id, path)
+
+
+def invalidate_vol_path_cache():
+    """ Drops all cached volume folders, e.g. on tenant or datastore changes """
+    with vol_path_cache_lock:
+        vol_path_cache.clear()
+
+
 def init_datastoreCache(force=False):
     """
     Initializes the datastore cache with the list of datastores accessible
@@ -100,6 +131,10 @@ def init_datastoreCache(force=False):
             tmp_ds.append((datastore.info.name,
                            datastore.info.url,
                            dockvols_path))
+        # Datastores may have been unmounted, renamed or re-created since
+        # the folders were resolved
+        if tmp_ds != datastores:
+            invalidate_vol_path_cache()
         datastores = tmp_ds
 
 
@@ -154,6 +189,8 @@ def get_volumes(tenant_re):
                                 'datastore': datastore})
         else:
             for root, dirs, files in os.walk(path):
+                # skip service folders, e.g. warm pools of pre-created disks
+                dirs[:] = [d for d in dirs if not d.startswith(".")]
                 # walkthough all files under docker_vol path
                 # root is the current directory which is traversing
                 #  root = /vmfs/volumes/datastore1/dockervol/tenant1_uuid
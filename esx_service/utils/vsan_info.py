@@ -23,33 +23,78 @@
 import logging
 import json
 import os.path
+import threading
+import time
 import vmdk_ops
 
 OBJTOOL = '/usr/lib/vmware/osfs/bin/objtool '
 OBJTOOL_SET_POLICY = OBJTOOL + "setPolicy -u {0} -p '{1}'"
 OBJTOOL_GET_ATTR = OBJTOOL + "getAttr -u {0} --format=json"
 
-# VSAN datastore
+# VSAN datastore lookup, cached as (datastore, name, url) or None when there
+# is no VSAN datastore. Failed lookups are not cached. The cache is dropped when datastores are added or
+# removed (see invalidate_vsan_datastore()) and after VSAN_DS_CACHE_TTL
+# seconds, for processes which don't listen to datastore changes.
+VSAN_DS_CACHE_TTL = 300
 _vsan_ds = None
+_vsan_ds_expires = 0
+_vsan_ds_lock = threading.Lock()
+
+# objtool getAttr output per VSAN object UUID, uuid -> (expires, attrs).
+# Entries are dropped when the policy of the object is set.
+OBJTOOL_ATTR_TTL = 10
+_obj_attrs = {}
+_obj_attrs_lock = threading.Lock()
+
+def get_vsan_datastore_info():
+    """Returns (datastore, name, url) for vsanDatastore, or None"""
+    global _vsan_ds, _vsan_ds_expires
+    with _vsan_ds_lock:
+        if time.time() < _vsan_ds_expires:
+            return _vsan_ds
 
-def get_vsan_datastore():
-    """Returns Datastore management object for vsanDatastore, or None"""
-    si = vmdk_ops.get_si()
-    stores = si.content.rootFolder.childEntity[0].datastore
     try:
-        return [d for d in stores if d.summary.type == "vsan"][0]
-    except:
+        si = vmdk_ops.get_si()
+        stores = si.content.rootFolder.childEntity[0].datastore
+        datastore = [d for d in stores if d.summary.type == "vsan"][0]
+        info = (datastore, datastore.info.name, datastore.info.url)
+    except IndexError:
+        # no VSAN datastore
+        info = None
+    except Exception as e:
+        # don't cache failures to talk to hostd, try again on the next call
+        logging.warning("Failed to look up VSAN datastore: %s", e)
         return None
 
+    with _vsan_ds_lock:
+        _vsan_ds = info
+        _vsan_ds_expires = time.time() + VSAN_DS_CACHE_TTL
+    return info
+
+
+def invalidate_vsan_datastore():
+    """Drop the cached VSAN datastore, e.g. after datastores were added or removed"""
+    global _vsan_ds_expires
+    with _vsan_ds_lock:
+        _vsan_ds_expires = 0
+
+
+def get_vsan_datastore():
+    """Returns Datastore management object for vsanDatastore, or None"""
+    info = get_vsan_datastore_info()
+    if info:
+        return info[0]
+    return None
+
 
 def get_vsan_dockvols_path():
     """
     Return the VSAN datastore dockvols path for a given cluster. Default to the
     first datastore for now, so we can test without VSAN.
     """
-    datastore = get_vsan_datastore()
-    if datastore:
-        path, err = vmdk_ops.get_vol_path(datastore.info.name)
+    info = get_vsan_datastore_info()
+    if info:
+        path, err = vmdk_ops.get_vol_path(info[1])
         if not err:
             return path
     else:
@@ -58,13 +103,10 @@ def get_vsan_dockvols_path():
 
 def is_on_vsan(vmdk_path):
     """Returns True if path is on VSAN datastore, False otherwise"""
-    global _vsan_ds
-    if not _vsan_ds:
-        _vsan_ds = get_vsan_datastore()
-        if not _vsan_ds:
-            return False
-    return os.path.realpath(vmdk_path).startswith(os.path.realpath(
-        _vsan_ds.info.url))
+    info = get_vsan_datastore_info()
+    if not info:
+        return False
+    return os.path.realpath(vmdk_path).startswith(os.path.realpath(info[2]))
 
 
 def set_policy(vmdk_path, policy_string):
@@ -76,6 +118,8 @@ def set_policy(vmdk_path, policy_string):
     uuid = vmdk_ops.get_vsan_uuid(vmdk_path)
     rc, out = vmdk_ops.RunCommand(OBJTOOL_SET_POLICY.format(uuid,
                                                             policy_string))
+    with _obj_attrs_lock:
+        _obj_attrs.pop(uuid, None)
     if rc != 0:
         logging.warning("Failed to set policy for %s : %s", vmdk_path, out)
         return out
@@ -96,10 +140,33 @@ def get_policy(vmdk_path):
     Returns VSAN policy string for VSAN object backing <vmdk_path>
     Throws exception if the path is not found or it is not a VSAN object
     """
-    uuid = vmdk_ops.get_vsan_uuid(vmdk_path)
+    attrs = get_object_attrs(vmdk_ops.get_vsan_uuid(vmdk_path))
+    if attrs is None:
+        logging.warning("Failed to get policy for %s", vmdk_path)
+        return None
+    policy = attrs['Policy']
+    return policy
+
+
+def get_object_attrs(uuid):
+    """
+    Returns the attributes of VSAN object <uuid> from objtool getAttr, or None
+    on error. Results are cached for OBJTOOL_ATTR_TTL seconds.
+    """
+    now = time.time()
+    with _obj_attrs_lock:
+        cached = _obj_attrs.get(uuid)
+        if cached and now < cached[0]:
+            return cached[1]
+
     rc, out = vmdk_ops.RunCommand(OBJTOOL_GET_ATTR.format(uuid))
     if rc != 0:
-        logging.warning("Failed to get policy for %s : %s", vmdk_path, out)
+        logging.warning("Failed to get attributes of VSAN object %s : %s", uuid, out)
         return None
-    policy = json.loads(out)['Policy']
-    return policy
+    attrs = json.loads(out)
+    with _obj_attrs_lock:
+        # drop expired entries so the cache doesn't grow with removed objects
+        for key in [k for k, v in _obj_attrs.items() if v[0] <= now]:
+            del _obj_attrs[key]
+        _obj_attrs[uuid] = (now + OBJTOOL_ATTR_TTL, attrs)
+    return attrs
@@ -29,6 +29,8 @@ Commands ("cmd" in request):
 		"attach"  - attach a VMDK to the requesting VM
 		"detach"  - detach a VMDK from the requesting VM (assuming it's unmounted)
 		"version" - get the ESX service version string
+		"batch"   - run a list of the above operations, one reply per operation
+		            (protocol version 3 and later)
 '''
 
 import atexit
@@ -43,6 +45,8 @@ import subprocess
 import sys
 import traceback
 import time
+import uuid
+import hashlib
 from ctypes import *
 
 from vmware import vsi
@@ -105,13 +109,21 @@ OSFS_MKDIR_CMD = "/usr/lib/vmware/osfs/bin/osfs-mkdir -n "
 
 # Defaults
 DOCK_VOLS_DIR = "dockvols"  # place in the same (with Docker VM) datastore
-MAX_JSON_SIZE = 1024 * 4  # max buf size for query json strings. Queries are limited in size
+MAX_JSON_SIZE = 1024 * 64  # max buf size for query json strings. Queries (incl. batches) are limited in size
 MAX_SKIP_COUNT = 16       # max retries on VMCI Get Ops failures
 VMDK_ADAPTER_TYPE = 'busLogic'  # default adapter type
 
 # Server side understand protocol version. If you are changing client/server protocol we use
 # over VMCI, PLEASE DO NOT FORGET TO CHANGE IT FOR CLIENT in file <esx_vmdkcmd.go> !
-SERVER_PROTOCOL_VERSION = 2
+SERVER_PROTOCOL_VERSION = 3
+# Client protocol versions accepted by the server. Version 3 adds "batch".
+SUPPORTED_PROTOCOL_VERSIONS = (2, 3)
+BATCH_MIN_PROTOCOL_VERSION = 3
+
+# Max number of operations in a "batch" request, and max number of
+# them executed in parallel
+MAX_BATCH_OPS = 64
+BATCH_PARALLELISM = 4
 
 # Error codes
 VMCI_ERROR = -1 # VMCI C code uses '-1' to indicate failures
@@ -140,12 +152,108 @@ lib = None
 # For managing resource locks.
 lockManager = threadutils.LockManager()
 
+# Identical concurrent read requests are coalesced into a single execution.
+# Keys are (cmd, tenant_uuid, full_vol_name, vm_datastore_url).
+COALESCED_CMDS = ("get", "list")
+read_flights = threadutils.SingleFlight()
+
+# Volume changing requests which are answered from the original request
+# when retried by the VM, see executeIdempotentRequest().
+# completed_replies maps (vm_uuid, cmd, full_vol_name, opts) ->
+# (expires, reply, vmdk_path, state), see get_reply_state()
+IDEMPOTENT_CMDS = ("create", "remove", "attach", "detach")
+IDEMPOTENT_REPLY_TTL = 30
+idempotent_flights = threadutils.SingleFlight()
+completed_replies = {}
+completed_replies_lock = threading.Lock()
+# vmdk_path resolved by the request running on the current thread
+request_local = threadutils.get_local_storage()
+
+# Per tenant cache of "list" replies, tenant_name -> (generation, expires, reply).
+# An entry is served while no volume was created or removed, no datastore was
+# added or removed and the auth DB was not modified since it was built.
+# The TTL covers changes made outside this service, e.g. by other ESX hosts
+# sharing a datastore.
+LIST_CACHE_TTL = 30
+list_cache = {}
+list_cache_lock = threading.Lock()
+list_generation = 0
+
 # Barrier indicating whether stop has been requested
 stopBarrier = False
 
 # Counter of operations in flight
 opsCounter = counter.OpsCounter()
 
+# Counter of requests dropped because the client deadline had passed
+expiredOpsCounter = counter.OpsCounter()
+
+# Requests are executed by REQUEST_WORKERS threads. Queued requests are
+# picked by priority class, from the highest priority to the lowest, each
+# class getting its share of the workers while other classes are busy too.
+# Detaches go first so that containers can be rescheduled quickly on node
+# drain; bulk work (clone, list) goes last. A request queued for more than
+# REQUEST_MAX_WAIT seconds is picked regardless of its class.
+# REQUEST_RESERVED_WORKERS of the workers only run attach and detach
+# requests, so these are not stuck behind creates and clones waiting for
+# disk I/O when all other workers are busy with them.
+REQUEST_CLASS_SHARES = [("detach", 8),
+                        ("attach", 6),
+                        ("get", 4),
+                        ("create", 3),  # create and remove
+                        ("clone", 2),
+                        ("list", 1)]
+REQUEST_WORKERS = 32
+REQUEST_MAX_WAIT = 5
+REQUEST_RESERVED_WORKERS = [("detach", 2),
+                            ("attach", 2)]
+request_dispatcher = None
+
+# Max number of I/O heavy disk operations (preallocated creates, copies and
+# deletes) running at the same time on a datastore. Per datastore (name)
+# overrides can be added to HEAVY_IO_LIMITS. Other operations are not limited.
+HEAVY_IO_LIMIT = 2
+HEAVY_IO_LIMITS = {}
+HEAVY_IO_DISK_FORMATS = (kv.VALID_ALLOCATION_FORMATS["zeroedthick"],
+                         kv.VALID_ALLOCATION_FORMATS["eagerzeroedthick"])
+heavy_io_limiter = threadutils.KeyedSemaphore(HEAVY_IO_LIMIT, "Heavy disk I/O", HEAVY_IO_LIMITS)
+
+# Warm pools of pre-created, detached volumes. A create matching a pool
+# (same folder, size, diskformat and vsan policy) moves a disk out of the pool
+# instead of creating one. Pools are configured in WARM_POOL_CONFIG_FILE, e.g.
+#   {"pools": [{"datastore": "vsanDatastore", "vmgroup": "_DEFAULT",
+#               "size": "10gb", "diskformat": "thin", "depth": 4}]}
+# and are topped up by a background thread every WARM_POOL_INTERVAL seconds,
+# or right after a disk was claimed. Pool disks live in WARM_POOL_DIR inside the
+# vmgroup folder, and are not accounted in the vmgroup quota until claimed.
+WARM_POOL_CONFIG_FILE = "/etc/vmware/vmdkops/warm_pool.json"
+WARM_POOL_DIR = ".warm_pool"
+WARM_POOL_INTERVAL = 60
+WARM_POOL_CREATED_BY = "warm pool"
+WARM_POOL_OPTS = (kv.SIZE, kv.DISK_ALLOCATION_FORMAT, kv.VSAN_POLICY_NAME)
+# pool disks being claimed or removed
+warm_pool_busy = set()
+warm_pool_lock = threading.Lock()
+warm_pool_wakeup = threading.Event()
+
+# Removed volumes are moved to TRASH_DIR in the datastore DOCK_VOLS_DIR, and
+# deleted there by TRASH_REAPERS background threads. A disk which fails to
+# delete stays in the trash and is retried on the next pass, every
+# TRASH_REAP_INTERVAL seconds or right after a remove. Disks are deleted in
+# parallel, also on the same datastore.
+TRASH_DIR = ".trash"
+TRASH_REAPERS = 4
+TRASH_REAP_INTERVAL = 60
+# trash disks being deleted
+trash_busy = set()
+trash_lock = threading.Lock()
+trash_wakeup = threading.Event()
+
+# Parent disks of linked clones are kept in LINKED_DIR in the datastore
+# DOCK_VOLS_DIR, and deleted with their last child.
+LINKED_DIR = ".linked"
+linked_clone_lock = threading.Lock()
+
 # Timeout setting for waiting all in-flight ops drained
 WAIT_OPS_TIMEOUT = 20
 
@@ -155,6 +263,36 @@ PCI_BUS_MASK = 31
 PCI_FUNC_BITS = 10
 PCI_FUNC_MASK = 7
 
+# Per VM cache of lowercase-keyed extraConfig and of resolved controller
+# PCI slots. Keyed by VM moref id, entries are
+# (config.changeVersion, extra_config_dict, {controller_key: [slot, bus]})
+# and are rebuilt whenever the VM config changeVersion changes.
+pci_slot_cache = {}
+pci_slot_cache_lock = threading.Lock()
+MAX_PCI_SLOT_CACHE_SIZE = 1024
+
+def volumes_changed():
+    """
+    Invalidate cached "list" replies after volumes or datastores changed.
+    """
+    global list_generation
+    with list_cache_lock:
+        list_generation += 1
+        list_cache.clear()
+
+
+def changes_volume_list(func):
+    """
+    Decorator for functions which create or remove volumes.
+    """
+    def invalidate(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            volumes_changed()
+    return invalidate
+
+
 # Run executable on ESX as needed.
 # Returns int with return value,  and a string with either stdout (on success) or  stderr (on error)
 def RunCommand(cmd):
@@ -182,6 +320,7 @@ def RunCommand(cmd):
 # returns error, or None for OK
 # opts is  dictionary of {option: value}.
 # for now we care about size and (maybe) policy
+@changes_volume_list
 def createVMDK(vmdk_path, vm_name, vol_name,
                opts={}, vm_uuid=None, tenant_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None):
     logging.info("*** createVMDK: %s opts=%s vm_name=%s vm_uuid=%s tenant_uuid=%s datastore_url=%s",
@@ -208,11 +347,36 @@ def createVMDK(vmdk_path, vm_name, vol_name,
                          vm_datastore=vm_datastore)
 
     if not kv.DISK_ALLOCATION_FORMAT in opts:
-        disk_format = kv.DEFAULT_ALLOCATION_FORMAT
         # Update opts with DISK_ALLOCATION_FORMAT for volume metadata
         opts[kv.DISK_ALLOCATION_FORMAT] = kv.DEFAULT_ALLOCATION_FORMAT
+
+    if claim_warm_vmdk(vmdk_path, vm_name, opts):
+        logging.info("Created %s from the warm pool", vmdk_path)
+    else:
+        error_info = provisionVMDK(vmdk_path, vm_name, vol_name, opts)
+        if error_info:
+            return error_info
+
+    if kv.VSAN_POLICY_NAME in opts:
+        vsan_policy.volume_added(vmdk_path, opts[kv.VSAN_POLICY_NAME])
+
+    # create succeed, insert the volume information into "volumes" table
+    if tenant_uuid:
+        vol_size_in_MB = convert.convert_to_MB(auth.get_vol_size(opts))
+        if not auth.add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_in_MB):
+            # the volume is accounted in volumes table now
+            auth.commit_quota_reservation()
     else:
-        disk_format = kv.VALID_ALLOCATION_FORMATS[opts[kv.DISK_ALLOCATION_FORMAT]]
+        logging.debug(error_code_to_message[ErrorCode.VM_NOT_BELONG_TO_TENANT].format(vm_name))
+
+
+def provisionVMDK(vmdk_path, vm_name, vol_name, opts):
+    """
+    Create the disk, apply the vsan policy and create its metadata.
+    Returns error, or None for OK.
+    """
+    disk_format = kv.VALID_ALLOCATION_FORMATS[opts.get(kv.DISK_ALLOCATION_FORMAT,
+                                                       kv.DEFAULT_ALLOCATION_FORMAT)]
 
     # VirtualDiskSpec
     vdisk_spec = vim.VirtualDiskManager.FileBackedVirtualDiskSpec()
@@ -228,11 +392,16 @@ def createVMDK(vmdk_path, vm_name, vol_name,
     volume_datastore_path = vmdk_utils.get_datastore_path(vmdk_path)
     logging.debug("volume_datastore_path=%s", volume_datastore_path)
 
-    si = get_si()
-    task = si.content.virtualDiskManager.CreateVirtualDisk(
-        name=volume_datastore_path, spec=vdisk_spec)
+    # Thin disks are cheap to create, preallocated ones are zeroed out on the datastore
+    heavy_io = []
+    if disk_format in HEAVY_IO_DISK_FORMATS:
+        heavy_io = [vmdk_utils.get_datastore_from_vmdk_path(vmdk_path)]
     try:
-        wait_for_tasks(si, [task])
+        with heavy_io_limiter.hold(*heavy_io):
+            si = get_si()
+            task = si.content.virtualDiskManager.CreateVirtualDisk(
+                name=volume_datastore_path, spec=vdisk_spec)
+            wait_for_tasks(si, [task])
     except vim.fault.VimFault as ex:
         return err("Failed to create volume: {0}".format(ex.msg))
 
@@ -261,14 +430,171 @@ def createVMDK(vmdk_path, vm_name, vol_name,
 
         return error_info
 
-    # create succeed, insert the volume information into "volumes" table
-    if tenant_uuid:
-        vol_size_in_MB = convert.convert_to_MB(auth.get_vol_size(opts))
-        auth.add_volume_to_volumes_table(tenant_uuid, datastore_url, vol_name, vol_size_in_MB)
-    else:
-        logging.debug(error_code_to_message[ErrorCode.VM_NOT_BELONG_TO_TENANT].format(vm_name))
+    return None
+
+
+def get_warm_pool_path(vol_path, opts):
+    """
+    Return the path of the warm pool for volumes created in vol_path with opts.
+    """
+    size_in_MB = convert.convert_to_MB(opts.get(kv.SIZE, kv.DEFAULT_DISK_SIZE))
+    disk_format = opts.get(kv.DISK_ALLOCATION_FORMAT, kv.DEFAULT_ALLOCATION_FORMAT)
+    pool_name = "{0}mb-{1}".format(size_in_MB, disk_format)
+    if kv.VSAN_POLICY_NAME in opts:
+        policy = opts[kv.VSAN_POLICY_NAME].encode()
+        pool_name += "-" + hashlib.sha1(policy).hexdigest()[:12]
+    return os.path.join(vol_path, WARM_POOL_DIR, pool_name)
+
+
+def claim_warm_vmdk(vmdk_path, vm_name, opts):
+    """
+    Move a disk matching opts from the warm pool to vmdk_path and make it
+    a volume created by vm_name. Returns True on success, False if the pool
+    is empty or the claim failed.
+    """
+    pool_path = get_warm_pool_path(os.path.dirname(vmdk_path), opts)
+    if not os.path.isdir(pool_path):
+        return False
+
+    vol_meta = {kv.STATUS: kv.DETACHED,
+                kv.VOL_OPTS: opts,
+                kv.CREATED: time.asctime(time.gmtime()),
+                kv.CREATED_BY: vm_name}
+    for file_name in vmdk_utils.list_vmdks(pool_path):
+        pool_vmdk_path = os.path.join(pool_path, file_name)
+        with warm_pool_lock:
+            if pool_vmdk_path in warm_pool_busy:
+                continue
+            warm_pool_busy.add(pool_vmdk_path)
+        try:
+            # Skip disks the filler has not finished (e.g. interrupted by a restart)
+            if kv.get_kv(pool_vmdk_path, kv.CREATED_BY) != WARM_POOL_CREATED_BY:
+                continue
+            si = get_si()
+            task = si.content.virtualDiskManager.MoveVirtualDisk(
+                sourceName=vmdk_utils.get_datastore_path(pool_vmdk_path),
+                destName=vmdk_utils.get_datastore_path(vmdk_path),
+                force=False)
+            try:
+                wait_for_tasks(si, [task])
+            except vim.fault.VimFault as ex:
+                logging.warning("Failed to claim %s from the warm pool: %s", pool_vmdk_path, ex.msg)
+                continue
+        finally:
+            with warm_pool_lock:
+                warm_pool_busy.discard(pool_vmdk_path)
+
+        warm_pool_wakeup.set()
+        if kv.setAll(vmdk_path, vol_meta):
+            return True
+        logging.warning("Failed to update metadata for %s claimed from the warm pool", vmdk_path)
+        clean_err = cleanVMDK(vmdk_path=vmdk_path)
+        if clean_err:
+            logging.warning("Failed to clean %s file: %s", vmdk_path, clean_err)
+        return False
+    return False
+
+
+def load_warm_pool_config(config_file=WARM_POOL_CONFIG_FILE):
+    """
+    Return the list of configured warm pools, empty if there is no config file.
+    """
+    if not os.path.isfile(config_file):
+        return []
+    try:
+        with open(config_file) as f:
+            return json.load(f)["pools"]
+    except (IOError, ValueError, KeyError) as e:
+        logging.warning("Failed to load warm pool config %s: %s", config_file, e)
+        return []
 
 
+def fill_warm_pool(pool):
+    """
+    Create (or remove) disks until the pool has the configured depth.
+    """
+    opts = dict((key, pool[key]) for key in WARM_POOL_OPTS if key in pool)
+    datastore = pool.get("datastore")
+    depth = int(pool.get("depth", 0))
+    if not vmdk_utils.validate_datastore(datastore):
+        logging.warning("Warm pool %s: unknown datastore %s", pool, datastore)
+        return
+    vol_path, error_info = get_vol_path(datastore, pool.get("vmgroup"))
+    if error_info:
+        logging.warning("Warm pool %s: %s", pool, error_info)
+        return
+    try:
+        validate_opts(opts, vol_path)
+    except ValidationError as e:
+        logging.warning("Warm pool %s: %s", pool, e.msg)
+        return
+
+    pool_path = get_warm_pool_path(vol_path, opts)
+    if not os.path.isdir(pool_path):
+        os.makedirs(pool_path)
+    with warm_pool_lock:
+        disks = [os.path.join(pool_path, f) for f in vmdk_utils.list_vmdks(pool_path)
+                 if os.path.join(pool_path, f) not in warm_pool_busy]
+
+    for pool_vmdk_path in disks[depth:]:
+        with warm_pool_lock:
+            if pool_vmdk_path in warm_pool_busy:
+                continue
+            warm_pool_busy.add(pool_vmdk_path)
+        try:
+            clean_err = cleanVMDK(vmdk_path=pool_vmdk_path)
+            if clean_err:
+                logging.warning("Failed to clean %s file: %s", pool_vmdk_path, clean_err)
+        finally:
+            with warm_pool_lock:
+                warm_pool_busy.discard(pool_vmdk_path)
+
+    for _ in range(depth - len(disks)):
+        vol_name = uuid.uuid4().hex
+        error_info = provisionVMDK(vmdk_path=os.path.join(pool_path, vol_name + ".vmdk"),
+                                   vm_name=WARM_POOL_CREATED_BY,
+                                   vol_name=vol_name,
+                                   opts=dict(opts))
+        if error_info:
+            logging.warning("Warm pool %s: %s", pool, error_info)
+            return
+
+
+def remove_warm_pools(vol_path):
+    """
+    Remove all warm pool disks of the volume folder vol_path, e.g. when its
+    vmgroup is removed. Returns error, or None for OK.
+    """
+    warm_pool_path = os.path.join(vol_path, WARM_POOL_DIR)
+    if not os.path.isdir(warm_pool_path):
+        return None
+    for pool_name in os.listdir(warm_pool_path):
+        pool_path = os.path.join(warm_pool_path, pool_name)
+        for file_name in vmdk_utils.list_vmdks(pool_path):
+            clean_err = cleanVMDK(vmdk_path=os.path.join(pool_path, file_name))
+            if clean_err:
+                return clean_err
+        os.rmdir(pool_path)
+    os.rmdir(warm_pool_path)
+    return None
+
+
+def warm_pool_filler():
+    """
+    Keep the configured warm pools at their depth.
+    """
+    threadutils.set_thread_name("WarmPoolFiller")
+    while True:
+        for pool in load_warm_pool_config():
+            try:
+                fill_warm_pool(pool)
+            except Exception as e:
+                logging.exception("Failed to fill warm pool %s: %s", pool, e)
+        warm_pool_wakeup.wait(WARM_POOL_INTERVAL)
+        warm_pool_wakeup.clear()
+
+
+@changes_volume_list
 def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_datastore_url=None, vm_datastore=None):
     logging.info("*** cloneVMDK: %s opts = %s vm_uuid=%s datastore_url=%s vm_datastore_url=%s vm_datastore=%s",
                  vmdk_path, opts, vm_uuid, datastore_url, vm_datastore_url, vm_datastore)
@@ -354,19 +680,29 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
         vdisk_spec.adapterType = VMDK_ADAPTER_TYPE
         vdisk_spec.diskType = disk_format
 
-        # Clone volume
-        si = get_si()
-        task = si.content.virtualDiskManager.CopyVirtualDisk(
-            sourceName=source_vol, destName=dest_vol, destSpec=vdisk_spec)
-        try:
-            wait_for_tasks(si, [task])
-        except vim.fault.VimFault as ex:
-            return err("Failed to clone volume: {0}".format(ex.msg))
+        linked = opts.get(kv.CLONE_MODE) == kv.CLONE_MODE_LINKED
+        if linked:
+            if attached:
+                return err("Cannot create a linked clone of volume {0}, it is in use by VM {1}"
+                           .format(src_volume, attached_vm_name))
+            error_info = linkedCloneVMDK(src_vmdk_path, vmdk_path)
+            if error_info:
+                return error_info
+        else:
+            # Clone volume, reading from the source and writing to the destination datastore
+            try:
+                with heavy_io_limiter.hold(src_datastore, datastore):
+                    si = get_si()
+                    task = si.content.virtualDiskManager.CopyVirtualDisk(
+                        sourceName=source_vol, destName=dest_vol, destSpec=vdisk_spec)
+                    wait_for_tasks(si, [task])
+            except vim.fault.VimFault as ex:
+                return err("Failed to clone volume: {0}".format(ex.msg))
 
     vol_name = vmdk_utils.strip_vmdk_extension(src_vmdk_path.split("/")[-1])
 
-    # Fix up the KV for the destination
-    if not kv.fixup_kv(src_vmdk_path, vmdk_path):
+    # Fix up the KV for the destination (linked clones get theirs from linkedCloneVMDK)
+    if not linked and not kv.fixup_kv(src_vmdk_path, vmdk_path):
         msg = ("Failed to create volume KV for %s" % vol_name)
         logging.warning(msg)
         error_info = err(msg)
@@ -380,6 +716,7 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
 
     # Handle vsan policy
     if kv.VSAN_POLICY_NAME in opts:
+        parent_path = kv.get_kv(vmdk_path, kv.LINKED_PARENT) if linked else None
         # Attempt to set policy to vmdk
         # set_policy_to_vmdk() deleted vmdk if couldn't set policy
         set_err = set_policy_to_vmdk(vmdk_path=vmdk_path,
@@ -387,6 +724,9 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
                                      vol_name=vol_name)
 
         if set_err:
+            # the linked clone was deleted, drop its reference to the parent
+            if parent_path and not os.path.isfile(vmdk_path):
+                release_linked_parent(parent_path)
             return set_err
 
     # Update volume meta
@@ -395,6 +735,8 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
     vol_meta[kv.CREATED] = time.asctime(time.gmtime())
     vol_meta[kv.VOL_OPTS][kv.CLONE_FROM] = src_volume
     vol_meta[kv.VOL_OPTS][kv.DISK_ALLOCATION_FORMAT] = opts[kv.DISK_ALLOCATION_FORMAT]
+    if kv.CLONE_MODE in opts:
+        vol_meta[kv.VOL_OPTS][kv.CLONE_MODE] = opts[kv.CLONE_MODE]
     if kv.ACCESS in opts:
         vol_meta[kv.VOL_OPTS][kv.ACCESS] = opts[kv.ACCESS]
     if kv.ATTACH_AS in opts:
@@ -406,6 +748,115 @@ def cloneVMDK(vm_name, vmdk_path, opts={}, vm_uuid=None, datastore_url=None, vm_
         removeVMDK(vmdk_path)
         return err(msg)
 
+    if kv.VSAN_POLICY_NAME in vol_meta[kv.VOL_OPTS]:
+        vsan_policy.volume_added(vmdk_path, vol_meta[kv.VOL_OPTS][kv.VSAN_POLICY_NAME])
+
+    # clone succeed, insert the volume information into "volumes" table
+    if tenant_uuid:
+        dest_vol_name = vmdk_utils.strip_vmdk_extension(os.path.basename(vmdk_path))
+        vol_size_in_MB = convert.convert_to_MB(auth.get_vol_size(opts))
+        if not auth.add_volume_to_volumes_table(tenant_uuid, datastore_url, dest_vol_name, vol_size_in_MB):
+            # the volume is accounted in volumes table now
+            auth.commit_quota_reservation()
+
+def linkedCloneVMDK(src_vmdk_path, vmdk_path):
+    """
+    Create vmdk_path as a linked clone of the detached volume src_vmdk_path.
+    The source disk is moved to LINKED_DIR, where it becomes a read-only
+    parent, and both volumes are recreated as its children, so this takes
+    the same time whatever the volume size.
+    Called with the source volume lock held. Returns error, or None for OK.
+    """
+    datastore = vmdk_utils.get_datastore_from_vmdk_path(src_vmdk_path)
+    if vmdk_utils.get_datastore_from_vmdk_path(vmdk_path) != datastore:
+        return err("A linked clone must be on the datastore of its source volume ({0})".format(datastore))
+    linked_path, error_info = get_service_dir(datastore, LINKED_DIR)
+    if error_info:
+        return error_info
+
+    parent_path = os.path.join(linked_path, uuid.uuid4().hex + ".vmdk")
+    logging.info("*** linkedCloneVMDK: %s -> %s, parent %s", src_vmdk_path, vmdk_path, parent_path)
+    src_meta = kv.getAll(src_vmdk_path)
+    si = get_si()
+    vdm = si.content.virtualDiskManager
+    try:
+        task = vdm.MoveVirtualDisk(sourceName=vmdk_utils.get_datastore_path(src_vmdk_path),
+                                   destName=vmdk_utils.get_datastore_path(parent_path),
+                                   force=False)
+        wait_for_tasks(si, [task])
+    except vim.fault.VimFault as ex:
+        return err("Failed to clone volume: {0}".format(ex.msg))
+
+    def restore_source(children):
+        """ Delete the children created so far and put the source volume back. """
+        try:
+            for child_path in children:
+                task = vdm.DeleteVirtualDisk(name=vmdk_utils.get_datastore_path(child_path))
+                wait_for_tasks(si, [task])
+            task = vdm.MoveVirtualDisk(sourceName=vmdk_utils.get_datastore_path(parent_path),
+                                       destName=vmdk_utils.get_datastore_path(src_vmdk_path),
+                                       force=False)
+            wait_for_tasks(si, [task])
+        except vim.fault.VimFault as restore_ex:
+            logging.error("Failed to restore volume %s from %s: %s",
+                          src_vmdk_path, parent_path, restore_ex.msg)
+            return
+        # the parent metadata may have been updated already
+        if not kv.setAll(src_vmdk_path, src_meta):
+            logging.error("Failed to restore metadata of volume %s", src_vmdk_path)
+
+    children = []
+    try:
+        for child_path in (src_vmdk_path, vmdk_path):
+            task = vdm.CreateChildDisk(childName=vmdk_utils.get_datastore_path(child_path),
+                                       parentName=vmdk_utils.get_datastore_path(parent_path),
+                                       isLinkedClone=True)
+            wait_for_tasks(si, [task])
+            children.append(child_path)
+    except vim.fault.VimFault as ex:
+        logging.warning("Failed to create child disk of %s: %s", parent_path, ex.msg)
+        restore_source(children)
+        return err("Failed to clone volume: {0}".format(ex.msg))
+
+    # The parent keeps the source metadata (and its own parent, if any)
+    parent_meta = dict(src_meta)
+    parent_meta[kv.LINKED_CHILDREN] = len(children)
+    child_meta = dict(src_meta)
+    child_meta[kv.LINKED_PARENT] = parent_path
+    if not (kv.setAll(parent_path, parent_meta) and
+            kv.create(src_vmdk_path, child_meta) and
+            kv.create(vmdk_path, child_meta)):
+        msg = "Failed to create linked clone metadata for {0}".format(vmdk_path)
+        logging.error(msg)
+        restore_source(children)
+        return err(msg)
+    return None
+
+
+def release_linked_parent(parent_path):
+    """
+    Drop a child reference to the linked clone parent disk parent_path,
+    and delete it with the last one.
+    """
+    with linked_clone_lock:
+        parent_meta = kv.getAll(parent_path)
+        if not parent_meta:
+            logging.warning("Linked clone parent %s has no metadata, not deleting it", parent_path)
+            return
+        children = parent_meta.get(kv.LINKED_CHILDREN, 1) - 1
+        if children > 0:
+            parent_meta[kv.LINKED_CHILDREN] = children
+            kv.setAll(parent_path, parent_meta)
+            return
+        clean_err = cleanVMDK(vmdk_path=parent_path)
+        if clean_err:
+            logging.warning("Failed to clean linked clone parent %s: %s", parent_path, clean_err)
+            return
+
+    if kv.LINKED_PARENT in parent_meta:
+        release_linked_parent(parent_meta[kv.LINKED_PARENT])
+
+
 def create_kv_store(vm_name, vmdk_path, opts):
     """ Create the metadata kv store for a volume """
     vol_meta = {kv.STATUS: kv.DETACHED,
@@ -423,10 +874,11 @@ def validate_opts(opts, vmdk_path):
      * diskformat - The allocation format of allocated disk
     """
     valid_opts = [kv.SIZE, kv.VSAN_POLICY_NAME, kv.DISK_ALLOCATION_FORMAT,
-                  kv.ATTACH_AS, kv.ACCESS, kv.FILESYSTEM_TYPE, kv.CLONE_FROM]
+                  kv.ATTACH_AS, kv.ACCESS, kv.FILESYSTEM_TYPE, kv.CLONE_FROM, kv.CLONE_MODE]
     defaults = [kv.DEFAULT_DISK_SIZE, kv.DEFAULT_VSAN_POLICY,\
                 kv.DEFAULT_ALLOCATION_FORMAT, kv.DEFAULT_ATTACH_AS,\
-                kv.DEFAULT_ACCESS, kv.DEFAULT_FILESYSTEM_TYPE, kv.DEFAULT_CLONE_FROM]
+                kv.DEFAULT_ACCESS, kv.DEFAULT_FILESYSTEM_TYPE, kv.DEFAULT_CLONE_FROM,
+                kv.DEFAULT_CLONE_MODE]
     invalid = frozenset(opts.keys()).difference(valid_opts)
     if len(invalid) != 0:
         msg = 'Invalid options: {0} \n'.format(list(invalid)) \
@@ -449,6 +901,8 @@ def validate_opts(opts, vmdk_path):
         validate_access(opts[kv.ACCESS])
     if kv.FILESYSTEM_TYPE in opts:
         validate_fstype(opts[kv.FILESYSTEM_TYPE], clone)
+    if kv.CLONE_MODE in opts:
+        validate_clone_mode(opts[kv.CLONE_MODE], clone, kv.DISK_ALLOCATION_FORMAT in opts)
 
 
 def validate_size(size, clone=False):
@@ -541,6 +995,20 @@ def validate_fstype(fstype, clone=False):
     if clone:
         raise ValidationError("Cannot define the filesystem type for a clone")
 
+def validate_clone_mode(clone_mode, clone=False, disk_format=False):
+    """
+    Ensure clone mode is valid, and is only given for a clone
+    """
+    if not clone:
+        raise ValidationError("Clone mode can only be defined for a clone")
+
+    if not clone_mode in kv.CLONE_MODES:
+        raise ValidationError("Clone mode \'{0}\' is not supported."
+                              " Valid options are: {1}.".format(clone_mode, kv.CLONE_MODES))
+
+    if clone_mode == kv.CLONE_MODE_LINKED and disk_format:
+        raise ValidationError("Cannot define the disk format for a linked clone")
+
 # Returns the UUID if the vmdk_path is for a VSAN backed.
 def get_vsan_uuid(vmdk_path):
     f = open(vmdk_path)
@@ -616,16 +1084,18 @@ def cleanVMDK(vmdk_path, vol_name=None):
 
     # Form datastore path from vmdk_path
     volume_datastore_path = vmdk_utils.get_datastore_path(vmdk_path)
+    datastore = vmdk_utils.get_datastore_from_vmdk_path(vmdk_path)
 
     retry_count = 0
     vol_meta = kv.getAll(vmdk_path)
     kv.delete(vmdk_path)
     while True:
-        si = get_si()
-        task = si.content.virtualDiskManager.DeleteVirtualDisk(name=volume_datastore_path)
         try:
             # Wait for delete, exit loop on success
-            wait_for_tasks(si, [task])
+            with heavy_io_limiter.hold(datastore):
+                si = get_si()
+                task = si.content.virtualDiskManager.DeleteVirtualDisk(name=volume_datastore_path)
+                wait_for_tasks(si, [task])
             break
         except vim.fault.FileNotFound as ex:
             logging.warning("*** removeVMDK: File not found error: %s", ex.msg)
@@ -642,12 +1112,101 @@ def cleanVMDK(vmdk_path, vol_name=None):
 
     return None
 
+def get_service_dir(datastore, dir_name):
+    """
+    Return (path, error) for the service folder dir_name (e.g. TRASH_DIR)
+    in DOCK_VOLS_DIR on datastore, creating it if needed.
+    """
+    path = os.path.join("/vmfs/volumes", datastore, DOCK_VOLS_DIR, dir_name)
+    if not os.path.isdir(path):
+        try:
+            os.mkdir(path)
+        except OSError as ex:
+            if not os.path.isdir(path):
+                return None, err("Failed to create {0}: {1}".format(path, ex))
+    return path, None
+
+
+def trashVMDK(vmdk_path):
+    """
+    Move the disk (with its metadata) to the trash folder of its datastore,
+    to be deleted by the trash reaper. Returns error, or None for OK.
+    """
+    datastore = vmdk_utils.get_datastore_from_vmdk_path(vmdk_path)
+    trash_path, error_info = get_service_dir(datastore, TRASH_DIR)
+    if error_info:
+        return error_info
+
+    trash_vmdk_path = os.path.join(trash_path, uuid.uuid4().hex + ".vmdk")
+    logging.info("*** trashVMDK: %s -> %s", vmdk_path, trash_vmdk_path)
+    si = get_si()
+    task = si.content.virtualDiskManager.MoveVirtualDisk(
+        sourceName=vmdk_utils.get_datastore_path(vmdk_path),
+        destName=vmdk_utils.get_datastore_path(trash_vmdk_path),
+        force=False)
+    try:
+        wait_for_tasks(si, [task])
+    except vim.fault.VimFault as ex:
+        return err("Failed to move volume to trash: {0}".format(ex.msg))
+
+    trash_wakeup.set()
+    return None
+
+
+def reap_trash(reapers):
+    """
+    Queue deletion of the disks in the trash folders of all datastores.
+    """
+    for (datastore, url, path) in vmdk_utils.get_datastores():
+        trash_path = os.path.join(path, TRASH_DIR)
+        for file_name in vmdk_utils.list_vmdks(trash_path):
+            vmdk_path = os.path.join(trash_path, file_name)
+            with trash_lock:
+                if vmdk_path in trash_busy:
+                    continue
+                trash_busy.add(vmdk_path)
+            # keyed by disk, so disks on the same datastore are deleted in parallel
+            reapers.submit(vmdk_path, reap_vmdk, vmdk_path)
+
+
+def reap_vmdk(vmdk_path):
+    """
+    Delete a disk from the trash.
+    """
+    try:
+        clean_err = cleanVMDK(vmdk_path=vmdk_path,
+                              vol_name=vmdk_utils.strip_vmdk_extension(os.path.basename(vmdk_path)))
+        if clean_err:
+            logging.warning("Failed to delete %s from trash, will retry: %s", vmdk_path, clean_err)
+    finally:
+        with trash_lock:
+            trash_busy.discard(vmdk_path)
+
+
+def trash_reaper():
+    """
+    Delete removed volumes in the background. The first pass picks up disks
+    left in the trash by a previous run of the service.
+    """
+    threadutils.set_thread_name("TrashReaper")
+    reapers = threadutils.KeyedWorkerPool(TRASH_REAPERS, name="TrashReaper")
+    while True:
+        try:
+            reap_trash(reapers)
+        except Exception as e:
+            logging.exception("Failed to reap trash: %s", e)
+        trash_wakeup.wait(TRASH_REAP_INTERVAL)
+        trash_wakeup.clear()
+
+
 # Return error, or None for OK
+@changes_volume_list
 def removeVMDK(vmdk_path, vol_name=None, vm_name=None, tenant_uuid=None, datastore_url=None):
     """
     Checks the status of the vmdk file using its meta file
-    If it is not attached, then cleans(deletes) the vmdk file.
-    If clean is successful, delete the volume from volume table
+    If it is not attached, then moves the vmdk file to the trash (or cleans
+    (deletes) it if that fails).
+    If this is successful, delete the volume from volume table
     """
     logging.info("*** removeVMDK: %s", vmdk_path)
 
@@ -660,12 +1219,28 @@ def removeVMDK(vmdk_path, vol_name=None, vm_name=None, tenant_uuid=None, datasto
                       vmdk_path, vol_name, attached_vm_name, kv_uuid)
         return err("Failed to remove volume {0}, in use by VM = {1}.".format(vol_name, attached_vm_name))
 
-    # Cleaning .vmdk file
-    clean_err = cleanVMDK(vmdk_path, vol_name)
+    # Cleaning .vmdk file, in the background if possible. Linked clones are
+    # small child disks, they are deleted right away so that their parent
+    # can be released.
+    linked_parent = kv.get_kv(vmdk_path, kv.LINKED_PARENT)
+    if linked_parent:
+        clean_err = cleanVMDK(vmdk_path, vol_name)
+    else:
+        clean_err = trashVMDK(vmdk_path)
+        if clean_err:
+            logging.warning("Failed to move %s to trash, deleting it: %s", vmdk_path, clean_err)
+            clean_err = cleanVMDK(vmdk_path, vol_name)
     if clean_err:
         logging.warning("Failed to clean %s file: %s", vmdk_path, clean_err)
         return clean_err
 
+    if linked_parent:
+        release_linked_parent(linked_parent)
+    vsan_policy.volume_removed(vmdk_path)
+
+    # A "create" for this name must not be answered from an earlier one anymore
+    forget_completed_replies(vmdk_utils.strip_vmdk_extension(os.path.basename(vmdk_path)))
+
     # clean succeeded, remove infomation of this volume from volumes table
     if tenant_uuid:
         error_info = auth.remove_volume_from_volumes_table(tenant_uuid, datastore_url, vol_name)
@@ -701,13 +1276,27 @@ def listVMDK(tenant):
     Returns a list of volume names (note: may be an empty list).
     Each volume name is returned as either `volume@datastore`, or just `volume`
     for volumes on vm_datastore
+    Replies are cached per tenant, see list_cache.
     """
+    with list_cache_lock:
+        generation = (list_generation, auth.auth_cache.generation())
+        entry = list_cache.get(tenant)
+    if entry and entry[0] == generation and time.time() < entry[1]:
+        logging.debug("listVMDK: returning cached list for tenant %s", tenant)
+        return entry[2]
+
     vmdk_utils.init_datastoreCache(force=True)
     vmdks = vmdk_utils.get_volumes(tenant)
     # build  fully qualified vol name for each volume found
-    return [{u'Name': get_full_vol_name(x['filename'], x['datastore']),
-             u'Attributes': {}} \
-            for x in vmdks]
+    result = [{u'Name': get_full_vol_name(x['filename'], x['datastore']),
+               u'Attributes': {}} \
+              for x in vmdks]
+
+    with list_cache_lock:
+        # Don't cache the result if anything changed while it was built
+        if generation[0] == list_generation:
+            list_cache[tenant] = (generation, time.time() + LIST_CACHE_TTL, result)
+    return result
 
 
 
@@ -795,21 +1384,32 @@ def get_vol_path(datastore, tenant_name=None, create=True):
     readable_path = path = dock_vol_path = os.path.join("/vmfs/volumes", datastore, DOCK_VOLS_DIR)
 
     if tenant_name:
-        error_info, tenant = auth_api.get_tenant_from_db(tenant_name)
-        if error_info:
+        error_info, tenant_id = auth_api.get_tenant_id_from_db(tenant_name)
+        if error_info or not tenant_id:
             logging.error("get_vol_path: failed to find tenant info for tenant %s", tenant_name)
-            path = dock_vol_path
-        path = os.path.join(dock_vol_path, tenant.id)
+            errMsg = error_code_to_message[ErrorCode.TENANT_NOT_EXIST].format(tenant_name)
+            return None, err(errMsg)
+        path = os.path.join(dock_vol_path, tenant_id)
         readable_path = os.path.join(dock_vol_path, tenant_name)
+    else:
+        tenant_id = None
+
+    # Folders which were already found (or created) are not probed again.
+    # tenant_id comes from the auth cache, so this costs no DB queries either.
+    cached_path = vmdk_utils.get_cached_vol_path(datastore, tenant_name, tenant_id)
+    if cached_path:
+        return cached_path, None
 
     if os.path.isdir(path):
         # If the readable_path exists then return, else return path with no symlinks
         if os.path.exists(readable_path):
             logging.debug("Found %s, returning", readable_path)
+            vmdk_utils.cache_vol_path(datastore, tenant_name, tenant_id, readable_path)
             return readable_path, None
         else:
             logging.warning("Internal: Tenant name symlink not found for path %s", readable_path)
             logging.debug("Found %s, returning", path)
+            vmdk_utils.cache_vol_path(datastore, tenant_name, tenant_id, path)
             return path, None
 
     if not create:
@@ -844,6 +1444,7 @@ def get_vol_path(datastore, tenant_name=None, create=True):
             logging.info("Symlink %s is created to point to path %s", symlink_path, path)
 
     logging.info("Created %s", path)
+    vmdk_utils.cache_vol_path(datastore, tenant_name, tenant_id, readable_path)
     return readable_path, None
 
 def parse_vol_name(full_vol_name):
@@ -989,7 +1590,8 @@ def authorize_check(vm_uuid, datastore_url, datastore, cmd, opts, use_default_ds
 
 
 # gets the requests, calculates path for volumes, and calls the relevant handler
-def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None):
+@auth.releases_quota_reservation
+def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None, deadline=None):
     """
     Executes a <cmd> request issused from a VM.
     The request is about volume <full_volume_name> in format volume@datastore.
@@ -999,8 +1601,225 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     For VM, the function gets vm_uuid, vm_name and config_path
     <opts> is a json options string blindly passed to a specific operation
 
+    Identical "get" and "list" requests from VMs of the same tenant which
+    arrive while one is executing share its result.
+    Retries of volume changing requests get the reply of the original
+    request, see executeIdempotentRequest().
+    <deadline> is the time (as in time.time()) after which the client is no
+    longer waiting for the reply, or None. Such requests are dropped before
+    taking the volume lock and before starting any vim task.
+
     Returns None (if all OK) or error string
     """
+    error_info, tenant_uuid, _ = auth.get_tenant(vm_uuid)
+    if error_info or not tenant_uuid:
+        # VMs without a tenant only get an empty list or a forced detach,
+        # neither is worth coalescing
+        return executeRequestForTenant(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid, deadline)
+
+    if cmd in COALESCED_CMDS:
+        # The shared call runs without a deadline, as it answers callers with
+        # different deadlines. Expired callers neither start nor join it.
+        expired = check_deadline(deadline, cmd, full_vol_name)
+        if expired:
+            return expired
+        vm_datastore_url = vmdk_utils.get_datastore_url_from_config_path(config_path)
+        key = (cmd, tenant_uuid, full_vol_name, vm_datastore_url)
+        return read_flights.do(key, executeRequestForTenant,
+                               vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid)
+
+    try:
+        if cmd in IDEMPOTENT_CMDS:
+            return executeIdempotentRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid, deadline)
+        return executeRequestForTenant(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid, deadline)
+    finally:
+        # Reads of this tenant which started before the change completed may
+        # return stale data, so later requests must not join them.
+        read_flights.forget(lambda key: key[1] == tenant_uuid)
+
+
+def executeIdempotentRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None, deadline=None):
+    """
+    Executes a volume changing request unless it is a retry from the VM
+    (e.g. plugin VMCI retries, see issue #1076). A retry which arrives while
+    the original request is running waits for it and gets its reply, a retry
+    arriving within IDEMPOTENT_REPLY_TTL seconds after a successful completion
+    gets the stored reply, unless the volume changed since (see get_reply_state).
+    Failures are not stored, so they can be retried.
+    A failure of a request whose deadline has passed is not handed to a retry
+    which still has time left, the retry runs the request again instead.
+    """
+    key = (vm_uuid, cmd, full_vol_name, json.dumps(opts, sort_keys=True))
+    with completed_replies_lock:
+        entry = completed_replies.get(key)
+    if entry and time.time() < entry[0]:
+        if get_reply_state(cmd, entry[2]) == entry[3]:
+            logging.info("executeRequest: '%s' for %s is a retry, returning earlier reply",
+                         cmd, full_vol_name)
+            return entry[1]
+        # e.g. the volume was removed or detached by the admin CLI
+        logging.info("executeRequest: '%s' for %s is a retry, but the volume changed since, "
+                     "running it again", cmd, full_vol_name)
+        with completed_replies_lock:
+            if completed_replies.get(key) is entry:
+                del completed_replies[key]
+
+    while True:
+        reply, flight_deadline = idempotent_flights.do(key, executeAndRememberRequest, key,
+                                                       vm_uuid, vm_name, config_path, cmd,
+                                                       full_vol_name, opts, vc_uuid, deadline)
+        now = time.time()
+        failed = isinstance(reply, dict) and u'Error' in reply
+        if not failed or flight_deadline is None or now < flight_deadline:
+            return reply
+        if deadline is not None and now >= deadline:
+            return reply
+        logging.info("executeRequest: '%s' for %s joined a request which expired, running it again",
+                     cmd, full_vol_name)
+
+
+def executeAndRememberRequest(key, vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid, deadline):
+    """
+    Executes the request and stores a successful reply under key.
+    Any stored reply for the same volume is dropped first: after e.g.
+    "remove", a new "create" must not be answered from the old one.
+    Returns (reply, deadline), so callers sharing the reply can tell
+    whether it failed because the deadline of this request passed.
+    """
+    forget_completed_replies(full_vol_name.split("@")[0])
+    request_local.vmdk_path = None
+    reply = executeRequestForTenant(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid, deadline)
+    if not (isinstance(reply, dict) and u'Error' in reply):
+        vmdk_path = request_local.vmdk_path
+        state = get_reply_state(cmd, vmdk_path)
+        with completed_replies_lock:
+            completed_replies[key] = (time.time() + IDEMPOTENT_REPLY_TTL, reply, vmdk_path, state)
+    return reply, deadline
+
+
+def get_reply_state(cmd, vmdk_path):
+    """
+    Returns the state of the volume which a stored reply to cmd relies on:
+    whether the vmdk exists for "create", the VM it is attached to for
+    "attach", None for other commands. A stored reply is only returned
+    while the state is the same as when it was stored.
+    """
+    if not vmdk_path:
+        return None
+    if cmd == "create":
+        return os.path.isfile(vmdk_path)
+    if cmd == "attach":
+        vol_meta = kv.getAll(vmdk_path)
+        if vol_meta and vol_meta.get(kv.STATUS) == kv.ATTACHED:
+            return vol_meta.get(kv.ATTACHED_VM_UUID)
+    return None
+
+
+def executeBatchRequest(vm_uuid, vm_name, config_path, ops, vc_uuid=None, deadline=None,
+                        protocol_version=SERVER_PROTOCOL_VERSION):
+    """
+    Executes a "batch" request: a list of operations, each one in the format
+    of a single request, i.e. {"cmd": cmd, "details": {"Name": name, "Opts": opts}}.
+    The VM identity is resolved once for the whole batch, tenant and privileges
+    come from the auth cache after the first operation.
+    Operations on the same volume run one after another in the given order,
+    operations on different volumes run in parallel, up to BATCH_PARALLELISM
+    at a time.
+
+    Returns {"Results": [reply, ...]} with a reply per operation, or error string
+    """
+    if protocol_version < BATCH_MIN_PROTOCOL_VERSION:
+        return err("Command 'batch' requires protocol version {} or later"
+                   .format(BATCH_MIN_PROTOCOL_VERSION))
+    if not isinstance(ops, list) or not ops:
+        return err("Batch request must contain a non-empty 'Ops' list")
+    if len(ops) > MAX_BATCH_OPS:
+        return err("Batch request has {} operations, at most {} are allowed"
+                   .format(len(ops), MAX_BATCH_OPS))
+
+    results = [None] * len(ops)
+    # Operations grouped by volume name, in request order
+    groups = {}
+    for index, op in enumerate(ops):
+        try:
+            cmd = op["cmd"]
+            full_vol_name = op["details"]["Name"]
+        except (KeyError, TypeError):
+            results[index] = err("Malformed batch operation #{}".format(index))
+            continue
+        if cmd in ("batch", "version"):
+            results[index] = err("Command '{}' is not allowed in a batch".format(cmd))
+            continue
+        vol_name = full_vol_name.split("@")[0] if full_vol_name else ""
+        groups.setdefault(vol_name, []).append(index)
+
+    pending = list(groups.values())
+    pending_lock = threading.Lock()
+    # The calling thread is one of the workers
+    num_workers = max(min(BATCH_PARALLELISM, len(groups)), 1)
+    running = counter.OpsCounter(num_workers)
+
+    def run_groups():
+        try:
+            while True:
+                with pending_lock:
+                    if not pending:
+                        return
+                    indexes = pending.pop(0)
+                for index in indexes:
+                    op = ops[index]
+                    try:
+                        results[index] = executeRequest(vm_uuid=vm_uuid,
+                                                        vc_uuid=vc_uuid,
+                                                        vm_name=vm_name,
+                                                        config_path=config_path,
+                                                        cmd=op["cmd"],
+                                                        full_vol_name=op["details"]["Name"],
+                                                        opts=op["details"].get("Opts", {}),
+                                                        deadline=deadline)
+                    except Exception as ex:
+                        logging.exception("executeBatchRequest: '%s' failed", op["cmd"])
+                        results[index] = err("Server returned an error: {0}".format(repr(ex)))
+        finally:
+            auth.release_auth_mgr()
+            running.decr()
+
+    for _ in range(num_workers - 1):
+        threadutils.start_new_thread(target=run_groups, daemon=True)
+    run_groups()
+    running.wait()
+
+    return {u'Results': results}
+
+
+def check_deadline(deadline, cmd, full_vol_name):
+    """
+    Returns err() for a request whose client supplied deadline has passed,
+    or None if it should still be executed.
+    """
+    if deadline is None or time.time() < deadline:
+        return None
+    expiredOpsCounter.incr()
+    logging.warning("Dropping expired request '%s' for %s, %.3fs past its deadline (%d dropped so far)",
+                    cmd, full_vol_name, time.time() - deadline, expiredOpsCounter.value)
+    return err("Request '{}' expired before it could be executed".format(cmd))
+
+
+def forget_completed_replies(vol_name):
+    """
+    Drop stored replies for volume vol_name, and all expired ones.
+    """
+    now = time.time()
+    with completed_replies_lock:
+        for key in list(completed_replies):
+            if key[2].split("@")[0] == vol_name or completed_replies[key][0] <= now:
+                del completed_replies[key]
+
+
+def executeRequestForTenant(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_uuid=None, deadline=None):
+    """
+    Does the actual work for executeRequest(), see there.
+    """
     logging.debug("config_path=%s", config_path)
     # get datastore the VM is running on
     vm_datastore_url = vmdk_utils.get_datastore_url_from_config_path(config_path)
@@ -1121,6 +1940,7 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         return errMsg
 
     vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+    request_local.vmdk_path = vmdk_path
 
 
     # Set up locking for volume operations.
@@ -1129,11 +1949,20 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
     # Set thread name to vm_name-lockname
     threadutils.set_thread_name("{0}-{1}".format(vm_name, lockname))
 
+    expired = check_deadline(deadline, cmd, full_vol_name)
+    if expired:
+        return expired
+
     # Get a lock for the volume
     logging.debug("Trying to acquire lock: %s", lockname)
     with lockManager.get_lock(lockname):
         logging.debug("Acquired lock: %s", lockname)
 
+        # The client may have given up while we were waiting for the lock
+        expired = check_deadline(deadline, cmd, full_vol_name)
+        if expired:
+            return expired
+
         if cmd == "get":
             response = getVMDK(vmdk_path, vol_name, datastore)
         elif cmd == "create":
@@ -1156,10 +1985,16 @@ def executeRequest(vm_uuid, vm_name, config_path, cmd, full_vol_name, opts, vc_u
         # For attach/detach reconfigure tasks, hold a per vm lock.
         elif cmd == "attach":
             with lockManager.get_lock(vm_uuid):
+                expired = check_deadline(deadline, cmd, full_vol_name)
+                if expired:
+                    return expired
                 response = attachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
                                       bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         elif cmd == "detach":
             with lockManager.get_lock(vm_uuid):
+                expired = check_deadline(deadline, cmd, full_vol_name)
+                if expired:
+                    return expired
                 response = detachVMDK(vmdk_path=vmdk_path, vm_name=vm_name,
                                       bios_uuid=vm_uuid, vc_uuid=vc_uuid)
         else:
@@ -1252,27 +2087,53 @@ def findDeviceByPath(vmdk_path, vm):
             return d
     return None
 
+def get_extra_config_index(vm, vm_config):
+    '''
+    Return (extra_config, slot_memo) for the given VM config snapshot.
+    extra_config maps lowercase extraConfig keys to values, slot_memo maps
+    controller key to resolved [slot, bus]. Both are cached per VM and
+    rebuilt when the VM config changes.
+    '''
+    vm_id = vm._GetMoId()
+    change_version = vm_config.changeVersion
+    with pci_slot_cache_lock:
+        entry = pci_slot_cache.get(vm_id)
+        if entry and entry[0] == change_version:
+            return entry[1], entry[2]
+
+    extra_config = dict((cfg.key.lower(), cfg.value) for cfg in vm_config.extraConfig)
+    slot_memo = {}
+    with pci_slot_cache_lock:
+        if len(pci_slot_cache) >= MAX_PCI_SLOT_CACHE_SIZE:
+            pci_slot_cache.clear()
+        pci_slot_cache[vm_id] = (change_version, extra_config, slot_memo)
+    return extra_config, slot_memo
+
 # Find the PCI slot number
-def get_controller_pci_slot(vm, pvscsi, key_offset):
+def get_controller_pci_slot(vm, pvscsi, key_offset, vm_config=None):
     ''' Return PCI slot number of the given PVSCSI controller
     Input parameters:
     vm: VM configuration
     pvscsi: given PVSCSI controller
     key_offset: offset from the bus number, controller_key - key_offset
     is equal to the slot number of this given PVSCSI controller
+    vm_config: VM config snapshot to use, fetched from vm if not given
     '''
+    if not vm_config:
+        vm_config = vm.config
+    extra_config, slot_memo = get_extra_config_index(vm, vm_config)
+    if pvscsi.key in slot_memo:
+        return list(slot_memo[pvscsi.key])
+
     if pvscsi.slotInfo:
        slot_num = pvscsi.slotInfo.pciSlotNumber
     else:
        # Slot number is got from from the VM config.
-       key = 'scsi{0}.pciSlotNumber'.format(pvscsi.key -
+       key = 'scsi{0}.pcislotnumber'.format(pvscsi.key -
                                             key_offset)
-       slot = [cfg for cfg in vm.config.extraConfig \
-               if cfg.key.lower() == key.lower()]
+       slot_num = extra_config.get(key)
        # If the given controller exists
-       if slot:
-          slot_num = slot[0].value
-       else:
+       if slot_num is None:
           return None
     # Check if the PCI slot is on the primary or secondary bus
     # and find the slot number for the bridge on the secondary
@@ -1283,18 +2144,16 @@ def get_controller_pci_slot(vm, pvscsi, key_offset):
     while bus > 0:
         bus = bus - 1
         # Get PCI bridge slot number
-        key = 'pciBridge{0}.pciSlotNumber'.format(bus)
-        bridge_slot = [cfg for cfg in vm.config.extraConfig \
-                       if cfg.key.lower() == key.lower()]
-        if bridge_slot:
-            slot_num = bridge_slot[0].value
-        else:
+        key = 'pcibridge{0}.pcislotnumber'.format(bus)
+        slot_num = extra_config.get(key)
+        if slot_num is None:
             # We didn't find a PCI bridge for this bus.
             return None
         bus = (int(slot_num) >> PCI_BUS_BITS) & PCI_BUS_MASK
 
     bus_num = '{0}.{1}'.format(hex(int(slot_num))[2:], func)
-    return [str(orig_slot_num), bus_num]
+    slot_memo[pvscsi.key] = [str(orig_slot_num), bus_num]
+    return list(slot_memo[pvscsi.key])
 
 def dev_info(unit_number, pci_bus_slot_number):
     '''Return a dictionary with Unit/Bus for the vmdk (or error)'''
@@ -1451,9 +2310,6 @@ def find_disk_slot_in_controller(vm, devices, pvsci, idx, offset_from_bus_number
 
     if len(avail_slots) != 0:
         disk_slot = avail_slots.pop()
-        pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
-                                                  offset_from_bus_number)
-
         logging.debug("Find an available slot: controller_key = %d slot = %d", controller_key, disk_slot)
     else:
         logging.warning("No available slot in this controller: controller_key = %d", controller_key)
@@ -1495,7 +2351,9 @@ def disk_attach(vmdk_path, vm):
     max_scsi_controllers = 4
 
 
-    devices = vm.config.hardware.device
+    # Use one config snapshot for all the lookups below
+    vm_config = vm.config
+    devices = vm_config.hardware.device
     # get all scsi controllers (pvsci, lsi logic, whatever)
     controllers = [d for d in devices
                    if isinstance(d, vim.VirtualSCSIController)]
@@ -1515,7 +2373,8 @@ def disk_attach(vmdk_path, vm):
 
         return dev_info(device.unitNumber,
                         get_controller_pci_slot(vm, pvsci[0],
-                                                offset_from_bus_number))
+                                                offset_from_bus_number,
+                                                vm_config))
 
 
     # Disk isn't attached, make sure we have a PVSCI and add it if we don't
@@ -1528,7 +2387,8 @@ def disk_attach(vmdk_path, vm):
         if (disk_slot is not None):
             controller_key = pvsci[idx].key
             pci_slot_number = get_controller_pci_slot(vm, pvsci[idx],
-                                                      offset_from_bus_number)
+                                                      offset_from_bus_number,
+                                                      vm_config)
             logging.debug("Find an available disk slot, controller_key=%d, slot_id=%d",
                           controller_key, disk_slot)
 
@@ -1548,12 +2408,14 @@ def disk_attach(vmdk_path, vm):
             return ret_err
 
         # Find the controller just added
-        devices = vm.config.hardware.device
+        vm_config = vm.config
+        devices = vm_config.hardware.device
         pvsci = [d for d in devices
                  if type(d) == vim.ParaVirtualSCSIController and
                  d.key == controller_key]
         pci_slot_number = get_controller_pci_slot(vm, pvsci[0],
-                                                  offset_from_bus_number)
+                                                  offset_from_bus_number,
+                                                  vm_config)
         logging.info("Added a PVSCSI controller, controller_key=%d pci_slot_number=%s",
                       controller_key, pci_slot_number[0])
 
@@ -1648,6 +2510,9 @@ def disk_detach_int(vmdk_path, vm, device, key=None, value=None):
         return err(msg)
 
     setStatusDetached(vmdk_path, key, value)
+    # Detach may come from vm_listener (VM powered off or disk removed in
+    # vSphere), a stored "attach" reply must not be replayed after it.
+    forget_completed_replies(vmdk_utils.strip_vmdk_extension(os.path.basename(vmdk_path)))
     logging.info("Disk detached %s", vmdk_path)
     return None
 
@@ -1744,7 +2609,9 @@ def wait_ops_in_flight():
         logging.info("All in-flight operations are completed - exiting")
         os.kill(os.getpid(), signal.SIGKILL) # kill the main process
     else:
-        logging.warn("In-flight operations are taking too long to complete - abandoning wait")
+        logging.warn("In-flight operations are taking too long to complete - abandoning wait "
+                     "(%d heavy disk I/O operations running, %d waiting)",
+                     heavy_io_limiter.running.value, heavy_io_limiter.waiting.value)
 
 def signal_handler_stop(signalnum, frame):
     global stopBarrier
@@ -1781,30 +2648,67 @@ def send_vmci_reply(client_socket, reply_string):
         logging.warning("vmci_reply returned error %s (errno=%d)",
                         os.strerror(errno), errno)
 
-def execRequestThread(client_socket, cartel, request):
+def get_vm_identity(cartel):
+    """
+    Returns (vm_name, config_path, vm_uuid, vc_uuid) of the VM with VMX cartel id
+    cartel (we only get cartelID from vmci). vc_uuid is None if the VM has no VC uuid.
+    """
+    vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
+    group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
+    vm_name = group_info["displayName"]
+    cfg_path = group_info["cfgPath"]
+    uuid = group_info["uuid"]            # BIOS UUID, see http://www.virtu-al.net/2015/12/04/a-quick-reference-of-vsphere-ids/
+    vcuuid = group_info["vcUuid"]       # VC UUID
+    # pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
+    # to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
+    UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
+    vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
+    vc_uuid = None
+
+    # Use a VC uuid if one is present.
+    if len(vcuuid) > 0:
+        vc_uuid = UUID_FORMAT.format(*vcuuid.replace("-",  " ").split())
+    return vm_name, cfg_path, vm_uuid, vc_uuid
+
+
+def check_request_rate(vm_uuid, request):
+    """
+    Charges a raw VMCI request from VM vm_uuid to the per VM and per vmgroup
+    rate limits, see auth.RequestRateLimiter. A batch costs a token per
+    operation, "version" and malformed requests are not charged.
+    Returns None if the request can be queued, or error message if it is throttled.
+    """
+    try:
+        req = json.loads(request.decode('utf-8'))
+        cmd = req["cmd"]
+    except Exception:
+        # malformed request, execRequestThread will reply with an error
+        return None
+    if cmd == "version":
+        return None
+    cost = 1
+    details = req.get("details")
+    if cmd == "batch" and isinstance(details, dict) and isinstance(details.get("Ops"), list):
+        cost = max(len(details["Ops"]), 1)
+    try:
+        return auth.request_rate_limiter.check(vm_uuid, cost)
+    finally:
+        auth.release_auth_mgr()
+
+
+def execRequestThread(client_socket, vm_identity, request, arrival=None):
     '''
     Execute requests in a thread context with a per volume locking.
+    vm_identity is (vm_name, config_path, vm_uuid, vc_uuid) of the VM which
+    sent the request, see get_vm_identity().
+    arrival is the time the request was received, the optional "timeout"
+    in the request (seconds) is counted from it.
     '''
     # Before we start, block to allow main thread or other running threads to advance.
     # https://docs.python.org/2/faq/library.html#none-of-my-threads-seem-to-run-why
     time.sleep(0.001)
     try:
-        # Get VM name & ID from VSI (we only get cartelID from vmci, need to convert)
-        vmm_leader = vsi.get("/userworld/cartel/%s/vmmLeader" % str(cartel))
-        group_info = vsi.get("/vm/%s/vmmGroupInfo" % vmm_leader)
-        vm_name = group_info["displayName"]
-        cfg_path = group_info["cfgPath"]
-        uuid = group_info["uuid"]            # BIOS UUID, see http://www.virtu-al.net/2015/12/04/a-quick-reference-of-vsphere-ids/
-        vcuuid = group_info["vcUuid"]       # VC UUID
-        # pyVmomi expects uuid like this one: 564dac12-b1a0-f735-0df3-bceb00b30340
-        # to get it from uuid in VSI vms/<id>/vmmGroup, we use the following format:
-        UUID_FORMAT = "{0}{1}{2}{3}-{4}{5}-{6}{7}-{8}{9}-{10}{11}{12}{13}{14}{15}"
-        vm_uuid = UUID_FORMAT.format(*uuid.replace("-",  " ").split())
-        vc_uuid = None
-
-        # Use a VC uuid if one is present.
-        if len(vcuuid) > 0:
-            vc_uuid = UUID_FORMAT.format(*vcuuid.replace("-",  " ").split())
+        vm_name, cfg_path, vm_uuid, vc_uuid = vm_identity
 
         try:
             req = json.loads(request.decode('utf-8'))
@@ -1817,7 +2721,7 @@ def execRequestThread(client_socket, cartel, request):
             # SERVER_PROTOCOL_VERSION by default to make backward compatible
             client_protocol_version = int(req["version"]) if "version" in req else SERVER_PROTOCOL_VERSION
             logging.debug("execRequestThread: client protocol version=%d", client_protocol_version)
-            if client_protocol_version != SERVER_PROTOCOL_VERSION:
+            if client_protocol_version not in SUPPORTED_PROTOCOL_VERSIONS:
                 reply_string = err("""There is a mismatch between VDVS client (Docker plugin) protocol version
                                     ({}) and server (ESXi) protocol version ({}) which indicates different
                                     versions of the product are installed on Guest and ESXi sides,
@@ -1827,10 +2731,27 @@ def execRequestThread(client_socket, cartel, request):
                 logging.warning("executeRequest '%s' failed: %s", req["cmd"], reply_string)
                 return
 
+            # Clients may tell how long they are going to wait for the reply
+            deadline = None
+            if "timeout" in req and arrival:
+                try:
+                    deadline = arrival + float(req["timeout"])
+                except (TypeError, ValueError):
+                    logging.warning("execRequestThread: ignoring invalid timeout '%s'", req["timeout"])
+
             # If the command is "version" then there is no need to handle the request via
             # the normal VM request handler.
             if req["cmd"] == "version":
                 reply_string = {u'version': "%s" % vmdk_utils.get_version()}
+            elif req["cmd"] == "batch":
+                reply_string = executeBatchRequest(
+                                vm_uuid=vm_uuid,
+                                vc_uuid=vc_uuid,
+                                vm_name=vm_name,
+                                config_path=cfg_path,
+                                ops=req["details"].get("Ops"),
+                                deadline=deadline,
+                                protocol_version=client_protocol_version)
             else:
                 opts = req["details"]["Opts"] if "Opts" in req["details"] else {}
                 reply_string = executeRequest(
@@ -1840,7 +2761,8 @@ def execRequestThread(client_socket, cartel, request):
                                 config_path=cfg_path,
                                 cmd=req["cmd"],
                                 full_vol_name=req["details"]["Name"],
-                                opts=opts)
+                                opts=opts,
+                                deadline=deadline)
 
             logging.info("executeRequest '%s' completed with ret=%s", req["cmd"], reply_string)
             send_vmci_reply(client_socket, reply_string)
@@ -1850,8 +2772,39 @@ def execRequestThread(client_socket, cartel, request):
         reply_string = err("Server returned an error: {0}".format(repr(ex_thr)))
         send_vmci_reply(client_socket, reply_string)
     finally:
+        auth.release_auth_mgr()
         opsCounter.decr()
 
+def get_request_class(request):
+    """
+    Returns priority class (see REQUEST_CLASS_SHARES) for a raw VMCI request.
+    A batch gets the lowest class of its operations, as it is bulk work.
+    """
+    classes = [class_name for class_name, _ in REQUEST_CLASS_SHARES]
+
+    def op_class(cmd, details):
+        if cmd == "version":
+            # trivial, answer right away
+            return "detach"
+        if cmd == "remove":
+            return "create"
+        if cmd == "create" and isinstance(details, dict) and \
+           kv.CLONE_FROM in (details.get("Opts") or {}):
+            return "clone"
+        return cmd if cmd in classes else "get"
+
+    try:
+        req = json.loads(request.decode('utf-8'))
+        if req["cmd"] == "batch":
+            ops = req["details"]["Ops"]
+            return max((op_class(op["cmd"], op.get("details")) for op in ops),
+                       key=classes.index)
+        return op_class(req["cmd"], req.get("details"))
+    except Exception:
+        # malformed request, execRequestThread will reply with an error
+        return "get"
+
+
 # code to grab/release VMCI listening socket
 g_vmci_listening_socket = None
 
@@ -1875,12 +2828,20 @@ def vmci_release_listening_socket():
 
 # load VMCI shared lib , listen on vSocket in main loop, handle requests
 def handleVmciRequests(port):
+    global request_dispatcher
     skip_count = MAX_SKIP_COUNT  # retries for vmci_get_one_op failures
     bsize = MAX_JSON_SIZE
     txt = create_string_buffer(bsize)
     cartel = c_int32()
     vmci_grab_listening_socket(port)
 
+    if not request_dispatcher:
+        request_dispatcher = threadutils.PriorityDispatcher(REQUEST_CLASS_SHARES,
+                                                            REQUEST_WORKERS,
+                                                            REQUEST_MAX_WAIT,
+                                                            "RequestWorker",
+                                                            REQUEST_RESERVED_WORKERS)
+
     while True:
         # Listening on VMCI socket
         logging.debug("lib.vmci_get_one_op: waiting for new request...")
@@ -1918,12 +2879,25 @@ def handleVmciRequests(port):
             send_vmci_reply(client_socket, err(svc_connect_err))
             continue
 
+        request = txt.value
+        # Per VM and per vmgroup rate limits. Throttled requests are failed
+        # right away, so a noisy VM can't fill the queue with its requests.
+        try:
+            vm_identity = get_vm_identity(cartel.value)
+            throttled = check_request_rate(vm_identity[2], request)
+        except Exception as ex:
+            logging.exception("Failed to identify the VM of cartel %s:", cartel.value)
+            send_vmci_reply(client_socket, err("Server returned an error: {0}".format(repr(ex))))
+            continue
+        if throttled:
+            send_vmci_reply(client_socket, err(throttled))
+            continue
+
         opsCounter.incr()
 
-        # Fire a thread to execute the request
-        threadutils.start_new_thread(
-            target=execRequestThread,
-            args=(client_socket, cartel.value, txt.value))
+        # Queue the request for a worker thread, by priority class
+        request_dispatcher.submit(get_request_class(request), execRequestThread,
+                                  client_socket, vm_identity, request, time.time())
 
     # Close listening socket when the loop is over
     logging.info("Closing VMCI listening socket...")
@@ -1960,9 +2934,14 @@ def main():
         kv.init()
         connectLocalSi()
 
+        # keep a local copy of the shared config DB (MultiNode mode) for request path reads
+        auth.auth_db_replica.start()
+
         # start the daemon. Do all the task to start the listener through the daemon
         threadutils.start_new_thread(target=vm_listener.start_vm_changelistener,
                                  daemon=True)
+        threadutils.start_new_thread(target=warm_pool_filler, daemon=True)
+        threadutils.start_new_thread(target=trash_reaper, daemon=True)
         handleVmciRequests(port)
 
     except Exception as e:
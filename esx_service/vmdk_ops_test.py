@@ -24,6 +24,7 @@ import glob
 import os
 import os.path
 import time
+import threading
 
 import vmdk_ops
 import log_config
@@ -49,6 +50,7 @@ from vmdkops_admin_sanity_test import ADMIN_CLI
 import glob
 import vmdkops_admin
 import test_utils
+import threadutils
 # Max volumes count we can attach to a singe VM.
 MAX_VOL_COUNT_FOR_ATTACH = 60
 
@@ -257,6 +259,145 @@ class VmdkCreateRemoveTestCase(unittest.TestCase):
             err = vmdk_ops.removeVMDK(vmdk_path)
             self.assertEqual(err, None, err)
 
+class VmdkWarmPoolTestCase(unittest.TestCase):
+    """Unit test for volume create from a warm pool"""
+
+    volName = "vol_UnitTest_WarmPool"
+    opts = {volume_kv.SIZE: "10mb", volume_kv.DISK_ALLOCATION_FORMAT: "thin"}
+    vm_name = test_utils.generate_test_vm_name()
+
+    def setUp(self):
+        self.name = vmdk_utils.get_vmdk_path(path, self.volName)
+        self.pool_path = vmdk_ops.get_warm_pool_path(path, self.opts)
+        os.makedirs(self.pool_path)
+        self.pool_vmdk = os.path.join(self.pool_path, "warm.vmdk")
+
+    def tearDown(self):
+        vmdk_ops.removeVMDK(self.name)
+        vmdk_ops.remove_warm_pools(path)
+
+    def testCreateFromPool(self):
+        err = vmdk_ops.provisionVMDK(vmdk_path=self.pool_vmdk,
+                                     vm_name=vmdk_ops.WARM_POOL_CREATED_BY,
+                                     vol_name="warm",
+                                     opts=dict(self.opts))
+        self.assertEqual(err, None, err)
+
+        # a create with other options does not use the pool
+        self.assertFalse(vmdk_ops.claim_warm_vmdk(self.name, self.vm_name, {volume_kv.SIZE: "20mb"}))
+
+        err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                  vmdk_path=self.name,
+                                  vol_name=self.volName,
+                                  opts=dict(self.opts))
+        self.assertEqual(err, None, err)
+        self.assertFalse(os.path.isfile(self.pool_vmdk), "Pool disk was not claimed")
+        self.assertTrue(os.path.isfile(self.name), "VMDK {0} is missing after create.".format(self.name))
+        self.assertEqual(volume_kv.get_kv(self.name, volume_kv.CREATED_BY), self.vm_name)
+
+
+class RecordingPool(object):
+    """ Records work items submitted by reap_trash() instead of running them """
+
+    def __init__(self):
+        self.items = []
+
+    def submit(self, key, func, *args):
+        self.items.append((key, func, args))
+
+
+class VmdkTrashTestCase(unittest.TestCase):
+    """Unit test for removed volumes deleted from the trash in the background"""
+
+    volName = "vol_UnitTest_Trash"
+    opts = {volume_kv.SIZE: "10mb", volume_kv.DISK_ALLOCATION_FORMAT: "thin"}
+    vm_name = test_utils.generate_test_vm_name()
+
+    def setUp(self):
+        self.clean_vmdk = vmdk_ops.cleanVMDK
+        self.trashed = []
+
+    def tearDown(self):
+        vmdk_ops.cleanVMDK = self.clean_vmdk
+        for vmdk_path in self.trashed:
+            with vmdk_ops.trash_lock:
+                vmdk_ops.trash_busy.discard(vmdk_path)
+            if os.path.isfile(vmdk_path):
+                vmdk_ops.cleanVMDK(vmdk_path)
+
+    def trash_volumes(self, count):
+        """ Create count volumes and move them to the trash, returns their paths in the trash """
+        datastore = vmdk_utils.get_datastore_from_vmdk_path(vmdk_utils.get_vmdk_path(path, self.volName))
+        trash_path = os.path.join("/vmfs/volumes", datastore, vmdk_ops.DOCK_VOLS_DIR, vmdk_ops.TRASH_DIR)
+        before = set(vmdk_utils.list_vmdks(trash_path))
+        for i in range(count):
+            vol_name = "{0}{1}".format(self.volName, i)
+            vmdk_path = vmdk_utils.get_vmdk_path(path, vol_name)
+            err = vmdk_ops.createVMDK(vm_name=self.vm_name,
+                                      vmdk_path=vmdk_path,
+                                      vol_name=vol_name,
+                                      opts=dict(self.opts))
+            self.assertEqual(err, None, err)
+            err = vmdk_ops.trashVMDK(vmdk_path)
+            self.assertEqual(err, None, err)
+            self.assertFalse(os.path.isfile(vmdk_path), "{0} was not moved to trash".format(vmdk_path))
+        trashed = set(vmdk_utils.list_vmdks(trash_path)) - before
+        self.assertEqual(len(trashed), count)
+        self.trashed = [os.path.join(trash_path, file_name) for file_name in trashed]
+        return [os.path.basename(vmdk_path) for vmdk_path in self.trashed]
+
+    def reap_trash(self, names):
+        """ Run reap_trash(), returns the work items queued for disks names """
+        pool = RecordingPool()
+        vmdk_ops.reap_trash(pool)
+        return [item for item in pool.items if os.path.basename(item[2][0]) in names]
+
+    def test_reap_trash(self):
+        names = self.trash_volumes(2)
+        items = self.reap_trash(names)
+        self.assertEqual(len(items), 2)
+        # disks on the same datastore are not serialized
+        self.assertNotEqual(items[0][0], items[1][0])
+
+        # disks already queued are not queued again
+        self.assertEqual(self.reap_trash(names), [])
+
+        for key, func, args in items:
+            func(*args)
+            self.assertFalse(os.path.isfile(args[0]), "{0} was not deleted".format(args[0]))
+            self.assertNotIn(args[0], vmdk_ops.trash_busy)
+
+    def test_reap_retry(self):
+        names = self.trash_volumes(1)
+        items = self.reap_trash(names)
+        self.assertEqual(len(items), 1)
+        vmdk_path = items[0][2][0]
+
+        vmdk_ops.cleanVMDK = lambda vmdk_path, vol_name=None: "Failed to delete {0}".format(vmdk_path)
+        vmdk_ops.reap_vmdk(vmdk_path)
+        vmdk_ops.cleanVMDK = self.clean_vmdk
+        self.assertTrue(os.path.isfile(vmdk_path))
+        self.assertNotIn(vmdk_path, vmdk_ops.trash_busy)
+
+        # the next pass retries the delete
+        items = self.reap_trash(names)
+        self.assertEqual(len(items), 1)
+        vmdk_ops.reap_vmdk(vmdk_path)
+        self.assertFalse(os.path.isfile(vmdk_path))
+
+    def test_reap_leftovers(self):
+        """ Disks left in the trash by a previous run are deleted by the first pass """
+        self.trash_volumes(vmdk_ops.TRASH_REAPERS + 1)
+        reapers = threadutils.KeyedWorkerPool(vmdk_ops.TRASH_REAPERS, name="TestTrashReaper")
+        vmdk_ops.reap_trash(reapers)
+        for _ in range(600):
+            if not any(os.path.isfile(vmdk_path) for vmdk_path in self.trashed):
+                break
+            time.sleep(0.1)
+        for vmdk_path in self.trashed:
+            self.assertFalse(os.path.isfile(vmdk_path), "{0} was not deleted".format(vmdk_path))
+
+
 class VmdkCreateCloneRemoveTestCase(unittest.TestCase):
     vm_name = test_utils.generate_test_vm_name()
     vm_uuid = str(uuid.uuid4())
@@ -349,6 +490,44 @@ class VmdkCreateCloneRemoveTestCase(unittest.TestCase):
         err = vmdk_ops.removeVMDK(self.name3)
         self.assertEqual(err, None, err)
 
+    def testLinkedCloneDelete(self):
+        err = vmdk_ops.createVMDK(vmdk_path=self.name,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.volName)
+        self.assertEqual(err, None, err)
+
+        linked_opts = {volume_kv.CLONE_FROM: self.volName,
+                       volume_kv.CLONE_MODE: volume_kv.CLONE_MODE_LINKED}
+        err = vmdk_ops.createVMDK(vmdk_path=self.name1,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.volName1,
+                                  opts=dict(linked_opts, **{volume_kv.DISK_ALLOCATION_FORMAT: "thin"}),
+                                  vm_uuid=self.vm_uuid,
+                                  datastore_url=self.vm_datastore_url)
+        self.assertNotEqual(err, None, "Linked clone with a diskformat should fail")
+
+        err = vmdk_ops.createVMDK(vmdk_path=self.name1,
+                                  vm_name=self.vm_name,
+                                  vol_name=self.volName1,
+                                  opts=linked_opts,
+                                  vm_uuid=self.vm_uuid,
+                                  datastore_url=self.vm_datastore_url)
+        self.assertEqual(err, None, err)
+
+        # both volumes are now children of the same parent
+        parent = volume_kv.get_kv(self.name, volume_kv.LINKED_PARENT)
+        self.assertNotEqual(parent, None)
+        self.assertEqual(volume_kv.get_kv(self.name1, volume_kv.LINKED_PARENT), parent)
+        self.assertEqual(volume_kv.get_kv(parent, volume_kv.LINKED_CHILDREN), 2)
+
+        err = vmdk_ops.removeVMDK(self.name)
+        self.assertEqual(err, None, err)
+        self.assertTrue(os.path.isfile(parent), "Parent {0} removed while in use".format(parent))
+
+        err = vmdk_ops.removeVMDK(self.name1)
+        self.assertEqual(err, None, err)
+        self.assertFalse(os.path.isfile(parent), "Parent {0} not removed".format(parent))
+
 class ValidationTestCase(unittest.TestCase):
     """ Test validation of -o options on create """
 
@@ -395,6 +574,37 @@ class ValidationTestCase(unittest.TestCase):
             with self.assertRaises(vmdk_ops.ValidationError):
                 vmdk_ops.validate_opts(opts, self.path)
 
+class VolPathCacheTestCase(unittest.TestCase):
+    """ Test that resolved volume folders are kept while datastores don't change """
+
+    def setUp(self):
+        self.datastores = vmdk_utils.get_datastores()
+        self.datastore = self.datastores[0][0]
+        self.path = self.datastores[0][2]
+        self.tenant_name = "vol_path_cache_test"
+        self.tenant_id = str(uuid.uuid4())
+
+    def tearDown(self):
+        vmdk_utils.invalidate_vol_path_cache()
+        vmdk_utils.init_datastoreCache(force=True)
+
+    def test_list_keeps_cached_folders(self):
+        vmdk_utils.cache_vol_path(self.datastore, self.tenant_name, self.tenant_id, self.path)
+        # make sure list reloads the datastores
+        vmdk_ops.volumes_changed()
+        vmdk_ops.listVMDK(None)
+        self.assertEqual(vmdk_utils.get_cached_vol_path(self.datastore, self.tenant_name, self.tenant_id),
+                         self.path)
+
+    def test_datastore_change_drops_cached_folders(self):
+        vmdk_utils.cache_vol_path(self.datastore, self.tenant_name, self.tenant_id, self.path)
+        # a datastore which is gone
+        vmdk_utils.datastores = self.datastores + [("gone_datastore", "gone_datastore_url",
+                                                    "/vmfs/volumes/gone_datastore/dockvols")]
+        vmdk_utils.init_datastoreCache(force=True)
+        self.assertEqual(vmdk_utils.get_cached_vol_path(self.datastore, self.tenant_name, self.tenant_id),
+                         None)
+
 class VmdkAttachDetachTestCase(unittest.TestCase):
     """ Unit test for VMDK Attach and Detach ops """
 
@@ -625,6 +835,150 @@ class VmdkAuthorizeTestCase(unittest.TestCase):
         error_info = self.auth_mgr.remove_volumes_from_volumes_table(tenant1.id)
         self.assertEqual(error_info, None)
 
+    def test_vmdkop_quota_reservation(self):
+        """ Test that quota reserved by a create in flight is counted by other creates """
+        vms = [(self.vm_uuid, self.vm_name)]
+        privileges = [{'datastore_url': self.datastore_url,
+                       'allow_create': 1,
+                       'max_volume_size': 0,
+                       'usage_quota': 1000}]
+        error_info, tenant1 = self.auth_mgr.create_tenant(name='vmdk_auth_test',
+                                                          description='Tenant used to vmdk_auth_test',
+                                                          vms=vms,
+                                                          privileges=privileges)
+        self.assertEqual(error_info, None)
+
+        opts = {u'size': u'600MB', u'fstype': u'ext4'}
+        reserved = threading.Event()
+        done = threading.Event()
+        result = {}
+
+        def create_in_flight():
+            # authorize a create and hold the reservation until told to finish
+            result['error_info'], _, _ = auth.authorize(vm_uuid=self.vm_uuid,
+                                                        datastore_url=self.datastore_url,
+                                                        cmd=auth.CMD_CREATE,
+                                                        opts=opts,
+                                                        privilege_ds_url=self.datastore_url)
+            reserved.set()
+            done.wait()
+            auth.release_quota_reservation()
+
+        thread = threading.Thread(target=create_in_flight)
+        thread.start()
+        reserved.wait()
+        self.assertEqual(result['error_info'], None)
+
+        # 600MB reserved by the create in flight, another 600MB must not fit in 1000MB
+        error_info, _, _ = auth.authorize(vm_uuid=self.vm_uuid,
+                                          datastore_url=self.datastore_url,
+                                          cmd=auth.CMD_CREATE,
+                                          opts=opts,
+                                          privilege_ds_url=self.datastore_url)
+        self.assertEqual(error_info, "The total volume size exceeds the usage quota")
+
+        # once the create in flight is done (failed), the space is available again
+        done.set()
+        thread.join()
+        error_info, _, _ = auth.authorize(vm_uuid=self.vm_uuid,
+                                          datastore_url=self.datastore_url,
+                                          cmd=auth.CMD_CREATE,
+                                          opts=opts,
+                                          privilege_ds_url=self.datastore_url)
+        self.assertEqual(error_info, None)
+        auth.release_quota_reservation()
+
+class VmdkBatchTestCase(unittest.TestCase):
+    """ Unit test for "batch" requests """
+    vm_name = test_utils.generate_test_vm_name()
+    vm = None
+    vm_config_path = None
+    vol_names = ["batch_vol1", "batch_vol2"]
+    datastore_name = None
+    datastore_path = None
+
+    def setUp(self):
+        """ Setup run before each test """
+        if not self.datastore_name:
+            datastores = vmdk_utils.get_datastores()
+            if not datastores:
+                logging.error("Cannot find a valid datastore")
+                self.assertFalse(True)
+            self.datastore_name = datastores[0][0]
+            self.datastore_path = datastores[0][2]
+
+        si = vmdk_ops.get_si()
+        error, self.vm = test_utils.create_vm(si=si,
+                                              vm_name=self.vm_name,
+                                              datastore_name=self.datastore_name)
+        if error:
+            self.assertFalse(True)
+        self.vm_config_path = vmdk_utils.get_vm_config_path(self.vm_name)
+        self.vm_uuid = vmdk_utils.get_vm_uuid_by_name(self.vm_name)
+        test_utils.create_default_tenant_and_privileges(self)
+
+    def tearDown(self):
+        """ Cleanup after each test """
+        default_tenant_path = os.path.join(self.datastore_path, auth_data_const.DEFAULT_TENANT_UUID)
+        for vol in self.vol_names:
+            vmdk_path = vmdk_utils.get_vmdk_path(default_tenant_path, vol)
+            if os.path.isfile(vmdk_path):
+                vmdk_ops.removeVMDK(vmdk_path)
+        if self.vm:
+            test_utils.remove_vm(vmdk_ops.get_si(), self.vm)
+
+    def execute_batch(self, ops, protocol_version=vmdk_ops.SERVER_PROTOCOL_VERSION):
+        return vmdk_ops.executeBatchRequest(vm_uuid=self.vm_uuid,
+                                            vm_name=self.vm_name,
+                                            config_path=self.vm_config_path,
+                                            ops=ops,
+                                            protocol_version=protocol_version)
+
+    def op(self, cmd, name, opts=None):
+        return {"cmd": cmd, "details": {"Name": name, "Opts": opts or {}}}
+
+    def test_batch_limits(self):
+        """ Test that invalid batches and operations are rejected """
+        ops = [self.op("get", self.vol_names[0])]
+        result = self.execute_batch(ops, protocol_version=vmdk_ops.BATCH_MIN_PROTOCOL_VERSION - 1)
+        self.assertTrue("Error" in result)
+
+        self.assertTrue("Error" in self.execute_batch([]))
+        self.assertTrue("Error" in self.execute_batch("not a list"))
+        too_many = [self.op("get", self.vol_names[0])] * (vmdk_ops.MAX_BATCH_OPS + 1)
+        self.assertTrue("Error" in self.execute_batch(too_many))
+
+        # bad operations fail on their own, the rest of the batch still runs
+        ops = [self.op("batch", self.vol_names[0]),
+               self.op("version", self.vol_names[0]),
+               {"cmd": "get"},
+               self.op("list", None)]
+        result = self.execute_batch(ops)
+        self.assertEqual(len(ops), len(result["Results"]))
+        for reply in result["Results"][:3]:
+            self.assertTrue("Error" in reply, reply)
+        self.assertFalse("Error" in result["Results"][3])
+
+    def test_batch_ops_on_volume_in_order(self):
+        """ Test that operations on the same volume run in the given order """
+        opts = {volume_kv.SIZE: "10mb"}
+        ops = []
+        for vol in self.vol_names:
+            ops += [self.op(auth.CMD_CREATE, vol, opts),
+                    self.op("get", vol),
+                    self.op(auth.CMD_REMOVE, vol),
+                    self.op("get", vol)]
+        result = self.execute_batch(ops)
+        results = result["Results"]
+        self.assertEqual(len(ops), len(results))
+        for i in range(len(self.vol_names)):
+            create, get, remove, get_removed = results[i * 4:i * 4 + 4]
+            self.assertEqual(None, create)
+            self.assertFalse("Error" in get, get)
+            self.assertEqual(None, remove)
+            self.assertTrue("Error" in get_removed, get_removed)
+
+
 class VmdkTenantTestCase(unittest.TestCase):
     """ Unit test for VMDK ops for multi-tenancy """
     default_tenant_vol1_name = "default_tenant_vol1"
@@ -796,6 +1150,10 @@ class VmdkTenantTestCase(unittest.TestCase):
         error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path, auth.CMD_CREATE, self.default_tenant_vol1_name, opts)
         self.assertEqual(None, error_info)
 
+        # a retry of the same create gets the reply of the original one
+        error_info = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path, auth.CMD_CREATE, self.default_tenant_vol1_name, opts)
+        self.assertEqual(None, error_info)
+
         # test attach a volume
         opts={}
         result = vmdk_ops.executeRequest(vm1_uuid, self.vm1_name, self.vm1_config_path, auth.CMD_ATTACH, self.default_tenant_vol1_name, opts)
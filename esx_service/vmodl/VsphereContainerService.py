@@ -174,6 +174,37 @@ class Tenant:
    def privileges(self):
        pass
 
+class TenantRemoveProgress:
+   _name = "vim.vcs.TenantRemoveProgress"
+
+   @JavaDocs(parent=_name, docs =
+   """
+   Progress of the volume removal of a Tenant being removed.
+   """
+   )
+   @Internal(parent=_name)
+   @DataType(name=_name, version=_VERSION)
+   def __init__(self):
+       pass
+
+   @JavaDocs(parent=_name, docs =
+   """
+   Number of volumes of the Tenant when the removal started.
+   """
+   )
+   @Attribute(parent=_name, typ="int")
+   def total(self):
+       pass
+
+   @JavaDocs(parent=_name, docs =
+   """
+   Number of volumes removed so far.
+   """
+   )
+   @Attribute(parent=_name, typ="int")
+   def removed(self):
+       pass
+
 class TenantManager:
    _name = "vim.vcs.TenantManager"
 
@@ -227,6 +258,24 @@ class TenantManager:
    def RemoveTenant(self, name, remove_volumes=False):
        pass
 
+   @JavaDocs(parent=_name, docs=
+   """
+   Query the progress of the volume removal of a Tenant being removed with
+   remove_volumes set. An interrupted removal is resumed by calling
+   RemoveTenant again.
+   @param name Tenant name
+   @return Progress of the volume removal, or unset if none is in progress.
+   @throws vim.fault.NotFound If the tenant name does not exist.
+   @throws vim.fault.VcsFault If an internal server error occurs.
+   """
+   )
+   @Method(parent=_name, wsdlName="GetTenantRemoveProgress",
+           faults=["vim.fault.NotFound", "vim.fault.VcsFault"])
+   @Param(name="name", typ="string")
+   @Return(typ="vim.vcs.TenantRemoveProgress", flags=F_OPTIONAL)
+   def GetTenantRemoveProgress(self, name):
+       pass
+
    @JavaDocs(parent=_name, docs=
    """
    Query Tenant for the given name.
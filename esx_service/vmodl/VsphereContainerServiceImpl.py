@@ -80,6 +80,25 @@ class TenantManagerImpl(vim.vcs.TenantManager):
 
         logging.info("Successfully removed tenant: name=%s", name)
 
+    def GetTenantRemoveProgress(self, name):
+        logging.info("Retrieving tenant remove progress: name=%s", name)
+
+        error_info, progress = auth_api._tenant_rm_progress(name)
+        if error_info:
+            logging.error("Failed to retrieve tenant remove progress: %s", error_info.msg)
+            if error_info.code == ErrorCode.TENANT_NOT_EXIST:
+                raise vim.fault.NotFound(msg=error_info.msg)
+            else:
+                raise vim.fault.VcsFault(msg=error_info.msg)
+
+        if not progress:
+            return None
+
+        result = vim.vcs.TenantRemoveProgress()
+        result.total = progress["total"]
+        result.removed = progress["removed"]
+        return result
+
     def GetTenants(self, name=None):
         logging.info("Retrieving tenant(s): name=%s", name)
 
@@ -250,6 +250,9 @@ class TestVsphereContainerService(unittest.TestCase):
         # Create a tenant
         self.tenantMgr.CreateTenant(name=TENANT_NAME, description=TENANT_DESC)
 
+        # No volume removal in progress
+        self.assertFalse(self.tenantMgr.GetTenantRemoveProgress(name=TENANT_NAME))
+
         # Remove the tenant
         self.tenantMgr.RemoveTenant(name=TENANT_NAME)
 
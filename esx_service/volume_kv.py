@@ -92,6 +92,19 @@ DEFAULT_FILESYSTEM_TYPE = 'ext4'
 CLONE_FROM = 'clone-from' # clone volume parent
 DEFAULT_CLONE_FROM = 'None'
 
+# Clone mode. A full clone is a copy of the source disk, a linked clone is a
+# child (delta) disk of a read-only snapshot of the source.
+CLONE_MODE = 'clone-mode'
+CLONE_MODE_FULL = 'full'
+CLONE_MODE_LINKED = 'linked'
+DEFAULT_CLONE_MODE = CLONE_MODE_FULL
+CLONE_MODES = [CLONE_MODE_FULL, CLONE_MODE_LINKED]
+
+# Linked clones: path of the parent disk (in the child metadata) and number
+# of child disks (in the parent metadata)
+LINKED_PARENT = 'linkedParent'
+LINKED_CHILDREN = 'linkedChildren'
+
 # Create a kv store object for this volume identified by vol_path
 # Create the side car or open if it exists.
 def init():
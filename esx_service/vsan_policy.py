@@ -16,8 +16,12 @@
 # Module for VSAN storage policy creation and configuration
 
 import os
+import json
 import logging
 import shutil
+import threading
+import collections
+import time
 import vmdk_utils
 import vsan_info
 import volume_kv as kv
@@ -25,6 +29,30 @@ import vsan_info
 
 ERROR_NO_VSAN_DATASTORE = 'Error: VSAN datastore does not exist'
 
+# Volumes are updated with a new policy content UPDATE_PARALLELISM at a time.
+# Every UPDATE_PROGRESS_EVERY volumes the progress is saved to a hidden file
+# next to the policy, so that an interrupted update can be resumed by running
+# it again with the same content.
+UPDATE_PARALLELISM = 8
+UPDATE_PROGRESS_EVERY = 20
+
+# Policy file contents, path -> (file identity, content). An entry is used
+# while the file mtime, size and inode are unchanged.
+policy_contents = {}
+policy_contents_lock = threading.Lock()
+
+# Reverse index of the volumes using each policy, saved next to the policies
+# (hidden, so it is not listed as a policy) so that it outlives the admin CLI
+# process. It is a dict with the time it was "built" and the "volumes",
+# real vmdk path -> {"path": vmdk path, "policy": policy name}.
+# The service keeps it up to date for the volumes it creates and removes
+# (see volume_added() and volume_removed()), and it is rebuilt from the
+# volume metadata when it is missing or older than POLICY_INDEX_TTL seconds,
+# which picks up changes made by other hosts sharing the datastore.
+POLICY_INDEX = '.volume_index'
+POLICY_INDEX_TTL = 300
+policy_index_lock = threading.Lock()
+
 def create(name, content):
     """
     Create a new storage policy and save it as dockvols/policies/name in
@@ -47,27 +75,38 @@ def create(name, content):
     return create_policy_file(filename, content)
 
 
-def update(name, content):
+def update(name, content, progress=None):
     """
     Update the content of an existing VSAN policy in the VSAN datastore.
     Update the policy content in each VSAN object currently using the policy. If
     a VSAN policy of the given name does not exist return an error string.
+    progress(updated, failed, total), if set, is called as volumes are updated.
+    An unfinished update with the same content is resumed.
     Return None on success.
     """
     path = policy_path(name)
     if not path:
         return ERROR_NO_VSAN_DATASTORE
 
-    err = update_policy_file_content(path, content)
-    if err:
-        return err
+    update_progress = load_update_progress(name)
+    if update_progress and update_progress['content'] == content:
+        logging.info("Resuming update of policy %s: %d volumes already updated",
+                     name, len(update_progress['updated']))
+    else:
+        # An unfinished update with other content left some volumes with the
+        # content from before it, keep the backup of that one.
+        err = update_policy_file_content(path, content, backup=not update_progress)
+        if err:
+            return err
 
-    return update_vsan_objects_with_policy(name, content)
+    return update_vsan_objects_with_policy(name, content, progress)
 
 
-def update_policy_file_content(path, content):
+def update_policy_file_content(path, content, backup=True):
     """
-    Update the VSAN policy file content. Return an error msg or None on success.
+    Update the VSAN policy file content, saving the old content to a backup
+    file unless backup is False and there is one already.
+    Return an error msg or None on success.
     """
     try:
         with open(path) as f:
@@ -93,7 +132,8 @@ def update_policy_file_content(path, content):
     # attempting to apply it to existing volumes.
     # Do an atomic rename of the tmpfile to the real policy file name
     try:
-        shutil.copy(path, backup_policy_filename(path))
+        if backup or not os.path.isfile(backup_policy_filename(path)):
+            shutil.copy(path, backup_policy_filename(path))
         os.rename(tmpfile, path)
     except OSError:
         print('Internal Error: Failed to update policy file contents: '
@@ -103,43 +143,111 @@ def update_policy_file_content(path, content):
     return None
 
 
-def update_vsan_objects_with_policy(name, content):
+def update_vsan_objects_with_policy(name, content, progress=None):
     """
     Find all VSAN objects using the policy given by `name` and update the policy
-    contents in their objects. Returns an error string containing the list of
+    contents in their objects, UPDATE_PARALLELISM at a time. Volumes already
+    updated by an unfinished update with the same content are skipped.
+    Returns an error string containing the list of
     volumes that failed to update, or a msg if there were no volumes to update.
     Returns None if all volumes were updated successfully.
 
     Note: This function assumes datastore_path exists.
     """
-    update_count = 0
+    update_progress = load_update_progress(name)
+    if not update_progress or update_progress['content'] != content:
+        update_progress = {'content': content, 'updated': []}
+    updated = set(update_progress['updated'])
+    vmdk_paths = get_policy_volumes(name)
+    pending = collections.deque(p for p in vmdk_paths if p not in updated)
+    total = len(vmdk_paths)
     failed_updates = []
-    dockvols_path = vsan_info.get_vsan_dockvols_path()
-    for v in list_volumes_and_policies():
-        if v['policy'] == name:
-            volume_name = v['volume']
-            vmdk_path = os.path.join(v['path'], volume_name)
-            if vsan_info.set_policy(vmdk_path, content):
-                failed_updates.append(volume_name)
-            else:
-                update_count = 1
-
+    lock = threading.Lock()
+
+    def report():
+        """ Save and report progress, called with lock held """
+        update_progress['updated'] = list(updated)
+        save_update_progress(name, update_progress)
+        if progress:
+            progress(len(updated), len(failed_updates), total)
+
+    def update_objects():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                vmdk_path = pending.popleft()
+            err = vsan_info.set_policy(vmdk_path, content)
+            with lock:
+                if err:
+                    failed_updates.append(os.path.basename(vmdk_path))
+                else:
+                    updated.add(vmdk_path)
+                if (len(updated) + len(failed_updates)) % UPDATE_PROGRESS_EVERY == 0:
+                    report()
+
+    workers = [threading.Thread(target=update_objects)
+               for _ in range(min(UPDATE_PARALLELISM, len(pending)) - 1)]
+    for worker in workers:
+        worker.start()
+    update_objects()
+    for worker in workers:
+        worker.join()
+
+    update_count = len(updated)
     if len(failed_updates) != 0:
         if update_count == 0:
             # All volumes failed to update, so reset the original policy
             os.rename(policy_path(backup_policy_filename(name)),
                       policy_path(name))
+            save_update_progress(name, None)
         else:
+            # Keep the progress, running the update again retries the failed volumes
+            report()
             log_failed_updates(failed_updates, name)
 
         return ('Successfully updated: {0} volumes.\n'
                 'Failed to update:     {1} volumes'.format(update_count,
                                                            failed_updates))
 
-    # Remove old policy file on success
+    if progress:
+        progress(update_count, 0, total)
+
+    # Remove old policy file and progress on success
     os.remove(policy_path(backup_policy_filename(name)))
+    save_update_progress(name, None)
     return None
 
+def update_progress_path(name):
+    """ Path of the progress file of a policy update """
+    return policy_path('.{0}.update_progress'.format(name))
+
+def load_update_progress(name):
+    """
+    Return the progress of an unfinished update of the policy, a dict with
+    the new 'content' and the paths of the 'updated' volumes, or None.
+    """
+    try:
+        with open(update_progress_path(name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def save_update_progress(name, update_progress):
+    """ Save the progress of a policy update, or remove it if update_progress is None """
+    path = update_progress_path(name)
+    try:
+        if update_progress is None:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+        tmpfile = '{0}.tmp'.format(path)
+        with open(tmpfile, 'w') as f:
+            json.dump(update_progress, f)
+        os.rename(tmpfile, path)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to save policy update progress %s: %s", path, e)
+
 def backup_policy_filename(name):
     """ Generate a .old file from a policy name or path """
     return '{0}.old'.format(name)
@@ -152,7 +260,7 @@ def log_failed_updates(volumes, policy_name):
     filename = policy_path('{0}.failed_volume_updates'.format(policy_name))
     try:
         with open(filename, 'w') as f:
-            f.write(volumes)
+            f.write('\n'.join(volumes))
             f.write('\n')
     except:
         print("Failed to save volume names that failed to update to file."
@@ -222,18 +330,37 @@ def get_policies():
 
     path = make_policies_dir(path)
     for name in os.listdir(path):
-        with open(os.path.join(path, name)) as f:
-            content = f.read()
-        policies[name] = content
+        # skip hidden files, e.g. update progress
+        if name.startswith('.'):
+            continue
+        policies[name] = read_policy_file(os.path.join(path, name))
     return policies
 
+def read_policy_file(path):
+    """
+    Return the content of a policy file, re-reading it only if it changed.
+    Raises OSError/IOError if the file does not exist.
+    """
+    st = os.stat(path)
+    identity = (st.st_mtime, st.st_size, st.st_ino)
+    with policy_contents_lock:
+        cached = policy_contents.get(path)
+    if cached and cached[0] == identity:
+        return cached[1]
+    with open(path) as f:
+        content = f.read()
+    with policy_contents_lock:
+        policy_contents[path] = (identity, content)
+    return content
+
 def get_policy_content(policy_name):
     """ Return the content for a given policy. """
-    if not policy_exists(policy_name):
+    path = policy_path(policy_name)
+    try:
+        return read_policy_file(path)
+    except (IOError, OSError, TypeError):
         logging.warning("Policy %s does not exist", policy_name)
         return None
-    with open(policy_path(policy_name)) as f:
-        return f.read()
 
 def set_policy_by_name(vmdk_path, policy_name):
     """ Set policy for a given volume. """
@@ -257,6 +384,87 @@ def list_volumes_and_policies():
     return vmdks_and_policies
 
 
+def policy_index_path():
+    """ Path of the policy index, or None if VSAN datastore doesn't exist """
+    return policy_path(POLICY_INDEX)
+
+def load_policy_index(path):
+    """ Return the saved policy index, or None if it is missing, broken or stale """
+    try:
+        index = json.loads(read_policy_file(path))
+        if time.time() - index['built'] < POLICY_INDEX_TTL:
+            return index
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def save_policy_index(path, index):
+    """ Save the policy index atomically """
+    make_policies_dir(os.path.dirname(os.path.dirname(path)))
+    tmpfile = '{0}.tmp'.format(path)
+    try:
+        with open(tmpfile, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmpfile, path)
+    except (IOError, OSError) as e:
+        logging.warning("Failed to save policy index %s: %s", path, e)
+
+def get_policy_index():
+    """
+    Return the volumes in the policy index, building it if needed:
+    real vmdk path -> {"path": vmdk path, "policy": policy name}.
+    """
+    path = policy_index_path()
+    if not path:
+        return {}
+    with policy_index_lock:
+        index = load_policy_index(path)
+        if index is None:
+            logging.info("Building policy index %s", path)
+            volumes = {}
+            for v in list_volumes_and_policies():
+                if v['policy']:
+                    vmdk_path = os.path.join(v['path'], v['volume'])
+                    volumes[os.path.realpath(vmdk_path)] = {'path': vmdk_path,
+                                                            'policy': v['policy']}
+            index = {'built': time.time(), 'volumes': volumes}
+            save_policy_index(path, index)
+        return index['volumes']
+
+def update_policy_index(real_path, entry):
+    """
+    Set (or remove, if entry is None) the index entry of a volume.
+    A missing or stale index is left for the next reader to rebuild.
+    """
+    path = policy_index_path()
+    if not path:
+        return
+    with policy_index_lock:
+        index = load_policy_index(path)
+        if index is None:
+            return
+        if entry:
+            index['volumes'][real_path] = entry
+        elif index['volumes'].pop(real_path, None) is None:
+            return
+        save_policy_index(path, index)
+
+def get_policy_volumes(name):
+    """ Return the list of vmdk paths of the volumes using the policy """
+    return [v['path'] for v in get_policy_index().values() if v['policy'] == name]
+
+def get_policy_usage():
+    """ Return a dict of policy names to the number of volumes using them """
+    return dict(collections.Counter(v['policy'] for v in get_policy_index().values()))
+
+def volume_added(vmdk_path, policy_name):
+    """ Record in the policy index that a new volume uses the policy """
+    update_policy_index(os.path.realpath(vmdk_path), {'path': vmdk_path, 'policy': policy_name})
+
+def volume_removed(vmdk_path):
+    """ Remove a volume from the policy index """
+    update_policy_index(os.path.realpath(vmdk_path), None)
+
 def policy_exists(name):
     """ Check if the policy file exists """
     return os.path.isfile(policy_path(name))
@@ -287,13 +495,12 @@ def kv_get_vsan_policy_name(path):
 
 def policy_in_use(path, name):
     """
-    Check if a policy is in use by a VMDK and return the name of the first VMDK
+    Check if a policy is in use by a VMDK and return the path of the first VMDK
     using it if it is, None otherwise
     """
-    for vmdk in list_volumes_and_policies():
-        policy = vmdk['policy']
-        if policy == name:
-            return vmdk
+    vmdk_paths = get_policy_volumes(name)
+    if vmdk_paths:
+        return vmdk_paths[0]
     return None
 
 
@@ -14,7 +14,9 @@
 
 import unittest
 import os, os.path
+import json
 import vsan_policy
+import vmdk_ops
 import vmdk_utils
 import volume_kv
 import vsan_info
@@ -34,11 +36,19 @@ class TestVsanPolicy(unittest.TestCase):
         self.content = ('(("proportionalCapacity" i50) '
                         '("hostFailuresToTolerate" i0))')
 
+        self.new_content = '(("hostFailuresToTolerate" i0))'
+        self.vmdk_paths = []
+
     def tearDown(self):
-        try:
-            os.remove(self.policy_path)
-        except:
-            pass
+        for vmdk_path in self.vmdk_paths:
+            vmdk_ops.removeVMDK(vmdk_path)
+        for path in (self.policy_path,
+                     vsan_policy.backup_policy_filename(self.policy_path),
+                     vsan_policy.update_progress_path(self.name)):
+            try:
+                os.remove(path)
+            except:
+                pass
 
     def assertPoliciesEqual(self):
         with open(self.policy_path) as f:
@@ -72,6 +82,89 @@ class TestVsanPolicy(unittest.TestCase):
         policies = vsan_policy.get_policies()
         self.assertTrue(self.content + '\n', policies[self.name])
 
+    def test_content_cache(self):
+        self.assertEqual(None, vsan_policy.create(self.name, self.content))
+        self.assertEqual(self.content + '\n', vsan_policy.get_policy_content(self.name))
+        # A modified policy file is read again
+        new_content = '(("hostFailuresToTolerate" i0))'
+        self.assertEqual(None, vsan_policy.update_policy_file_content(self.policy_path, new_content))
+        self.assertEqual(new_content + '\n', vsan_policy.get_policy_content(self.name))
+        os.remove(vsan_policy.backup_policy_filename(self.policy_path))
+
+    def create_volumes(self, count):
+        """ Create count volumes using the test policy """
+        for i in range(len(self.vmdk_paths), len(self.vmdk_paths) + count):
+            vol_name = 'vsan_policy_test_vol{0}'.format(i)
+            vmdk_path = vmdk_utils.get_vmdk_path(vsan_info.get_vsan_dockvols_path(), vol_name)
+            err = vmdk_ops.createVMDK(vmdk_path=vmdk_path,
+                                      vm_name='vsan_policy_test',
+                                      vol_name=vol_name,
+                                      opts={volume_kv.SIZE: '10mb',
+                                            volume_kv.VSAN_POLICY_NAME: self.name})
+            self.assertEqual(None, err, err)
+            self.vmdk_paths.append(vmdk_path)
+
+    def test_update(self):
+        self.assertEqual(None, vsan_policy.create(self.name, self.content))
+        count = vsan_policy.UPDATE_PARALLELISM + 2
+        self.create_volumes(count)
+        reports = []
+        self.assertEqual(None, vsan_policy.update(self.name, self.new_content,
+                                                  lambda *args: reports.append(args)))
+        self.assertEqual((count, 0, count), reports[-1])
+        self.assertEqual(self.new_content + '\n', vsan_policy.get_policy_content(self.name))
+        self.assertFalse(os.path.isfile(vsan_policy.backup_policy_filename(self.policy_path)))
+        self.assertEqual(None, vsan_policy.load_update_progress(self.name))
+
+    def test_update_resume(self):
+        self.assertEqual(None, vsan_policy.create(self.name, self.content))
+        self.create_volumes(3)
+        # An update interrupted after the first volume was updated
+        self.assertEqual(None, vsan_policy.update_policy_file_content(self.policy_path, self.new_content))
+        self.assertEqual(None, vsan_info.set_policy(self.vmdk_paths[0], self.new_content))
+        vsan_policy.save_update_progress(self.name, {'content': self.new_content,
+                                                     'updated': self.vmdk_paths[:1]})
+        reports = []
+        self.assertEqual(None, vsan_policy.update(self.name, self.new_content,
+                                                  lambda *args: reports.append(args)))
+        self.assertEqual((3, 0, 3), reports[-1])
+        self.assertEqual(None, vsan_policy.load_update_progress(self.name))
+
+    def test_policy_index(self):
+        self.assertEqual(None, vsan_policy.create(self.name, self.content))
+        # a missing index is rebuilt from the volume metadata
+        index_path = vsan_policy.policy_index_path()
+        if os.path.isfile(index_path):
+            os.remove(index_path)
+        self.create_volumes(2)
+        self.assertEqual(sorted(self.vmdk_paths), sorted(vsan_policy.get_policy_volumes(self.name)))
+        self.assertTrue(os.path.isfile(index_path))
+        self.assertEqual(2, vsan_policy.get_policy_usage()[self.name])
+        self.assertNotEqual(None, vsan_policy.delete(self.name))
+
+        # the saved index is kept up to date by create and remove
+        self.create_volumes(3)
+        self.assertEqual(sorted(self.vmdk_paths), sorted(vsan_policy.get_policy_volumes(self.name)))
+        vmdk_ops.removeVMDK(self.vmdk_paths.pop())
+        self.assertEqual(sorted(self.vmdk_paths), sorted(vsan_policy.get_policy_volumes(self.name)))
+
+        # a stale index is rebuilt
+        index = vsan_policy.load_policy_index(index_path)
+        index['built'] -= vsan_policy.POLICY_INDEX_TTL
+        index['volumes'] = {}
+        vsan_policy.save_policy_index(index_path, index)
+        self.assertEqual(sorted(self.vmdk_paths), sorted(vsan_policy.get_policy_volumes(self.name)))
+
+    def test_update_keeps_first_backup(self):
+        self.assertEqual(None, vsan_policy.create(self.name, self.content))
+        self.assertEqual(None, vsan_policy.update_policy_file_content(self.policy_path, self.new_content))
+        # another update started before the first one was finished
+        self.assertEqual(None, vsan_policy.update_policy_file_content(self.policy_path,
+                                                                      '(("proportionalCapacity" i10))',
+                                                                      backup=False))
+        with open(vsan_policy.backup_policy_filename(self.policy_path)) as f:
+            self.assertEqual(self.content + '\n', f.read())
+
 
 if __name__ == '__main__':
     volume_kv.init()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# Copyright 2017 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of the storage used lookup done by quota check on the create path.
+# Compares volume_usage table (auth DB 1.3+) with summing volumes table.
+# Runs on ESX against a scratch auth DB, e.g.
+#   PYTHONPATH=/usr/lib/vmware/vmdkops/Python:/usr/lib/vmware/vmdkops/Python/utils \
+#       python quota_check_bench.py 100000
+
+import os
+import sys
+import time
+import uuid
+
+import auth_data
+import auth_data_const
+
+ITERATIONS = 100
+VOLUME_SIZE = 10
+DATASTORE_URL = "bench_datastore_url"
+
+
+def timed(conn, query, args):
+    """ Returns the average time of running query, and its result """
+    start = time.time()
+    for _ in range(ITERATIONS):
+        result = conn.execute(query, args).fetchone()[0]
+    return (time.time() - start) / ITERATIONS, result
+
+
+def main():
+    num_volumes = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    db_path = "/tmp/auth-db-bench-" + str(uuid.uuid4())
+    auth_mgr = auth_data.AuthorizationDataManager(db_path)
+    try:
+        err = auth_mgr.new_db()
+        if err:
+            print("Failed to create {0}: {1}".format(db_path, err))
+            return 1
+        conn = auth_mgr.conn
+        tenant_id = auth_data_const.DEFAULT_TENANT_UUID
+        conn.executemany(
+            "INSERT INTO volumes(tenant_id, datastore_url, volume_name, volume_size) VALUES (?, ?, ?, ?)",
+            ((tenant_id, DATASTORE_URL, "vol{0}".format(i), VOLUME_SIZE) for i in range(num_volumes)))
+        conn.commit()
+
+        args = (tenant_id, DATASTORE_URL)
+        elapsed_usage, usage = timed(conn,
+                                     "SELECT total_size FROM volume_usage WHERE tenant_id = ? and datastore_url = ?",
+                                     args)
+        elapsed_sum, total = timed(conn,
+                                   "SELECT SUM(volume_size) FROM volumes WHERE tenant_id = ? and datastore_url = ?",
+                                   args)
+        if usage != total:
+            print("volume_usage {0} does not match SUM(volume_size) {1}".format(usage, total))
+            return 1
+        print("Quota check with {0} volumes: volume_usage {1:.6f}s, SUM(volumes) {2:.6f}s".format(
+              num_volumes, elapsed_usage, elapsed_sum))
+        return 0
+    finally:
+        if auth_mgr.conn:
+            auth_mgr.conn.close()
+        if os.path.exists(db_path):
+            os.remove(db_path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())